@@ -0,0 +1,424 @@
+"""
+Prefetching client of /get_patches/ for training loops.
+
+PatchLoader keeps several requests in flight over one pooled HTTP
+connection set, so upcoming batches download while the current one trains.
+Response bodies are written into reusable (optionally pinned) buffers and
+the tensors of a batch are views into them. It only needs httpx and numpy,
+torch is used when installed.
+
+    batches = ({f"{brain_id}_{section_id}_{x}_{y}": record, ...} for ...)
+    with PatchLoader("http://localhost:8000", batches, concurrency=4) as loader:
+        for batch in loader:
+            train_step(batch.images)
+    print(loader.meter)
+"""
+import itertools
+import json
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# numpy dtypes of the safetensors dtype names
+DTYPES = {
+    "BOOL": np.bool_,
+    "U8": np.uint8,
+    "I8": np.int8,
+    "U16": np.uint16,
+    "I16": np.int16,
+    "I32": np.int32,
+    "I64": np.int64,
+    "F16": np.float16,
+    "F32": np.float32,
+    "F64": np.float64,
+}
+
+# torch dtypes of the safetensors dtype names this torch supports
+TORCH_DTYPES = {}
+if torch is not None:
+    for _name, _dtype in DTYPES.items():
+        try:
+            TORCH_DTYPES[_name] = torch.from_numpy(np.empty(0, dtype=_dtype)).dtype
+        except TypeError:
+            pass
+
+
+class ThroughputMeter(object):
+    """
+    Patches, bytes and request latencies of a loader, in total and over the
+    last `window` seconds. Safe to update from the request threads.
+
+    Parameters
+    ---
+    - window: float, seconds of the recent rates
+    """
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.patches = 0
+        self.bytes = 0
+        self.batches = 0
+        self.events = deque()
+        self.latencies = deque(maxlen=1024)
+
+    def add(self, patches, nbytes, latency):
+        now = time.perf_counter()
+        with self.lock:
+            self.patches += patches
+            self.bytes += nbytes
+            self.batches += 1
+            self.latencies.append(latency)
+            self.events.append((now, patches, nbytes))
+            while self.events and self.events[0][0] < now - self.window:
+                self.events.popleft()
+
+    def rates(self):
+        """Total and recent patches/s and MB/s, and request latency percentiles in ms"""
+        now = time.perf_counter()
+        with self.lock:
+            elapsed = max(now - self.start, 1e-9)
+            recent = [e for e in self.events if e[0] >= now - self.window]
+            span = max(min(self.window, elapsed), 1e-9)
+            latencies = np.asarray(self.latencies) * 1000
+            return {
+                "patches_per_s": self.patches / elapsed,
+                "mb_per_s": self.bytes / elapsed / 1e6,
+                "recent_patches_per_s": sum(e[1] for e in recent) / span,
+                "recent_mb_per_s": sum(e[2] for e in recent) / span / 1e6,
+                "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                "latency_p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+            }
+
+    def __str__(self):
+        r = self.rates()
+        return (
+            f"{self.batches} batches  {self.patches} patches  "
+            f"{r['patches_per_s']:.1f} patches/s  {r['mb_per_s']:.1f} MB/s  "
+            f"(last {self.window:g}s {r['recent_patches_per_s']:.1f} patches/s)  "
+            f"latency p50 {r['latency_p50_ms']:.1f}ms p95 {r['latency_p95_ms']:.1f}ms"
+        )
+
+
+class ResponseBuffer(object):
+    """
+    Growable byte buffer a response body is written into and kept for the
+    next response. With pin_memory it is page-locked torch memory, so the
+    decoded tensors can be copied to the GPU with non_blocking=True.
+
+    Parameters
+    ---
+    - nbytes: int, initial capacity
+    - pin_memory: bool, allocate page-locked memory (needs torch with CUDA)
+    """
+
+    def __init__(self, nbytes=0, pin_memory=False):
+        self.pin_memory = pin_memory
+        self.size = 0
+        self.allocate(nbytes)
+
+    def allocate(self, nbytes):
+        if self.pin_memory:
+            self.tensor = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+            self.array = self.tensor.numpy()
+        else:
+            self.tensor = None
+            self.array = np.empty(nbytes, dtype=np.uint8)
+
+    def reserve(self, nbytes):
+        """Grow to at least nbytes, keeping what was written so far"""
+        if nbytes <= len(self.array):
+            return
+        written = self.array[: self.size].copy() if self.size else None
+        self.allocate(max(nbytes, 2 * len(self.array)))
+        if written is not None:
+            self.array[: self.size] = written
+
+    def write(self, data):
+        n = len(data)
+        self.reserve(self.size + n)
+        self.array[self.size : self.size + n] = np.frombuffer(data, dtype=np.uint8)
+        self.size += n
+
+    def reset(self):
+        self.size = 0
+
+    def view(self, dtype, start, stop, shape):
+        """Tensor of the bytes [start, stop), sharing the buffer memory"""
+        array = self.array[start:stop].view(DTYPES[dtype]).reshape(shape)
+        if torch is None:
+            return array
+        if self.tensor is not None:
+            # Sliced from the pinned tensor so the view is pinned as well
+            return self.tensor[start:stop].view(TORCH_DTYPES[dtype]).view(shape)
+        return torch.from_numpy(array)
+
+
+def decode_safetensors(buffer, offset=0):
+    """Tensors of the safetensors file at `offset` of a ResponseBuffer, as views into it"""
+    (n,) = struct.unpack_from("<Q", buffer.array, offset)
+    header = json.loads(buffer.array[offset + 8 : offset + 8 + n].tobytes())
+    header.pop("__metadata__", None)
+    start = offset + 8 + n
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        tensors[name] = buffer.view(info["dtype"], start + begin, start + end, info["shape"])
+    return tensors
+
+
+class Decompressor(object):
+    """Incremental decoder of a response Content-Encoding"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self.decoder = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding == "lz4":
+            self.decoder = lz4_frame.LZ4FrameDecompressor()
+        elif encoding in (None, "identity"):
+            self.decoder = None
+        else:
+            raise ValueError(f"Unsupported Content-Encoding {encoding!r}")
+
+    def decompress(self, chunk):
+        return chunk if self.decoder is None else self.decoder.decompress(chunk)
+
+
+class PatchBatch(object):
+    """
+    One response of /get_patches/. Images (and masks) are in the order of
+    ids and share the memory of buffer.
+
+    Parameters
+    ---
+    - ids: list[str], patch ids of the request
+    - images: list, image tensor of every patch
+    - masks: list or None, label mask of every patch
+    - buffer: ResponseBuffer, memory of the tensors
+    - latency: float, seconds from sending the request to the decoded batch
+    """
+
+    def __init__(self, ids, images, masks, buffer, latency):
+        self.ids = ids
+        self.images = images
+        self.masks = masks
+        self.buffer = buffer
+        self.latency = latency
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.buffer.size
+
+    def as_dict(self):
+        return {"ids": self.ids, "images": self.images, "masks": self.masks}
+
+
+class PatchLoader(object):
+    """
+    Iterate over PatchBatches of /get_patches/, in the order of `batches`,
+    with up to `concurrency` requests in flight. Requests share one httpx
+    connection pool.
+
+    With reuse_buffers, the buffer of a batch is recycled when the next batch
+    is requested: use or copy its tensors (e.g. .to("cuda", non_blocking=True)
+    from pinned memory) before moving on. At most concurrency + 1 buffers are
+    ever allocated.
+
+    Parameters
+    ---
+    - url: str, base url of the patch service
+    - batches: iterable of dict, patch id -> record (PostPatchRecordSchema or dict) of every batch
+    - concurrency: int, requests in flight
+    - masks: bool, also fetch the label masks
+    - level: int or None, pyramid level set on records that have none
+    - codec: str or None, "zstd" or "lz4" to ask for a compressed response
+    - cache: bool, let the service answer from its response cache (for batches sent again, e.g. validation sets)
+    - pin_memory: bool, decode into page-locked memory
+    - reuse_buffers: bool, recycle buffers across batches
+    - timeout: float, seconds allowed per request
+    - client: httpx.Client or None, shared client, created (and closed) by the loader when None
+    - meter: ThroughputMeter or None
+    """
+
+    def __init__(
+        self,
+        url,
+        batches,
+        concurrency=4,
+        masks=False,
+        level=None,
+        codec=None,
+        cache=False,
+        pin_memory=False,
+        reuse_buffers=True,
+        timeout=120.0,
+        client=None,
+        meter=None,
+    ):
+        if (codec == "zstd" and zstandard is None) or (codec == "lz4" and lz4_frame is None):
+            raise ImportError(f"The {codec} codec is not installed")
+        if pin_memory and torch is None:
+            raise ImportError("pin_memory needs torch")
+        self.url = url.rstrip("/")
+        self.batches = batches
+        self.concurrency = max(concurrency, 1)
+        self.masks = masks
+        self.level = level
+        self.codec = codec
+        self.cache = cache
+        self.pin_memory = pin_memory
+        self.reuse_buffers = reuse_buffers
+        self.timeout = timeout
+        self.own_client = client is None
+        self.client = client if client is not None else httpx.Client(
+            limits=httpx.Limits(
+                max_connections=self.concurrency, max_keepalive_connections=self.concurrency
+            ),
+            timeout=timeout,
+        )
+        self.meter = meter if meter is not None else ThroughputMeter()
+        self.buffers = []
+        self.buffers_lock = threading.Lock()
+
+    def acquire(self):
+        with self.buffers_lock:
+            if self.buffers:
+                return self.buffers.pop()
+        return ResponseBuffer(pin_memory=self.pin_memory)
+
+    def release(self, buffer):
+        if self.reuse_buffers:
+            with self.buffers_lock:
+                self.buffers.append(buffer)
+
+    def request_body(self, records):
+        patches = {}
+        for idx, record in records.items():
+            record = dict(record)
+            if self.level is not None:
+                record.setdefault("level", self.level)
+            patches[f"{idx}"] = record
+        return {"patches": patches}
+
+    def fetch(self, records):
+        """Send one batch and decode the response into a buffer, on a request thread"""
+        ids = [f"{idx}" for idx in records]
+        headers = {"Accept-Encoding": self.codec or "identity"}
+        buffer = self.acquire()
+        buffer.reset()
+        start = time.perf_counter()
+        try:
+            with self.client.stream(
+                "POST",
+                f"{self.url}/get_patches/",
+                params={"masks": self.masks, "cache": self.cache},
+                json=self.request_body(records),
+                headers=headers,
+                timeout=self.timeout,
+            ) as response:
+                if response.status_code >= 400:
+                    response.read()
+                    response.raise_for_status()
+                length = response.headers.get("content-length")
+                decoder = Decompressor(response.headers.get("content-encoding"))
+                if length is not None and decoder.decoder is None:
+                    buffer.reserve(int(length))
+                for chunk in response.iter_raw():
+                    buffer.write(decoder.decompress(chunk))
+            tensors = decode_safetensors(buffer)
+        except BaseException:
+            self.release(buffer)
+            raise
+        latency = time.perf_counter() - start
+        images = [tensors[f"{n}"] for n in range(len(ids))]
+        masks = [tensors[f"{n}_mask"] for n in range(len(ids))] if self.masks else None
+        self.meter.add(len(ids), buffer.size, latency)
+        return PatchBatch(ids, images, masks, buffer, latency)
+
+    def __iter__(self):
+        batches = iter(self.batches)
+        in_flight = deque()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        def submit_next():
+            records = next(batches, None)
+            if records is not None:
+                in_flight.append(executor.submit(self.fetch, records))
+
+        try:
+            for _ in range(self.concurrency):
+                submit_next()
+            while in_flight:
+                batch = in_flight.popleft().result()
+                submit_next()
+                yield batch
+                self.release(batch.buffer)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def close(self):
+        if self.own_client:
+            self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if torch is not None:
+
+    class PatchDataset(torch.utils.data.IterableDataset):
+        """
+        torch IterableDataset of PatchLoader batches, for
+        DataLoader(dataset, batch_size=None). Each DataLoader worker fetches
+        every num_workers-th batch with a loader of its own. Buffers are not
+        reused in workers, whose tensors reach the main process asynchronously.
+
+        Parameters
+        ---
+        - url: str, base url of the patch service
+        - batches: iterable of dict, re-iterable once per epoch
+        - loader_kwargs: PatchLoader options
+        """
+
+        def __init__(self, url, batches, **loader_kwargs):
+            self.url = url
+            self.batches = batches
+            self.loader_kwargs = loader_kwargs
+
+        def __iter__(self):
+            batches, kwargs = self.batches, dict(self.loader_kwargs)
+            info = torch.utils.data.get_worker_info()
+            if info is not None:
+                batches = itertools.islice(batches, info.id, None, info.num_workers)
+                kwargs["reuse_buffers"] = False
+            with PatchLoader(self.url, batches, **kwargs) as loader:
+                for batch in loader:
+                    yield batch.as_dict()
@@ -1,40 +1,122 @@
 from distributed.client import Client
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 import asyncio
+import os
+import threading
 from sqlalchemy.orm import Session, sessionmaker
 from contextlib import asynccontextmanager
+from ...lib.db_config import metadata_dsn
+from ...lib.inverted_index import RegionPatchIndex
+from .response_cache import ResponseCache
+
+DASK_SCHEDULER_ADDRESS = "tcp://127.0.0.1:8786"
+
+# Connection pool of the shared async engine
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+
+# Shared across requests, created in the app lifespan
+_engine = None
+_session_maker = None
+_dask_client = None
+_dask_client_lock = asyncio.Lock()
+_region_indexes = {}
+_region_indexes_lock = threading.Lock()
+_response_cache = None
+
 
 def async_session_generator(engine):
     return sessionmaker(engine, class_=AsyncSession)
 
-def register_async_engine():
-    dialect = "postgresql+asyncpg"
-    user_name = "postgres"
-    host = "qd3.humanbrain.in"
-    port = "15432"
-    db_name = "test_metadata_patch"
-    password = "password"
+def register_async_engine(
+    pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=DB_POOL_PRE_PING
+):
     engine = create_async_engine(
-        f"{dialect}://{user_name}:{password}@{host}:{port}/{db_name}"
+        metadata_dsn("postgresql+asyncpg"),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=pool_pre_ping,
     )
     return engine
 
+def get_engine():
+    global _engine, _session_maker
+    if _engine is None:
+        _engine = register_async_engine()
+        _session_maker = async_session_generator(_engine)
+    return _engine
+
 @asynccontextmanager
-async def get_session():
-    try:
-        engine = register_async_engine()
-        async_session = async_session_generator(engine)
-        async with async_session() as session:  # type: ignore
+async def session_scope():
+    """AsyncSession of the shared engine, rolled back on errors"""
+    get_engine()
+    async with _session_maker() as session:  # type: ignore
+        try:
             yield session
-    except:
-        await session.rollback()
-        raise
-    finally:
-        await session.close()
+        except:
+            await session.rollback()
+            raise
 
-def get_dask_client() -> Client:
+async def get_session():
+    """Depends provider of a request scoped session, closed once the request is done"""
+    async with session_scope() as session:
+        yield session
+
+async def connect_dask_client() -> Client:
     from dask.distributed import Client
-    client = Client(address="tcp://127.0.0.1:8786")
+    client = await Client(address=DASK_SCHEDULER_ADDRESS, asynchronous=True)
     return client
 
+async def get_dask_client() -> Client:
+    """
+    Return the shared asynchronous client. The client reconnects on its own
+    while the LocalCluster restarts; once it gives up it is replaced here.
+    """
+    global _dask_client
+    async with _dask_client_lock:
+        if _dask_client is None or _dask_client.status in ("closing", "closed", "failed"):
+            _dask_client = await connect_dask_client()
+    return _dask_client
+
+async def get_client() -> Client:
+    """Depends provider of the shared Dask client, see get_dask_client"""
+    return await get_dask_client()
+
+def get_region_patch_index(brain_id) -> RegionPatchIndex:
+    """
+    Region to patch index of a brain, opened read-only once and shared by every
+    request. Blocking, call it from the threadpool. Raises FileNotFoundError
+    when the brain has no index, so unknown brains are never opened or kept.
+    """
+    with _region_indexes_lock:
+        if brain_id not in _region_indexes:
+            _region_indexes[brain_id] = RegionPatchIndex.for_brain(brain_id, read_only=True)
+        return _region_indexes[brain_id]
+
+def get_response_cache() -> ResponseCache:
+    """Disk cache of /get_patches/ responses, indexed on first use"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+def response_cache_stats():
+    return _response_cache.stats() if _response_cache is not None else None
+
+async def open_shared_resources():
+    get_engine()
+    await get_dask_client()
 
+async def close_shared_resources():
+    global _engine, _session_maker, _dask_client
+    if _dask_client is not None:
+        await _dask_client.close()
+        _dask_client = None
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+        _session_maker = None
+    for region_index in _region_indexes.values():
+        region_index.close()
+    _region_indexes.clear()
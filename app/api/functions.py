@@ -1,15 +1,21 @@
-from ...lib.patch import Patch
+from ...lib.patch import Patch, PatchBatchReader
+from ...lib.chunk_cache import get_chunk_cache, chunk_cache_stats, store_stamp
+from ...lib.pyramid import level_store_path
+from ...lib.raster import label_store_path
+import numpy as np
 import zarr as za
-import dask.array as da
 from dask.array import from_zarr as da_zarr  # type: ignore
 
 # import dask.delayed as da_delayed
-from tqdm import tqdm
+from functools import lru_cache
 import torch
-import safetensors as st
-from safetensors.torch import save as st_save
-from .dependencies import get_dask_client
-from .models import PostPatchRecordsSchema, PostPatchRecordSchema
+from dask.distributed import as_completed
+from .models import PostPatchRecordSchema
+from .serialization import safetensors_parts, frame_parts
+from .scheduling import cluster_workers, group_records, locality_key, placement
+
+# Store handles a worker keeps open across tasks
+STORE_HANDLES = 256
 
 
 def get_patch_array(patch: PostPatchRecordSchema):
@@ -18,26 +24,198 @@ def get_patch_array(patch: PostPatchRecordSchema):
         section_id=patch.section_id,
         x=patch.x,
         y=patch.y,
-        store=da_zarr(patch.store_path),
+        store=da_zarr(level_store_path(patch.store_path, patch.level)),
+        level=patch.level,
     ).array()
 
 
+def open_store(path):
+    """
+    zarr handle of a store, kept open by the worker process until the store
+    is rewritten (its stamp changes)
+    """
+    return open_store_version(path, store_stamp(path))
+
+
+@lru_cache(maxsize=STORE_HANDLES)
+def open_store_version(path, stamp):
+    return za.open(path, mode="r")
+
+
 # @dask.delayed
 def convert_to_tensor(patch):
-    patch = get_patch_array(patch).compute()  # type: ignore
-    torch_tensor = torch.tensor(patch)
-    return torch_tensor
+    # Through the batch reader, so single patches also use the worker chunk cache
+    return convert_store_to_tensors([patch])[0]
+
+
+def convert_store_to_tensors(patches):
+    """Read all patches of one store and level with a single batch reader"""
+    store = open_store(level_store_path(patches[0].store_path, patches[0].level))
+    batch = [
+        Patch(
+            brain_id=patch.brain_id,
+            section_id=patch.section_id,
+            x=patch.x,
+            y=patch.y,
+            store=store,
+            level=patch.level,
+        )
+        for patch in patches
+    ]
+    reader = PatchBatchReader(cache=get_chunk_cache())
+    # Patches are assembled contiguous, only a picked channel is copied here
+    return [torch.from_numpy(np.ascontiguousarray(array)) for array in reader.read(batch)]
+
+
+def convert_store_to_masks(patches):
+    """
+    Label masks of the patches of one store, from the section label store
+    written by PatchDB.rasterize_labels. The masks are full resolution and
+    subsampled to the level of the patches.
+    """
+    store = open_store(label_store_path(patches[0].store_path))
+    batch = [
+        Patch(
+            brain_id=patch.brain_id,
+            section_id=patch.section_id,
+            x=patch.x,
+            y=patch.y,
+            store=store,
+        )
+        for patch in patches
+    ]
+    factor = 2 ** patches[0].level
+    reader = PatchBatchReader(cache=get_chunk_cache())
+    # torch has no general uint16 support, region ids are sent as int32
+    return [
+        torch.from_numpy(mask[::factor, ::factor].astype(np.int32))
+        for mask in reader.read(batch)
+    ]
+
+
+def convert_to_pair(patch):
+    """Image and label mask of a single patch"""
+    return convert_to_tensor(patch), convert_store_to_masks([patch])[0]
 
 
-def process_patches(patch_records):
-    client = get_dask_client()
-    all_patches = [
-        client.submit(convert_to_tensor, patch=patch_records[idx])
-        for idx in patch_records
+async def process_patches(client, patch_records, masks=False):
+    """
+    Read the patches on the cluster of the Dask client with one task per
+    chunk neighbourhood of a store, each pinned to the worker that always
+    reads that neighbourhood
+    """
+    workers = await cluster_workers(client)
+    groups = group_records(patch_records)
+    batches = [[patch_records[idx] for idx in group_idx] for group_idx in groups.values()]
+    places = [placement(key, workers) for key in groups]
+    futures = [
+        client.submit(convert_store_to_tensors, batch, **place)
+        for batch, place in zip(batches, places)
     ]
-    all_patches = client.compute(all_patches, sync=True)
+    if masks:
+        futures += [
+            client.submit(convert_store_to_masks, batch, **place)
+            for batch, place in zip(batches, places)
+        ]
+    results = await client.gather(futures)
+    tensors = {
+        idx: tensor
+        for group_idx, group_tensors in zip(groups.values(), results)
+        for idx, tensor in zip(group_idx, group_tensors)
+    }
     patch_tensors = {
-        f"{idx}": patch for idx, patch in enumerate(all_patches)  # type: ignore
+        f"{n}": tensors[idx] for n, idx in enumerate(patch_records)  # type: ignore
     }
-    data = st_save(patch_tensors)
-    return data
+    if masks:
+        mask_tensors = {
+            idx: mask
+            for group_idx, group_masks in zip(groups.values(), results[len(batches) :])
+            for idx, mask in zip(group_idx, group_masks)
+        }
+        for n, idx in enumerate(patch_records):
+            patch_tensors[f"{n}_mask"] = mask_tensors[idx]
+    return patch_tensors
+
+
+def region_patch_records(region_index, region_id, brain_id, level=0, **query):
+    """Page of the inverted index as /get_patches/ records and their coverage"""
+    patches, coverage = {}, {}
+    for section_id, min_x, min_y, _, ratio in region_index.query(region_id, **query):
+        patch_id = f"{brain_id}_{section_id}_{min_x}_{min_y}"
+        patches[patch_id] = PostPatchRecordSchema(
+            brain_id=brain_id,
+            section_id=section_id,
+            x=min_x,
+            y=min_y,
+            store_path=f"/storage/BrainSAM/zarr_n5/optimum_1024/{brain_id}/{section_id}.n5",
+            level=level,
+        )
+        coverage[patch_id] = ratio
+    return patches, coverage
+
+
+async def gather_cache_stats(client):
+    """Chunk cache counters of every cluster worker and their totals"""
+    workers = await client.run(chunk_cache_stats)
+    total = {}
+    for stats in workers.values():
+        for k, v in stats.items():
+            total[k] = total.get(k, 0) + v
+    return {"workers": workers, "total": total}
+
+
+# Number of patches submitted to the cluster but not yet streamed out
+STREAM_WINDOW = 32
+
+
+def frame_patch(key, tensor, mask=None):
+    """
+    Frame a patch as a little-endian u64 length followed by a safetensors
+    blob, holding the image under `key` and its label mask under `key`_mask
+    (see serialization for the tensor names). Returns the buffers of the
+    record, the tensor data is not copied.
+    """
+    tensors = {f"{key}": tensor}
+    if mask is not None:
+        tensors[f"{key}_mask"] = mask
+    return frame_parts(safetensors_parts(tensors))
+
+
+async def stream_patches(client, patch_records, window=STREAM_WINDOW, masks=False):
+    """
+    Submit the patches to the cluster asynchronously and yield the buffers of
+    each one as a framed record as soon as its future completes. At most `window` patches
+    are in flight, which bounds the memory held by a single request. With
+    masks, every record also carries the patch's label mask. Tensors are named
+    by the position of the patch in the request, as in process_patches, and
+    each patch runs on the worker of its chunk neighbourhood.
+    """
+    workers = await cluster_workers(client)
+    pending = iter(enumerate(patch_records))
+    in_flight = {}
+    futures = as_completed(loop=client.loop)
+
+    def submit_next():
+        n, idx = next(pending, (None, None))
+        if idx is None:
+            return
+        convert = convert_to_pair if masks else convert_to_tensor
+        record = patch_records[idx]
+        future = client.submit(
+            convert, patch=record, pure=False, **placement(locality_key(record), workers)
+        )
+        in_flight[future.key] = n, future
+        futures.add(future)
+
+    try:
+        for _ in range(max(window, 1)):
+            submit_next()
+        async for future in futures:
+            result = await future
+            n, _ = in_flight.pop(future.key)
+            submit_next()
+            yield frame_patch(n, *result) if masks else frame_patch(n, result)
+    finally:
+        # Stop cluster work for clients that disconnect mid-stream
+        for _, future in in_flight.values():
+            future.cancel()
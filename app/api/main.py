@@ -1,14 +1,31 @@
 from contextlib import asynccontextmanager
-from fastapi import Depends, FastAPI, Header, HTTPException, Response
-from dask.distributed import LocalCluster
-from .dependencies import get_session
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from typing import Optional
+from dask.distributed import Client, LocalCluster
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from .dependencies import get_client, get_session, open_shared_resources, close_shared_resources, get_region_patch_index, get_response_cache, response_cache_stats
 from typing_extensions import Annotated
-from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import StreamingResponse
 from ...lib.query.fetch import QFetch
-from .models import PostPatchRecordsSchema
+from .models import PostPatchRecordsSchema, RegionPatchesSchema
 from fastapi.middleware.cors import CORSMiddleware
-from .functions import process_patches
+from .functions import process_patches, stream_patches, gather_cache_stats, region_patch_records, STREAM_WINDOW
+from ...lib.region_index import regions_in_window
+from ...lib.polygon_graph import InvalidGeojsonError
+from zarr.errors import PathNotFoundError
+from .serialization import (
+    BufferStreamingResponse,
+    GZipExceptOctetStreamMiddleware,
+    aencode_groups,
+    encode_groups,
+    negotiate_codec,
+    safetensors_parts,
+)
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
+from starlette.responses import Response
+from .response_cache import CachedPayloadResponse, etag, etag_matches, response_key
 
 
 @asynccontextmanager
@@ -17,12 +34,17 @@ async def lifespan(app: FastAPI):
     import sys
     sys.path.append('/storage/')
     cluster = LocalCluster(n_workers=16,processes=True,threads_per_worker=1, scheduler_port=8786)
+    # Dask client and DB engine shared by every request, handed to the
+    # endpoints by the get_client and get_session dependencies
+    await open_shared_resources()
     yield
     # Clean up the ML models and release the resources
+    await close_shared_resources()
     cluster.close()
 
 app = FastAPI(lifespan=lifespan)
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Patch tensors (application/octet-stream) are never gzipped, see /get_patches/
+app.add_middleware(GZipExceptOctetStreamMiddleware, minimum_size=1000)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -32,14 +54,145 @@ app.add_middleware(
 )
 
 @app.get('/status')
-async def status():
-    return {"message": "OK"}
+async def status(session: Annotated[AsyncSession, Depends(get_session)]):
+    # The API itself is up either way, the metadata DB is reported next to it
+    try:
+        await session.execute(text("SELECT 1"))
+        metadata_db = "OK"
+    except (SQLAlchemyError, OSError):
+        metadata_db = "unavailable"
+    return {"message": "OK", "metadata_db": metadata_db}
+
+
+@app.get('/metrics')
+async def metrics(client: Annotated[Client, Depends(get_client)]):
+    return {
+        "chunk_cache": await gather_cache_stats(client),
+        "response_cache": response_cache_stats(),
+    }
+
+
+@app.get('/regions_in_window/')
+async def get_regions_in_window(
+    brain_id: int, section_id: int, min_x: int, min_y: int, max_x: int, max_y: int
+):
+    # Window in full resolution pixels, answered from the cached section region index
+    try:
+        regions = await run_in_threadpool(
+            regions_in_window, brain_id, section_id, (min_x, min_y, max_x, max_y)
+        )
+    except (FileNotFoundError, PathNotFoundError):
+        raise HTTPException(status_code=404, detail="Section not found")
+    except InvalidGeojsonError:
+        raise HTTPException(status_code=422, detail="Section has no usable geojson")
+    return {"brain_id": brain_id, "section_id": section_id, "regions": regions}
+
+
+@app.get('/region_patches/', response_model=RegionPatchesSchema)
+async def get_region_patches(
+    region_id: int,
+    brain_id: int,
+    min_coverage: float = 0.0,
+    section_min: Optional[int] = None,
+    section_max: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=10000),
+    offset: int = Query(0, ge=0),
+    level: int = 0,
+):
+    # Patches of a region by decreasing coverage, from the brain's inverted index
+    try:
+        region_index = await run_in_threadpool(get_region_patch_index, brain_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Region index not found")
+    patches, coverage = await run_in_threadpool(
+        region_patch_records,
+        region_index,
+        region_id,
+        brain_id,
+        level=level,
+        min_coverage=min_coverage,
+        section_min=section_min,
+        section_max=section_max,
+        limit=limit,
+        offset=offset,
+    )
+    next_offset = offset + limit if len(patches) == limit else None
+    return {"patches": patches, "coverage": coverage, "next_offset": next_offset}
 
 
 @app.post("/get_patches/")
-async def get_patches(patch_records: PostPatchRecordsSchema):
-    data = process_patches(patch_records.patches)
-    return Response(data, media_type="application/octet-stream")
+async def get_patches(
+    patch_records: PostPatchRecordsSchema,
+    client: Annotated[Client, Depends(get_client)],
+    stream: bool = False,
+    window: int = STREAM_WINDOW,
+    masks: bool = False,
+    cache: bool = False,
+    accept_encoding: Annotated[Optional[str], Header()] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    # With masks, the label mask of patch key is sent as key_mask next to its image.
+    # Tensor buffers are written to the response as they are, compressed only
+    # with a codec the client asks for in Accept-Encoding (zstd or lz4)
+    codec = negotiate_codec(accept_encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if codec is not None:
+        headers["Content-Encoding"] = codec
+    if stream:
+        # Each record is a u64 little-endian length followed by a safetensors blob,
+        # named by position as in buffered responses (see serialization).
+        # Records come in completion order, so streams are never cached
+        headers["X-Patch-Framing"] = "length-prefixed-safetensors"
+        return BufferStreamingResponse(
+            aencode_groups(
+                stream_patches(client, patch_records.patches, window=window, masks=masks), codec
+            ),
+            media_type="application/octet-stream",
+            headers=headers,
+        )
+    # With cache, identical batches (e.g. fixed validation sets) are served from
+    # the response cache. The ETag names the payload as sent, so a hit and a
+    # miss of the same request carry the same ETag. A client holding that
+    # payload sends its ETag in If-None-Match and gets 412 without a body:
+    # this is a POST, so the failed condition is answered with 412, not 304
+    key = background = None
+    if cache or if_none_match is not None:
+        key = await run_in_threadpool(response_key, patch_records.patches, masks)
+        headers["ETag"] = etag(key, codec)
+        if etag_matches(if_none_match, headers["ETag"]):
+            return Response(
+                status_code=412, headers={"ETag": headers["ETag"], "Vary": headers["Vary"]}
+            )
+    if cache:
+        response_cache = await run_in_threadpool(get_response_cache)
+        cached = await run_in_threadpool(response_cache.get, key)
+        if cached is not None:
+            headers["X-Response-Cache"] = "hit"
+            if codec is None:
+                # Payloads are cached uncompressed, so these hits are sent without copies
+                return CachedPayloadResponse(cached, headers=headers)
+            with cached:
+                payload = await run_in_threadpool(cached.read)
+            return BufferStreamingResponse(
+                encode_groups([[payload]], codec),
+                media_type="application/octet-stream",
+                headers=headers,
+            )
+    tensors = await process_patches(client, patch_records.patches, masks=masks)
+    parts = safetensors_parts(tensors)
+    if codec is None:
+        headers["Content-Length"] = str(sum(memoryview(part).nbytes for part in parts))
+    if cache:
+        headers["X-Response-Cache"] = "miss"
+        # Written after the response is sent, from the same buffers
+        background = BackgroundTask(response_cache.put, key, parts)
+    # Sync iterators are consumed in the threadpool, compression never blocks the event loop
+    return BufferStreamingResponse(
+        encode_groups([parts], codec),
+        media_type="application/octet-stream",
+        headers=headers,
+        background=background,
+    )
     
 
 
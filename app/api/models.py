@@ -8,6 +8,8 @@ class PostPatchRecordSchema(BaseModel):
     x: int
     y: int
     store_path: str
+    # 2**level downsampled patch of the same footprint, 0 is full resolution
+    level: int = 0
 
 
 class LabelSchema(BaseModel):
@@ -16,4 +18,11 @@ class LabelSchema(BaseModel):
     polygon: List[List[List[int]]] | List[List[List[List[int]]]]
 
 class PostPatchRecordsSchema(BaseModel):
-    patches: Dict[str,PostPatchRecordSchema]
\ No newline at end of file
+    patches: Dict[str,PostPatchRecordSchema]
+
+
+class RegionPatchesSchema(BaseModel):
+    # patches can be posted to /get_patches/ as is
+    patches: Dict[str,PostPatchRecordSchema]
+    coverage: Dict[str,float]
+    next_offset: Optional[int] = None
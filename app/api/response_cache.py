@@ -0,0 +1,235 @@
+"""
+Opt-in disk cache of /get_patches/ responses. Entries are the safetensors
+payloads of whole batches, keyed on the patch records and the modification
+stamps of the stores they are read from, so a store rewrite (a new pyramid
+level or label mask) never serves stale patches.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import anyio
+from starlette.responses import Response
+
+from ...lib.chunk_cache import store_stamp
+from ...lib.pyramid import level_store_path
+from ...lib.raster import label_store_path
+
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "/storage/BrainSAM/data/response_cache")
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", 64 << 30))
+# Internal nginx location serving RESPONSE_CACHE_DIR, hits are then sent with X-Accel-Redirect
+RESPONSE_CACHE_ACCEL_PREFIX = os.environ.get("RESPONSE_CACHE_ACCEL_PREFIX")
+
+# Bump when the payload layout changes
+RESPONSE_CACHE_VERSION = 1
+
+SUFFIX = ".safetensors"
+
+
+def response_key(patch_records, masks=False):
+    """
+    sha256 of the records in request order, the masks flag and the stamps of
+    the stores read. Patch ids are left out, tensors are named by position.
+    """
+    records = [patch_records[idx].model_dump() for idx in patch_records]
+    stores = {level_store_path(r["store_path"], r["level"]) for r in records}
+    if masks:
+        stores |= {label_store_path(r["store_path"]) for r in records}
+    payload = {
+        "version": RESPONSE_CACHE_VERSION,
+        "records": records,
+        "masks": masks,
+        "stores": [[path, store_stamp(path)] for path in sorted(stores)],
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+def etag(key, codec=None):
+    """ETag of the payload of key as sent, compressed with codec or not"""
+    return f'"{key}-{codec}"' if codec else f'"{key}"'
+
+
+def etag_matches(if_none_match, tag):
+    """Whether an If-None-Match header lists tag, weak tags and * included"""
+    if if_none_match is None:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
+
+
+class ResponseCache(object):
+    """
+    Size-capped LRU of response payloads on local disk.
+
+    Files are written atomically and recency is kept in their mtime, so the
+    index is rebuilt from the directory on start and survives restarts. API
+    processes sharing the directory each evict from their own view of it.
+
+    Parameters
+    ---
+    - root: str, cache directory
+    - max_bytes: int, size cap of the payloads
+    """
+
+    def __init__(self, root=RESPONSE_CACHE_DIR, max_bytes=RESPONSE_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self.load_index()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}{SUFFIX}")
+
+    def load_index(self):
+        files = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".tmp"):
+                # Left behind by an interrupted write
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith(SUFFIX):
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, entry.name[: -len(SUFFIX)], stat.st_size))
+        with self.lock:
+            for _, key, size in sorted(files):
+                self.entries[key] = size
+                self.nbytes += size
+            self.evict()
+
+    def get(self, key):
+        """
+        Cached payload opened for reading, or None. Holding the file open
+        keeps it readable even if it is evicted while being sent.
+        """
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            with self.lock:
+                self.misses += 1
+                if key in self.entries:
+                    self.nbytes -= self.entries.pop(key)
+            return None
+        size = os.fstat(f.fileno()).st_size
+        try:
+            # Mark as recently used for the next index rebuild
+            os.utime(f.fileno())
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+            if key not in self.entries:
+                self.entries[key] = size
+                self.nbytes += size
+            self.entries.move_to_end(key)
+        return f
+
+    def put(self, key, parts):
+        """Write a payload from its buffers, then evict down to the size cap"""
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                for part in parts:
+                    size += f.write(part)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)
+            self.entries[key] = size
+            self.nbytes += size
+            self.evict()
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class CachedPayloadResponse(Response):
+    """
+    Response of a payload file opened by ResponseCache.get, closed once sent.
+    Servers offering the ASGI zero-copy send extension get the file to
+    sendfile() from. Behind nginx (RESPONSE_CACHE_ACCEL_PREFIX) the body is
+    left to X-Accel-Redirect. Otherwise the file is streamed in large reads.
+    """
+
+    media_type = "application/octet-stream"
+    chunk_size = 1 << 20
+
+    def __init__(self, file, headers=None):
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+        self.status_code = 200
+        self.background = None
+        self.init_headers(headers)
+        if RESPONSE_CACHE_ACCEL_PREFIX:
+            self.headers["X-Accel-Redirect"] = (
+                f"{RESPONSE_CACHE_ACCEL_PREFIX.rstrip('/')}/{os.path.basename(file.name)}"
+            )
+            self.headers["content-length"] = "0"
+        else:
+            self.headers["content-length"] = str(self.size)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send(
+                {"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers}
+            )
+            if RESPONSE_CACHE_ACCEL_PREFIX or scope["method"].upper() == "HEAD":
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            elif "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": self.file,
+                        "count": self.size,
+                        "more_body": False,
+                    }
+                )
+            else:
+                more_body = True
+                while more_body:
+                    chunk = await anyio.to_thread.run_sync(self.file.read, self.chunk_size)
+                    more_body = len(chunk) == self.chunk_size
+                    await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+        finally:
+            self.file.close()
@@ -0,0 +1,51 @@
+"""
+Locality-aware placement of patch reads on the Dask cluster. Patches are
+grouped by store, level and chunk neighbourhood, and every neighbourhood is
+always sent to the same worker, so that worker's store handles and chunk cache
+stay hot for it across requests.
+"""
+import zlib
+
+# Side of the square neighbourhoods patches are grouped by, in pixels of their level
+LOCALITY_TILE = 4096
+
+
+def locality_key(record):
+    """(store_path, level, tile row, tile col) of the neighbourhood holding the patch origin"""
+    return (
+        record.store_path,
+        record.level,
+        (record.y >> record.level) // LOCALITY_TILE,
+        (record.x >> record.level) // LOCALITY_TILE,
+    )
+
+
+def group_records(patch_records):
+    """Keys of patch_records grouped by locality_key, in request order"""
+    groups = {}
+    for idx in patch_records:
+        groups.setdefault(locality_key(patch_records[idx]), []).append(idx)
+    return groups
+
+
+async def cluster_workers(client):
+    """Sorted addresses of the workers currently connected to the scheduler"""
+    # The asynchronous client's scheduler_info() is a snapshot refreshed every few
+    # seconds, empty right after connecting, so ask the scheduler
+    return sorted(await client.nthreads())
+
+
+def preferred_worker(key, workers):
+    """
+    Rendezvous hash of a locality key over the workers. Only the keys of a
+    worker that joins or leaves move, every other neighbourhood keeps its worker.
+    """
+    return max(workers, key=lambda worker: zlib.crc32(f"{key}|{worker}".encode()))
+
+
+def placement(key, workers):
+    """client.submit restrictions pinning a locality key to its worker"""
+    if not workers:
+        return {}
+    # Loose, so the task still runs if the worker left the cluster
+    return {"workers": [preferred_worker(key, workers)], "allow_other_workers": True}
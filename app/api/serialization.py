@@ -0,0 +1,204 @@
+"""
+Zero-copy safetensors serialization of patch tensors for the API responses,
+with optional lz4/zstd compression negotiated through Accept-Encoding.
+
+Tensors are named by the position of their patch in the request's patches,
+"0", "1", ..., and the label mask of patch n is "n_mask". Buffered responses
+hold all of them in one safetensors file. Streamed responses hold one
+length-prefixed safetensors record per patch, in completion order, under the
+same names, so both modes decode the same way.
+"""
+import json
+import struct
+
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from starlette.responses import StreamingResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+ZSTD_LEVEL = 3
+
+# Offered in this order of preference, when installed
+CODECS = [name for name, module in (("zstd", zstandard), ("lz4", lz4_frame)) if module is not None]
+
+# safetensors dtype names
+DTYPES = {
+    np.dtype(np.bool_): "BOOL",
+    np.dtype(np.uint8): "U8",
+    np.dtype(np.int8): "I8",
+    np.dtype(np.uint16): "U16",
+    np.dtype(np.int16): "I16",
+    np.dtype(np.int32): "I32",
+    np.dtype(np.int64): "I64",
+    np.dtype(np.float16): "F16",
+    np.dtype(np.float32): "F32",
+    np.dtype(np.float64): "F64",
+}
+
+
+def as_array(tensor):
+    """NumPy array sharing the memory of a tensor, copied only if not contiguous"""
+    if not isinstance(tensor, np.ndarray):
+        tensor = tensor.numpy()
+    return np.ascontiguousarray(tensor)
+
+
+def safetensors_parts(tensors):
+    """
+    Buffers of a safetensors file holding `tensors` (name -> tensor): the
+    header length and JSON header, then a memoryview of the data of every
+    tensor. Written one after another they form the file, nothing is copied.
+    """
+    arrays = {name: as_array(tensor) for name, tensor in tensors.items()}
+    header, offset = {}, 0
+    for name, array in arrays.items():
+        header[name] = {
+            "dtype": DTYPES[array.dtype],
+            "shape": list(array.shape),
+            "data_offsets": [offset, offset + array.nbytes],
+        }
+        offset += array.nbytes
+    raw = json.dumps(header, separators=(",", ":")).encode()
+    # Pad the header with spaces so the data starts 8-byte aligned
+    raw += b" " * (-len(raw) % 8)
+    parts = [struct.pack("<Q", len(raw)) + raw]
+    parts += [memoryview(array.reshape(-1)).cast("B") for array in arrays.values()]
+    return parts
+
+
+def frame_parts(parts):
+    """Prefix the buffers of one record with their total length as a little-endian u64"""
+    size = sum(memoryview(part).nbytes for part in parts)
+    return [struct.pack("<Q", size)] + parts
+
+
+def negotiate_codec(accept_encoding):
+    """The preferred installed codec listed in the client's Accept-Encoding, or None"""
+    accepted = {
+        token.split(";")[0].strip().lower() for token in (accept_encoding or "").split(",")
+    }
+    for codec in CODECS:
+        if codec in accepted:
+            return codec
+    return None
+
+
+class GroupEncoder(object):
+    """
+    Compress buffers with `codec` as one stream. Every group of buffers is
+    flushed on its own, so a client can decode each record as it arrives.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif codec == "lz4":
+            self.compressor = lz4_frame.LZ4FrameCompressor(auto_flush=True)
+        else:
+            raise ValueError(f"Unknown codec {codec!r}")
+
+    def start(self):
+        return self.compressor.begin() if self.codec == "lz4" else b""
+
+    def group(self, parts):
+        out = [self.compressor.compress(part) for part in parts]
+        if self.codec == "zstd":
+            out.append(self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+        return b"".join(out)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def encode_groups(groups, codec=None):
+    """Response chunks of groups of buffers, the buffers themselves without a codec"""
+    if codec is None:
+        for parts in groups:
+            yield from parts
+        return
+    encoder = GroupEncoder(codec)
+    yield encoder.start()
+    for parts in groups:
+        yield encoder.group(parts)
+    yield encoder.finish()
+
+
+async def aencode_groups(groups, codec=None):
+    """encode_groups over an async iterator of groups, compressing in the threadpool"""
+    if codec is None:
+        async for parts in groups:
+            for part in parts:
+                yield part
+        return
+    encoder = GroupEncoder(codec)
+    yield encoder.start()
+    async for parts in groups:
+        yield await run_in_threadpool(encoder.group, parts)
+    yield encoder.finish()
+
+
+class BufferStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that hands bytes-like chunks (memoryviews of tensor
+    data) to the server as they are, where starlette would encode anything
+    that is not bytes as text. uvicorn writes any buffer to the transport.
+    """
+
+    async def stream_response(self, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        async for chunk in self.body_iterator:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(self.charset)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class GZipExceptOctetStreamMiddleware(object):
+    """
+    GZipMiddleware that leaves application/octet-stream responses alone.
+    Patch tensors are dense image data (or already compressed with a
+    negotiated codec), so gzip only costs CPU on them.
+    """
+
+    def __init__(self, app, minimum_size=500, compresslevel=9):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get("Accept-Encoding", ""):
+            await self.app(scope, receive, send)
+            return
+        responder = GZipResponder(self.app, self.minimum_size, self.compresslevel)
+        responder.send = send
+        passthrough = False
+
+        async def send_selective(message):
+            nonlocal passthrough
+            if message["type"] == "http.response.start":
+                content_type = Headers(raw=message["headers"]).get("content-type", "")
+                passthrough = content_type.startswith("application/octet-stream")
+            if passthrough:
+                await send(message)
+            else:
+                await responder.send_with_gzip(message)
+
+        await self.app(scope, receive, send_selective)
@@ -0,0 +1,95 @@
+"""
+Load test of the per-request setup cost of the API dependencies. Each simulated
+request submits one small task to the cluster and, with --db, runs SELECT 1.
+The shared mode reuses the client/engine from app.api.dependencies; the
+per-request mode creates and tears them down on every request as the API used
+to.
+
+    python -m benchmarks.api_load --requests 200 --concurrency 16 [--db]
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+from dask.distributed import LocalCluster
+from sqlalchemy import text
+
+from app.api import dependencies
+
+
+def task(x):
+    return x + 1
+
+
+async def per_request(i, use_db):
+    client = await dependencies.connect_dask_client()
+    try:
+        await client.submit(task, i, pure=False)
+    finally:
+        await client.close()
+    if use_db:
+        engine = dependencies.register_async_engine()
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        finally:
+            await engine.dispose()
+
+
+async def shared(i, use_db):
+    client = await dependencies.get_dask_client()
+    await client.submit(task, i, pure=False)
+    if use_db:
+        async with dependencies.session_scope() as session:
+            await session.execute(text("SELECT 1"))
+
+
+async def load(request, n_requests, concurrency, use_db):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await request(i, use_db)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n_requests)))
+    return np.array(latencies) * 1000, time.perf_counter() - start
+
+
+def report(name, latencies, elapsed):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(
+        f"{name:<12} p50 {p50:8.1f}ms  p95 {p95:8.1f}ms  p99 {p99:8.1f}ms"
+        f"  {len(latencies) / elapsed:8.1f} req/s"
+    )
+
+
+async def main(args):
+    report("per-request", *await load(per_request, args.requests, args.concurrency, args.db))
+    if args.db:
+        dependencies.get_engine()
+    await dependencies.get_dask_client()
+    try:
+        report("shared", *await load(shared, args.requests, args.concurrency, args.db))
+    finally:
+        await dependencies.close_shared_resources()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--db", action="store_true", help="also query the metadata DB")
+    args = parser.parse_args()
+    cluster = LocalCluster(
+        n_workers=args.workers, threads_per_worker=1, scheduler_port=8786, dashboard_address=None
+    )
+    try:
+        asyncio.run(main(args))
+    finally:
+        cluster.close()
@@ -0,0 +1,96 @@
+"""
+Compare the row-wise and bulk labeling engines of PatchDB.populate_db on a
+synthetic section. Every tile gets a second, overlapping polygon of its
+region (unless --no_overlap) and with --regions tiles share region ids, so
+regions are made of several polygons. Both engines give such a region the
+coverage of the union of its polygons, and are checked against each other
+and against a per-patch reference.
+
+    python -m benchmarks.label_engine --height 32768 --width 49152 --stride 512
+    python -m benchmarks.label_engine --regions 16
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+from lib.patch_db import PatchDB
+from .synthetic import synthetic_section
+
+
+def run(engine, patch_size, stride):
+    pdb = PatchDB(0, 0, patch_size, stride)
+    start = time.perf_counter()
+    pdb.populate_db(engine=engine)
+    return pdb, time.perf_counter() - start
+
+
+def union_coverage(pdb):
+    """Coverage of every region from the union of its polygons, one patch at a time"""
+    tree = shapely.STRtree(pdb.region_polygons)
+    column = {c: i for i, c in enumerate(pdb.label_columns)}
+    rows, cols, data = [], [], []
+    for idx in np.flatnonzero(~pdb.patches.is_bg).tolist():
+        patch_poly = pdb.patch_polygons[idx]
+        pieces = {}
+        for r in tree.query(patch_poly).tolist():
+            piece = shapely.transform(pdb.region_polygons[r].intersection(patch_poly), np.round)
+            pieces.setdefault(str(pdb.tree_region_ids[r]), []).append(piece)
+        for region_id, region_pieces in pieces.items():
+            ratio = shapely.union_all(region_pieces).area / patch_poly.area
+            if ratio > 0:
+                rows.append(idx)
+                cols.append(column[region_id])
+                data.append(ratio)
+    return sp.csr_matrix((data, (rows, cols)), shape=pdb.labels.shape)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=16384)
+    parser.add_argument("--width", type=int, default=24576)
+    parser.add_argument("--tile", type=int, default=2048)
+    parser.add_argument("--patch_size", type=int, default=1024)
+    parser.add_argument("--stride", type=int, default=512)
+    parser.add_argument("--regions", type=int, help="distinct region ids, tiles share them")
+    parser.add_argument(
+        "--no_overlap", dest="overlap", action="store_false", help="one polygon per tile"
+    )
+    args = parser.parse_args()
+
+    region_ids = None if args.regions is None else np.arange(1, args.regions + 1)
+    with tempfile.TemporaryDirectory() as root:
+        with synthetic_section(
+            root,
+            args.height,
+            args.width,
+            tile=args.tile,
+            region_ids=region_ids,
+            overlap=args.overlap,
+        ):
+            rowwise, t_rowwise = run("rowwise", args.patch_size, args.stride)
+            bulk, t_bulk = run("bulk", args.patch_size, args.stride)
+            reference = union_coverage(bulk)
+
+    assert rowwise.label_columns == bulk.label_columns
+    rowwise_err = abs(rowwise.labels - bulk.labels).max()
+    reference_err = abs(reference - bulk.labels).max()
+    same_areas = all(
+        p.region_areas.keys() == q.region_areas.keys()
+        for p, q in zip(rowwise.patches, bulk.patches)
+    )
+    n_regions = len(set(str(r) for r in bulk.tree_region_ids))
+    print(f"patches: {len(bulk.patches)}  polygons: {len(bulk.region_polygons)}"
+          f"  regions: {n_regions}")
+    print(f"rowwise: {t_rowwise:.2f}s")
+    print(f"bulk:    {t_bulk:.2f}s  ({t_rowwise / t_bulk:.1f}x)")
+    print(f"max coverage difference  rowwise: {rowwise_err:.2e}"
+          f"  union reference: {reference_err:.2e}  same labels: {same_areas}"
+          f"  {'ok' if max(rowwise_err, reference_err) < 1e-9 and same_areas else 'MISMATCH'}")
+
+
+if __name__ == "__main__":
+    main()
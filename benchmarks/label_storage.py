@@ -0,0 +1,57 @@
+"""
+Memory and qc time of the sparse label matrix against the wide frame with one
+float column per nomenclature region, for one synthetic section.
+
+    python -m benchmarks.label_storage --height 32768 --width 49152 --stride 256
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from lib.patch_db import PatchDB
+from .synthetic import synthetic_section
+
+
+def timed(fn, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=16384)
+    parser.add_argument("--width", type=int, default=24576)
+    parser.add_argument("--patch_size", type=int, default=1024)
+    parser.add_argument("--stride", type=int, default=256)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        with synthetic_section(root, args.height, args.width):
+            pdb = PatchDB(0, 0, args.patch_size, args.stride)
+            pdb.populate_db()
+
+    labels = pdb.labels
+    t_dense_build = timed(pdb.dense_db, repeat=1)
+    dense = pdb.dense_db()
+    dense_bytes = dense.memory_usage(deep=True).sum()
+    sparse_bytes = (
+        pdb.patch_db.memory_usage(deep=True).sum()
+        + labels.data.nbytes
+        + labels.indices.nbytes
+        + labels.indptr.nbytes
+    )
+    t_dense_sum = timed(lambda: dense[pdb.label_columns].sum(axis=1))
+    t_sparse_sum = timed(lambda: np.asarray(labels.sum(axis=1)).ravel())
+
+    print(f"patches: {labels.shape[0]}  label columns: {labels.shape[1]}  non-zeros: {labels.nnz}")
+    print(f"memory  dense: {dense_bytes / 2**20:8.2f} MiB  sparse: {sparse_bytes / 2**20:8.2f} MiB")
+    print(f"qc sums dense: {t_dense_sum * 1000:8.2f} ms   sparse: {t_sparse_sum * 1000:8.2f} ms")
+    print(f"dense export: {t_dense_build * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
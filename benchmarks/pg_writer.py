@@ -0,0 +1,141 @@
+"""
+Write time of the metadata of synthetic sections to Postgres with
+lib.metadata_writer (COPY into staging tables and one merge per table)
+against row-by-row SQLAlchemy ORM merges with a commit per section. The
+bulk write is then rerun unchanged, to time the idempotent path.
+
+Needs an empty database, its patches and patch_labels tables are dropped.
+
+    python -m benchmarks.pg_writer --dsn postgresql://postgres@localhost:5432/bench --sections 8
+"""
+import argparse
+import asyncio
+import copy
+import json
+import tempfile
+import time
+
+import asyncpg
+from sqlalchemy import Boolean, Column, Float, Integer, String, Text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import declarative_base
+
+from lib.metadata_writer import PatchMetadataWriter, label_rows, patch_rows
+from lib.patch_db import PatchDB
+from .synthetic import synthetic_section
+
+Base = declarative_base()
+
+
+class PatchRow(Base):
+    __tablename__ = "patches"
+    id = Column(Text, primary_key=True)
+    brain_id = Column(Integer)
+    section_id = Column(Integer)
+    min_x = Column(Integer)
+    min_y = Column(Integer)
+    patch_size = Column(Integer)
+    store_path = Column(Text)
+    is_bg = Column(Boolean)
+    check_bg = Column(Boolean)
+    no_geojson = Column(Boolean)
+
+
+class PatchLabelRow(Base):
+    __tablename__ = "patch_labels"
+    patch_id = Column(String, primary_key=True)
+    region_id = Column(Integer, primary_key=True)
+    brain_id = Column(Integer)
+    section_id = Column(Integer)
+    coverage = Column(Float)
+    polygon = Column(JSONB)
+
+
+def section_results(args):
+    with tempfile.TemporaryDirectory() as root:
+        with synthetic_section(root, args.height, args.width):
+            pdb = PatchDB(0, 0, args.patch_size, args.stride)
+            pdb.populate_db()
+            pdb.qc_check()
+    result = pdb.result()
+    results = []
+    for section_id in range(args.sections):
+        section = copy.copy(result)
+        section.section_id = section_id
+        results.append(section)
+    return results
+
+
+async def reset_tables(conn):
+    await conn.execute("DROP TABLE IF EXISTS patches, patch_labels")
+    await PatchMetadataWriter(conn).create_tables()
+
+
+async def count_rows(conn):
+    return (
+        await conn.fetchval("SELECT count(*) FROM patches"),
+        await conn.fetchval("SELECT count(*) FROM patch_labels"),
+    )
+
+
+async def orm_write(dsn, results):
+    engine = create_async_engine(dsn.replace("postgresql://", "postgresql+asyncpg://", 1))
+    try:
+        async with AsyncSession(engine) as session:
+            for result in results:
+                for row in patch_rows(result):
+                    await session.merge(PatchRow(**dict(zip(PatchRow.__table__.columns.keys(), row))))
+                for row in label_rows(result):
+                    values = dict(zip(PatchLabelRow.__table__.columns.keys(), row))
+                    # The ORM JSONB type serializes itself, label_rows hands out JSON text
+                    values["polygon"] = None if row[-1] is None else json.loads(row[-1])
+                    await session.merge(PatchLabelRow(**values))
+                await session.commit()
+    finally:
+        await engine.dispose()
+
+
+async def timed(label, coro, n_rows, conn):
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    patches, labels = await count_rows(conn)
+    print(
+        f"{label:<14} {elapsed:8.2f}s  {n_rows / elapsed:10.0f} rows/s"
+        f"  patches {patches:8d}  labels {labels:8d}"
+    )
+
+
+async def main(args):
+    results = section_results(args)
+    n_patches = sum(len(r) for r in results)
+    n_labels = sum(1 for r in results for _ in label_rows(r))
+    print(f"sections: {len(results)}  patches: {n_patches}  labels: {n_labels}")
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        writer = PatchMetadataWriter(conn, batch_size=args.batch_size)
+        orm_results = results[: args.orm_sections]
+        orm_rows = sum(len(r) for r in orm_results) + sum(
+            1 for r in orm_results for _ in label_rows(r)
+        )
+        await reset_tables(conn)
+        await timed(f"orm x{len(orm_results)}", orm_write(args.dsn, orm_results), orm_rows, conn)
+        await reset_tables(conn)
+        await timed("copy", writer.write_sections(results), n_patches + n_labels, conn)
+        await timed("copy rerun", writer.write_sections(results), n_patches + n_labels, conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="postgresql://postgres@localhost:5432/bench")
+    parser.add_argument("--height", type=int, default=16384)
+    parser.add_argument("--width", type=int, default=24576)
+    parser.add_argument("--patch_size", type=int, default=1024)
+    parser.add_argument("--stride", type=int, default=256)
+    parser.add_argument("--sections", type=int, default=8)
+    parser.add_argument("--orm_sections", type=int, default=1, help="sections written through the ORM")
+    parser.add_argument("--batch_size", type=int, default=50000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,72 @@
+"""
+Compare the raster coverage engine with the exact polygon (bulk) engine on a
+synthetic section, and time relabeling other grids from the same raster.
+Every tile gets a second, overlapping polygon of its region unless
+--no_overlap, the overlaps must count once in both engines.
+
+    python -m benchmarks.raster_engine --height 32768 --width 49152 --scale 8
+"""
+import argparse
+import tempfile
+import time
+
+from lib.patch_db import PatchDB
+from .synthetic import synthetic_section
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=16384)
+    parser.add_argument("--width", type=int, default=24576)
+    parser.add_argument("--tile", type=int, default=2048)
+    parser.add_argument("--patch_size", type=int, default=1024)
+    parser.add_argument("--stride", type=int, default=512)
+    parser.add_argument("--scale", type=int, default=8)
+    parser.add_argument(
+        "--no_overlap", dest="overlap", action="store_false", help="one polygon per tile"
+    )
+    args = parser.parse_args()
+    tolerance = args.scale / args.patch_size
+
+    with tempfile.TemporaryDirectory() as root:
+        with synthetic_section(
+            root, args.height, args.width, tile=args.tile, overlap=args.overlap
+        ):
+            bulk = PatchDB(0, 0, args.patch_size, args.stride)
+            start = time.perf_counter()
+            bulk.populate_db(engine="bulk")
+            t_bulk = time.perf_counter() - start
+
+            raster = PatchDB(0, 0, args.patch_size, args.stride)
+            start = time.perf_counter()
+            raster.populate_db(engine="raster", raster_scale=args.scale)
+            t_raster = time.perf_counter() - start
+
+            # Other grids reuse the section raster, only the reduction is redone
+            section_raster, _ = raster.section_raster(args.scale)
+            regrid = []
+            for patch_size, stride in [(1024, 256), (512, 256), (2048, 1024)]:
+                other = PatchDB(0, 0, patch_size, stride)
+                start = time.perf_counter()
+                section_raster.coverage(
+                    other.patches.min_x, other.patches.min_y, patch_size, stride
+                )
+                regrid.append((patch_size, stride, time.perf_counter() - start))
+
+    assert bulk.label_columns == raster.label_columns
+    diff = abs(bulk.labels - raster.labels)
+    max_err = diff.max()
+    print(f"patches: {len(bulk.patches)}  regions: {len(bulk.region_polygons)}")
+    print(f"bulk:   {t_bulk:.2f}s")
+    print(f"raster: {t_raster:.2f}s  ({t_bulk / t_raster:.1f}x, scale {args.scale})")
+    print(
+        f"max coverage difference: {max_err:.4f}  tolerance: {tolerance:.4f}  "
+        f"{'ok' if max_err <= tolerance else 'EXCEEDED'}"
+    )
+    print(f"mean difference per label: {diff.sum() / max(bulk.labels.nnz, 1):.5f}")
+    for patch_size, stride, t in regrid:
+        print(f"regrid {patch_size}/{stride}: {t * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
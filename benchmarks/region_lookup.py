@@ -0,0 +1,63 @@
+"""
+Tree index -> region id lookups in PolygonGraph edge construction: the boolean
+scan over geodf against the precomputed tree_region_ids array.
+
+    python -m benchmarks.region_lookup --height 65536 --width 65536 --tile 1024
+"""
+import argparse
+import os
+import tempfile
+import time
+from functools import partial
+
+import networkx as nx
+
+from lib.polygon_graph import PolygonGraph
+from .synthetic import make_geojson
+
+
+def scan_lookup(geodf, tree_idx):
+    return geodf.loc[geodf["tree_idx"] == tree_idx, "region_id"].values[0]
+
+
+def build_edges(pg, region_id_mapper):
+    G = nx.Graph()
+    add_edges = partial(
+        PolygonGraph.add_edges_based_on_proximity,
+        G=G,
+        tree=pg.geo_tree,
+        region_id_mapper=region_id_mapper,
+    )
+    start = time.perf_counter()
+    pg.geodf.apply(add_edges, axis=1)
+    return G, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=32768)
+    parser.add_argument("--width", type=int, default=32768)
+    parser.add_argument("--tile", type=int, default=512)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        path = make_geojson(
+            os.path.join(root, "section.geojson"), args.height, args.width, tile=args.tile
+        )
+        start = time.perf_counter()
+        pg = PolygonGraph(path)
+        t_graph = time.perf_counter() - start
+
+    G_scan, t_scan = build_edges(pg, partial(scan_lookup, pg.geodf))
+    G_array, t_array = build_edges(
+        pg, partial(PolygonGraph._tree_idx_to_region_id, pg.tree_region_ids)
+    )
+    assert nx.utils.graphs_equal(G_scan, G_array)
+    print(f"polygons: {len(pg.geodf)}  edges: {G_array.number_of_edges()}")
+    print(f"PolygonGraph: {t_graph:.2f}s")
+    print(f"edges with scan lookup:  {t_scan:.2f}s")
+    print(f"edges with array lookup: {t_array:.2f}s  ({t_scan / t_array:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
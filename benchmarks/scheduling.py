@@ -0,0 +1,178 @@
+"""
+Throughput of the patch read scheduling of /get_patches/ on a LocalCluster.
+Requests are blocks of overlapping patches around a few hotspots of a
+synthetic section, revisited over the run as training epochs revisit their
+regions of interest, and are submitted as
+
+- per-patch: one unrestricted task per patch opening the store and slicing
+  it, as /get_patches/ first did
+- per-section: one task per store through the cached batch reader
+- locality: one task per chunk neighbourhood, pinned to its worker with
+  app.api.scheduling, through the cached batch reader and kept store handles
+
+Workers read with numpy only (no torch), the serialization is left out.
+
+    python -m benchmarks.scheduling --workers 8 --requests 64 --patches 64
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from functools import lru_cache
+
+import numpy as np
+import zarr as za
+from dask.distributed import Client, LocalCluster
+
+from app.api.models import PostPatchRecordSchema
+from app.api.scheduling import cluster_workers, group_records, placement
+from lib.chunk_cache import chunk_cache_stats, get_chunk_cache
+from lib.patch import Patch, PatchBatchReader
+from .synthetic import make_store
+
+
+def read_patch(record):
+    store = za.open(record.store_path, mode="r")
+    return Patch(record.x, record.y, record.brain_id, record.section_id, store=store).array()
+
+
+@lru_cache(maxsize=256)
+def open_store(path):
+    return za.open(path, mode="r")
+
+
+def read_group(records, keep_handles=False):
+    path = records[0].store_path
+    store = open_store(path) if keep_handles else za.open(path, mode="r")
+    batch = [Patch(r.x, r.y, r.brain_id, r.section_id, store=store) for r in records]
+    reader = PatchBatchReader(cache=get_chunk_cache())
+    return [np.ascontiguousarray(view) for view in reader.read(batch)]
+
+
+def clear_cache():
+    get_chunk_cache().clear()
+
+
+def make_requests(store_path, h, w, n_requests, n_patches, stride, n_hotspots, seed=0):
+    """Every request is a block of stride-aligned patches jittered around a hotspot"""
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_patches)))
+    cells_y, cells_x = (h - 1024) // stride - side, (w - 1024) // stride - side
+    hotspots = rng.integers(0, (cells_y, cells_x), size=(n_hotspots, 2))
+    requests = []
+    for _ in range(n_requests):
+        cy, cx = hotspots[rng.integers(n_hotspots)] + rng.integers(-side, side + 1, size=2)
+        y0 = int(np.clip(cy, 0, cells_y)) * stride
+        x0 = int(np.clip(cx, 0, cells_x)) * stride
+        records = {}
+        for n in range(n_patches):
+            dy, dx = divmod(n, side)
+            x, y = x0 + dx * stride, y0 + dy * stride
+            records[f"0_0_{x}_{y}"] = PostPatchRecordSchema(
+                brain_id=0, section_id=0, x=x, y=y, store_path=store_path
+            )
+        requests.append(records)
+    return requests
+
+
+async def per_patch(client, records):
+    futures = [client.submit(read_patch, records[idx], pure=False) for idx in records]
+    return await client.gather(futures)
+
+
+async def per_section(client, records):
+    futures = [client.submit(read_group, list(records.values()), pure=False)]
+    return await client.gather(futures)
+
+
+async def locality(client, records):
+    workers = await cluster_workers(client)
+    groups = group_records(records)
+    futures = [
+        client.submit(
+            read_group,
+            [records[idx] for idx in group_idx],
+            keep_handles=True,
+            pure=False,
+            **placement(key, workers),
+        )
+        for key, group_idx in groups.items()
+    ]
+    return await client.gather(futures)
+
+
+def patch_chunks(requests, chunk=1024):
+    """Chunks decoded when every patch is read on its own, without a cache"""
+    return sum(
+        (-(-(r.y + 1024) // chunk) - r.y // chunk) * (-(-(r.x + 1024) // chunk) - r.x // chunk)
+        for records in requests
+        for r in records.values()
+    )
+
+
+async def cache_counters(client):
+    stats = await client.run(chunk_cache_stats)
+    return sum(s["misses"] for s in stats.values()), sum(s["hits"] for s in stats.values())
+
+
+async def run(client, mode, requests, concurrency):
+    await client.run(clear_cache)
+    misses0, hits0 = await cache_counters(client)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(records):
+        async with semaphore:
+            await mode(client, records)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(records) for records in requests))
+    elapsed = time.perf_counter() - start
+    misses, hits = await cache_counters(client)
+    misses, hits = misses - misses0, hits - hits0
+    if mode is per_patch:
+        misses = patch_chunks(requests)
+    n_patches = sum(len(records) for records in requests)
+    print(
+        f"{mode.__name__:<12} {n_patches / elapsed:8.1f} patches/s  {elapsed:7.2f}s"
+        f"  chunk decodes {misses:6d}  cache hits {hits:6d}"
+    )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as root:
+        store_path = f"{root}/section.zarr"
+        make_store(store_path, args.height, args.width, fill=True)
+        requests = make_requests(
+            store_path,
+            args.height,
+            args.width,
+            args.requests,
+            args.patches,
+            args.stride,
+            args.hotspots,
+        )
+        cluster = await LocalCluster(
+            n_workers=args.workers, threads_per_worker=1, processes=True, asynchronous=True
+        )
+        client = await Client(cluster, asynchronous=True)
+        try:
+            # Warm the worker imports so the first mode is not charged for them
+            await client.gather([client.submit(clear_cache, pure=False) for _ in range(args.workers)])
+            for mode in (per_patch, per_section, locality):
+                await run(client, mode, requests, args.concurrency)
+        finally:
+            await client.close()
+            await cluster.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=16384)
+    parser.add_argument("--width", type=int, default=16384)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--patches", type=int, default=64)
+    parser.add_argument("--stride", type=int, default=512)
+    parser.add_argument("--hotspots", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
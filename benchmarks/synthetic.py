@@ -0,0 +1,123 @@
+"""
+Synthetic sections for the benchmarks. A section is a zarr store of the
+requested shape and a geojson of jittered, slightly overlapping region tiles
+laid out in the same coordinate frame as the annotation geojsons.
+"""
+from contextlib import contextmanager
+from functools import partial
+import json
+import os
+
+import numpy as np
+import zarr as za
+
+from lib import patch_db as patch_db_module
+from lib.path_config import PathConfig
+from lib.pyramid import level_store_path
+from lib.raster import label_store_path
+
+NOMENCLATURE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "lib",
+    "nomenclature.json",
+)
+TYPE_KEY = "type (gray matter/fiber tract/CNS cavity/developmental/other)"
+
+
+def region_feature(corners, region_id):
+    """Geojson feature of a region polygon with image corners (x, y)"""
+    # Annotation geojsons store image rows as negative y
+    ring = [[float(cx), float(-cy)] for cx, cy in corners]
+    ring.append(ring[0])
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [ring]},
+        "properties": {
+            "data": {
+                "id": region_id,
+                "name": f"Region {region_id}",
+                "acronym": f"R{region_id}",
+                TYPE_KEY: "G",
+                "parent_structure_id": 0,
+                "color_hex_triplet": "FFFFFF",
+            }
+        },
+    }
+
+
+def make_geojson(path, h, w, tile=2048, region_ids=None, overlap=False, seed=0):
+    """
+    Write a geojson tiling a h x w section with jittered region polygons. With
+    overlap, every tile gets a second polygon of its region shifted by half a
+    tile, so regions are made of overlapping polygons.
+    """
+    rng = np.random.default_rng(seed)
+    if region_ids is None:
+        region_ids = np.arange(1, 1000)
+    features = []
+    n = 0
+    for y in range(0, h, tile):
+        for x in range(0, w, tile):
+            jitter = rng.uniform(-0.1, 0.1, size=(4, 2)) * tile
+            corners = np.array(
+                [[x, y], [x + tile, y], [x + tile, y + tile], [x, y + tile]],
+                dtype=np.float64,
+            )
+            corners = corners + jitter
+            region_id = int(region_ids[n % len(region_ids)])
+            features.append(region_feature(corners, region_id))
+            if overlap:
+                features.append(region_feature(corners + tile / 2, region_id))
+            n += 1
+    with open(path, "w") as f:
+        json.dump(
+            {"type": "FeatureCollection", "rotation": 0, "features": features}, f
+        )
+    return path
+
+
+def make_store(path, h, w, chunk=1024, fill=False, seed=0):
+    """Create a h x w x 3 uint8 zarr section, optionally filled with noise"""
+    store = za.open(
+        path, mode="w", shape=(h, w, 3), chunks=(chunk, chunk, 3), dtype=np.uint8
+    )
+    if fill:
+        rng = np.random.default_rng(seed)
+        for y in range(0, h, chunk):
+            store[y : y + chunk] = rng.integers(
+                0, 255, size=(min(chunk, h - y), w, 3), dtype=np.uint8
+            )
+    return store
+
+
+@contextmanager
+def synthetic_section(root, h, w, **geojson_kwargs):
+    """
+    Point PathConfig and the nomenclature loader at a synthetic section. Every
+    path a section writes to (pyramid levels, label mask, region index) is
+    kept under root.
+    """
+    gjson_path = make_geojson(os.path.join(root, "section.geojson"), h, w, **geojson_kwargs)
+    store_path = os.path.join(root, "section.zarr")
+    make_store(store_path, h, w)
+    paths = {
+        "gjson_path": lambda self: gjson_path,
+        "zarr_store_path": lambda self: store_path,
+        "pyramid_store_path": lambda self, level: level_store_path(store_path, level),
+        "label_store_path": lambda self: label_store_path(store_path),
+        "region_index_path": lambda self: os.path.join(root, "region_index.npz"),
+        "region_patches_path": lambda self: os.path.join(root, "region_patches.sqlite"),
+    }
+    saved = {name: getattr(PathConfig, name) for name in paths}
+    saved_registry = patch_db_module.get_nomenclature_registry
+    for name, path in paths.items():
+        setattr(PathConfig, name, path)
+    patch_db_module.get_nomenclature_registry = partial(
+        saved_registry, nomenclature_path=NOMENCLATURE_PATH
+    )
+    try:
+        yield gjson_path, store_path
+    finally:
+        for name, path in saved.items():
+            setattr(PathConfig, name, path)
+        patch_db_module.get_nomenclature_registry = saved_registry
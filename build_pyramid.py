@@ -0,0 +1,34 @@
+from lib.path_config import PathConfig
+from lib.pyramid import PyramidBuilder, PYRAMID_LEVELS
+from save_metadata import get_tasks
+from tqdm import tqdm
+import argparse
+
+
+def build_section(brain_id, section_id, levels, workers):
+    try:
+        PyramidBuilder(PathConfig(brain_id, section_id), levels, workers).build()
+        return True
+    except Exception as e:
+        with open('error_log.txt','a') as f:
+            f.write(f'Pyramid:BrainID:{brain_id},SectionID:{section_id},Error:{e}\n')
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--brain_id', type=int)
+    parser.add_argument('--section_id', type=int)
+    parser.add_argument('--levels', type=int, default=PYRAMID_LEVELS)
+    parser.add_argument('--workers', type=int, default=16, help='threads writing chunks of a level')
+    args = parser.parse_args()
+    if args.section_id is not None:
+        task_sections = [(args.brain_id, args.section_id)]
+    else:
+        task_sections = get_tasks(args.brain_id)
+    errors = 0
+    # Finished levels are skipped and unfinished ones resume, so a rerun only does the missing work
+    for brain_id, section_id in tqdm(task_sections):
+        if not build_section(brain_id, section_id, args.levels, args.workers):
+            errors += 1
+    print(f'Errors: {errors}')
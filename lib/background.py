@@ -0,0 +1,75 @@
+import numpy as np
+import zarr as za
+
+from .pyramid import PyramidBuilder, downsample_block
+
+# Downsampling level read for background detection, 2**4 = 16x
+BACKGROUND_LEVEL = 4
+
+
+def build_level(store, level):
+    """
+    Downsample a full resolution section by 2**level in memory, one tile of
+    chunks at a time so only a few chunks of the section are decoded at
+    once. Tiles go through the same cascade of 2x reductions as
+    PyramidBuilder, so the pixels match the level store.
+    """
+    factor = 2**level
+    h, w = store.shape[:2]
+    # Tiles are whole chunks holding whole downsampling blocks
+    th, tw = (int(np.lcm(c, factor)) for c in store.chunks[:2])
+    out = np.zeros((-(-h // factor), -(-w // factor)) + store.shape[2:], dtype=np.uint8)
+    for y in range(0, h, th):
+        for x in range(0, w, tw):
+            block = np.asarray(store[y : y + th, x : x + tw])
+            for _ in range(level):
+                block = downsample_block(block, 2)
+            oy, ox = y // factor, x // factor
+            out[oy : oy + block.shape[0], ox : ox + block.shape[1]] = block
+    return out
+
+
+def open_level(path_config, store, level=BACKGROUND_LEVEL, workers=1):
+    """
+    Read a downsampled level of the section from its pyramid, building the
+    missing or unfinished levels with PyramidBuilder (workers threads, one
+    is enough when sections run in parallel processes). Where the pyramid
+    cannot be written the level is built in memory instead.
+    """
+    try:
+        paths = PyramidBuilder(path_config, level, workers).build()
+        return np.asarray(za.open(paths[-1], mode="r")[:])
+    except OSError:
+        return build_level(store, level)
+
+
+def tissue_mask(thumb, bg_threshold=220):
+    """
+    Tissue pixels of a brightfield thumbnail: darker than the bright slide
+    background and not the zero fill outside the scanned area.
+    """
+    if thumb.ndim == 3:
+        gray = thumb.mean(axis=2)
+        filled = thumb.max(axis=2) > 0
+    else:
+        gray = thumb
+        filled = thumb > 0
+    return (gray < bg_threshold) & filled
+
+
+def tissue_fraction(mask, min_x, min_y, patch_size, factor):
+    """
+    Tissue fraction of every patch from an integral image of the mask.
+    Patch boxes are mapped to the mask resolution and clipped to it; the
+    part of a patch outside the section counts as background.
+    """
+    h, w = mask.shape
+    integral = np.zeros((h + 1, w + 1), dtype=np.int64)
+    integral[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+    x0 = np.clip(min_x // factor, 0, w)
+    y0 = np.clip(min_y // factor, 0, h)
+    x1 = np.clip(-(-(min_x + patch_size) // factor), 0, w)
+    y1 = np.clip(-(-(min_y + patch_size) // factor), 0, h)
+    tissue = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    area = (-(-patch_size // factor)) ** 2
+    return tissue / area
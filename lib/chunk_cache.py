@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import os
+import sys
+import threading
+
+import numpy as np
+import zarr
+
+
+# Process-wide byte budget, one cache per API worker process
+CHUNK_CACHE_BYTES = int(os.environ.get("CHUNK_CACHE_BYTES", 1 << 30))
+
+STORE_METADATA_FILES = (".zarray", ".zattrs", "attributes.json")
+
+
+def store_stamp(path):
+    """
+    Latest mtime (ns) of a store directory and its array metadata, None when
+    missing. Rewriting a store (mode="w") or resuming a pyramid level changes
+    it, so it versions the chunks cached from the store.
+    """
+    stamps = []
+    for p in (path,) + tuple(os.path.join(path, name) for name in STORE_METADATA_FILES):
+        try:
+            stamps.append(os.stat(p).st_mtime_ns)
+        except OSError:
+            pass
+    return max(stamps) if stamps else None
+
+
+class ChunkCache(object):
+    """
+    Thread-safe LRU cache with a byte budget for store chunks.
+
+    Values are either decoded chunks (numpy arrays) or raw chunk bytes. Entries
+    larger than the whole budget are never cached.
+
+    Parameters
+    ---
+    - max_bytes: int, byte budget of the cache
+    """
+
+    def __init__(self, max_bytes=CHUNK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sizeof(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return len(value)
+        return sys.getsizeof(value)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.sizeof(self.entries.pop(key))
+            self.entries[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self.sizeof(evicted)
+                self.evictions += 1
+
+    def invalidate(self, prefix):
+        """Drop every entry whose key starts with `prefix`"""
+        with self.lock:
+            for key in [k for k in self.entries if k[: len(prefix)] == prefix]:
+                self.nbytes -= self.sizeof(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_chunk_cache = None
+
+
+def get_chunk_cache():
+    """Return the process-wide chunk cache"""
+    global _chunk_cache
+    if _chunk_cache is None:
+        _chunk_cache = ChunkCache()
+    return _chunk_cache
+
+
+def chunk_cache_stats():
+    return get_chunk_cache().stats()
+
+
+class CachingStore(MutableMapping):
+    """
+    Storage layer that keeps raw chunk bytes of a zarr/N5 store in a ChunkCache.
+    Metadata keys pass straight through to the wrapped store. Chunks are keyed
+    on the store stamp taken when the store is opened, so a store rewritten by
+    another process is never served from the chunks of its previous version.
+
+    Parameters
+    ---
+    - path: str, path of the zarr/N5 store
+    - cache: ChunkCache, defaults to the process-wide cache
+    """
+
+    metadata_suffixes = (".zarray", ".zgroup", ".zattrs", "attributes.json")
+
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.store = zarr.storage.normalize_store_arg(path, mode="r")
+        self.stamp = store_stamp(path)
+        self.cache = cache if cache is not None else get_chunk_cache()
+
+    def __getitem__(self, key):
+        if key.endswith(self.metadata_suffixes):
+            return self.store[key]
+        value = self.cache.get((self.path, self.stamp, key))
+        if value is None:
+            value = self.store[key]
+            self.cache.put((self.path, self.stamp, key), value)
+        return value
+
+    def __setitem__(self, key, value):
+        self.cache.invalidate((self.path, self.stamp, key))
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        self.cache.invalidate((self.path, self.stamp, key))
+        del self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def listdir(self, path=None):
+        return self.store.listdir(path)
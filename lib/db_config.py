@@ -0,0 +1,28 @@
+"""
+Connection settings of the test_metadata_patch Postgres DB, shared by the API
+engine and the save_metadata writer. The password is never part of the tree.
+"""
+import os
+from urllib.parse import quote
+
+METADATA_PG_HOST = os.environ.get("METADATA_PG_HOST", "qd3.humanbrain.in")
+METADATA_PG_PORT = int(os.environ.get("METADATA_PG_PORT", 15432))
+METADATA_PG_DB = os.environ.get("METADATA_PG_DB", "test_metadata_patch")
+METADATA_PG_USER = os.environ.get("METADATA_PG_USER", "postgres")
+
+
+def metadata_dsn(scheme="postgresql"):
+    """
+    DSN of the metadata DB with the given URL scheme (e.g. postgresql+asyncpg
+    for SQLAlchemy). METADATA_PG_DSN replaces the settings as a whole. The
+    password comes from METADATA_PG_PASSWORD, otherwise the driver falls back
+    to PGPASSWORD or ~/.pgpass.
+    """
+    dsn = os.environ.get("METADATA_PG_DSN")
+    if dsn:
+        return f"{scheme}{dsn[dsn.index('://'):]}"
+    password = os.environ.get("METADATA_PG_PASSWORD")
+    user = quote(METADATA_PG_USER, safe="")
+    if password:
+        user = f"{user}:{quote(password, safe='')}"
+    return f"{scheme}://{user}@{METADATA_PG_HOST}:{METADATA_PG_PORT}/{METADATA_PG_DB}"
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+import numpy as np
+
+from .path_config import PathConfig
+
+
+def region_postings(labels, label_columns):
+    """
+    Inverted view of a sparse label matrix: (region_ids, patch_idx, coverage)
+    of every non-zero entry, sorted by region and by decreasing coverage
+    """
+    coo = labels.tocoo()
+    keep = coo.data > 0
+    region_ids = np.asarray([int(c) for c in label_columns], dtype=np.int64)[coo.col[keep]]
+    patch_idx, coverage = coo.row[keep], coo.data[keep]
+    order = np.lexsort((-coverage, region_ids))
+    return region_ids[order], patch_idx[order], coverage[order]
+
+
+class RegionPatchIndex(object):
+    """
+    Per-brain SQLite inverted index from region id to the patches covering it,
+    ordered by coverage.
+
+    Sections are replaced as a whole, so reprocessing a section never leaves
+    stale postings. Queries walk the (region_id, coverage) index and are
+    paginated with limit/offset. The connection is shared between threads
+    behind a lock. Read-only indexes (for the API) only open an existing
+    file and never write to it.
+
+    Parameters
+    ---
+    - path: str, the SQLite file of the brain
+    - read_only: bool, open an existing index without creating or migrating it
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if read_only:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(path)
+            self.conn = sqlite3.connect(
+                f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True, check_same_thread=False
+            )
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(
+                """
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS postings (
+                    region_id INTEGER, coverage REAL, section_id INTEGER,
+                    min_x INTEGER, min_y INTEGER, patch_size INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS postings_region ON postings (
+                    region_id, coverage DESC, section_id, min_x, min_y, patch_size
+                );
+                CREATE INDEX IF NOT EXISTS postings_section ON postings (section_id);
+                """
+            )
+
+    @classmethod
+    def for_brain(cls, brain_id, read_only=False):
+        return cls(PathConfig(brain_id, None).region_patches_path(), read_only=read_only)
+
+    def add_sections(self, results):
+        """Replace the postings of the sections of the given PatchDBResults"""
+        rows = []
+        for result in results:
+            region_ids, patch_idx, coverage = region_postings(result.labels, result.label_columns)
+            rows.append(
+                (
+                    result.section_id,
+                    zip(
+                        region_ids.tolist(),
+                        coverage.tolist(),
+                        [result.section_id] * len(patch_idx),
+                        result.min_x[patch_idx].tolist(),
+                        result.min_y[patch_idx].tolist(),
+                        [result.patch_size] * len(patch_idx),
+                    ),
+                )
+            )
+        with self.lock, self.conn:
+            for section_id, postings in rows:
+                self.conn.execute("DELETE FROM postings WHERE section_id = ?", (section_id,))
+                self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?)", postings)
+
+    def query(
+        self, region_id, min_coverage=0.0, section_min=None, section_max=None, limit=100, offset=0
+    ):
+        """
+        Patches of region_id with at least min_coverage in the section range
+        [section_min, section_max], by decreasing coverage. Returns a list of
+        (section_id, min_x, min_y, patch_size, coverage).
+        """
+        query = (
+            "SELECT section_id, min_x, min_y, patch_size, coverage FROM postings "
+            "WHERE region_id = ? AND coverage >= ?"
+        )
+        params = [region_id, min_coverage]
+        if section_min is not None:
+            query += " AND section_id >= ?"
+            params.append(section_min)
+        if section_max is not None:
+            query += " AND section_id <= ?"
+            params.append(section_max)
+        query += " ORDER BY coverage DESC, section_id, min_x, min_y LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
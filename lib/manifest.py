@@ -0,0 +1,197 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+import zarr as za
+
+from .nomenclature import NOMENCLATURE_PATH
+from .path_config import PathConfig
+
+# Sources whose changes invalidate previously processed sections
+VERSIONED_SOURCES = [
+    "background.py",
+    "nomenclature.py",
+    "patch.py",
+    "patch_db.py",
+    "polygon_graph.py",
+    "pyramid.py",
+    "raster.py",
+    "region_index.py",
+]
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_version(nomenclature_path=NOMENCLATURE_PATH):
+    """
+    Hash of the labeling code and of the nomenclature PatchDB loads, so a
+    change of either reprocesses every section
+    """
+    digest = hashlib.sha256()
+    lib_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in VERSIONED_SOURCES:
+        with open(os.path.join(lib_dir, name), "rb") as f:
+            digest.update(f.read())
+    digest.update(file_sha256(nomenclature_path).encode())
+    return digest.hexdigest()[:16]
+
+
+@dataclass(frozen=True)
+class SectionKey:
+    """Everything a section's metadata depends on"""
+
+    brain_id: int
+    section_id: int
+    geojson_hash: str
+    zarr_shape: str
+    patch_size: int
+    stride: int
+    code_version: str
+
+    @property
+    def fingerprint(self):
+        return (
+            self.geojson_hash,
+            self.zarr_shape,
+            self.patch_size,
+            self.stride,
+            self.code_version,
+        )
+
+
+class SectionManifest(object):
+    """
+    SQLite manifest of processed sections with a structured failure table.
+
+    A section is complete when its stored fingerprint (geojson hash, zarr
+    shape, patch size, stride and code version) matches the current one.
+    Geojson hashes are cached by (path, mtime, size) to avoid rehashing
+    unchanged files. The connection is shared between threads behind a lock.
+    """
+
+    def __init__(self, path="metadata_manifest.sqlite"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS completed (
+                    brain_id INTEGER, section_id INTEGER, geojson_hash TEXT,
+                    zarr_shape TEXT, patch_size INTEGER, stride INTEGER,
+                    code_version TEXT, completed_at REAL,
+                    PRIMARY KEY (brain_id, section_id)
+                );
+                CREATE TABLE IF NOT EXISTS failures (
+                    brain_id INTEGER, section_id INTEGER, geojson_hash TEXT,
+                    zarr_shape TEXT, patch_size INTEGER, stride INTEGER,
+                    code_version TEXT, stage TEXT, error TEXT,
+                    attempts INTEGER, last_attempt REAL,
+                    PRIMARY KEY (brain_id, section_id)
+                );
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha256 TEXT
+                );
+                """
+            )
+
+    def geojson_hash(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT mtime, size, sha256 FROM file_hashes WHERE path = ?", (path,)
+            ).fetchone()
+        if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return row[2]
+        sha = file_sha256(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                (path, stat.st_mtime, stat.st_size, sha),
+            )
+        return sha
+
+    @staticmethod
+    def zarr_shape(path):
+        try:
+            return "x".join(str(n) for n in za.open(path, mode="r").shape)
+        except Exception:
+            return ""
+
+    def section_key(self, brain_id, section_id, patch_size, stride, version=None):
+        path_config = PathConfig(brain_id, section_id)
+        return SectionKey(
+            brain_id,
+            section_id,
+            self.geojson_hash(path_config.gjson_path()),
+            self.zarr_shape(path_config.zarr_store_path()),
+            patch_size,
+            stride,
+            version if version is not None else code_version(),
+        )
+
+    def is_complete(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT geojson_hash, zarr_shape, patch_size, stride, code_version "
+                "FROM completed WHERE brain_id = ? AND section_id = ?",
+                (key.brain_id, key.section_id),
+            ).fetchone()
+        return row is not None and tuple(row) == key.fingerprint
+
+    def mark_complete(self, keys):
+        rows = [
+            (k.brain_id, k.section_id, *k.fingerprint, time.time()) for k in keys
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self.conn.executemany(
+                "DELETE FROM failures WHERE brain_id = ? AND section_id = ?",
+                [(k.brain_id, k.section_id) for k in keys],
+            )
+
+    def record_failure(self, key, stage, error):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (brain_id, section_id) DO UPDATE SET "
+                "geojson_hash = excluded.geojson_hash, zarr_shape = excluded.zarr_shape, "
+                "patch_size = excluded.patch_size, stride = excluded.stride, "
+                "code_version = excluded.code_version, stage = excluded.stage, "
+                "error = excluded.error, attempts = attempts + 1, "
+                "last_attempt = excluded.last_attempt",
+                (
+                    key.brain_id,
+                    key.section_id,
+                    *key.fingerprint,
+                    stage,
+                    str(error),
+                    time.time(),
+                ),
+            )
+
+    def failed_sections(self, brain_id=None):
+        query = "SELECT brain_id, section_id FROM failures"
+        params = ()
+        if brain_id is not None:
+            query += " WHERE brain_id = ?"
+            params = (brain_id,)
+        with self.lock:
+            return [tuple(row) for row in self.conn.execute(query, params)]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,261 @@
+"""
+Bulk writer of patch metadata to the test_metadata_patch Postgres DB.
+"""
+import asyncio
+from itertools import islice
+import json
+
+import asyncpg
+
+from .db_config import metadata_dsn
+from .inverted_index import region_postings
+
+# Rows sent per COPY
+COPY_BATCH_SIZE = 50000
+
+PATCH_COLUMNS = (
+    "id",
+    "brain_id",
+    "section_id",
+    "min_x",
+    "min_y",
+    "patch_size",
+    "store_path",
+    "is_bg",
+    "check_bg",
+    "no_geojson",
+)
+LABEL_COLUMNS = ("patch_id", "region_id", "brain_id", "section_id", "coverage", "polygon")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patches (
+    id TEXT PRIMARY KEY,
+    brain_id INTEGER NOT NULL,
+    section_id INTEGER NOT NULL,
+    min_x INTEGER NOT NULL,
+    min_y INTEGER NOT NULL,
+    patch_size INTEGER NOT NULL,
+    store_path TEXT NOT NULL,
+    is_bg BOOLEAN NOT NULL,
+    check_bg BOOLEAN NOT NULL,
+    no_geojson BOOLEAN NOT NULL
+);
+CREATE INDEX IF NOT EXISTS patches_section ON patches (brain_id, section_id);
+CREATE TABLE IF NOT EXISTS patch_labels (
+    patch_id TEXT NOT NULL,
+    region_id INTEGER NOT NULL,
+    brain_id INTEGER NOT NULL,
+    section_id INTEGER NOT NULL,
+    coverage DOUBLE PRECISION NOT NULL,
+    polygon JSONB,
+    PRIMARY KEY (patch_id, region_id)
+);
+CREATE INDEX IF NOT EXISTS patch_labels_section ON patch_labels (brain_id, section_id);
+"""
+
+# Emptied on commit, so a connection reuses them across transactions
+STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS patches_staging
+    (LIKE patches INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;
+CREATE TEMP TABLE IF NOT EXISTS patch_labels_staging
+    (LIKE patch_labels INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;
+"""
+
+
+def merge_sql(table, columns, key):
+    """INSERT ... ON CONFLICT from the staging table, skipping rows that did not change"""
+    values = [c for c in columns if c not in key]
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"SELECT {', '.join(columns)} FROM {table}_staging "
+        f"ON CONFLICT ({', '.join(key)}) DO UPDATE SET "
+        + ", ".join(f"{c} = EXCLUDED.{c}" for c in values)
+        + f" WHERE ({', '.join(f'{table}.{c}' for c in values)}) "
+        f"IS DISTINCT FROM ({', '.join(f'EXCLUDED.{c}' for c in values)})"
+    )
+
+
+def delete_stale_sql(table, key):
+    """Delete the rows of the given sections that are not in the staging table"""
+    match = " AND ".join(f"t.{c} = s.{c}" for c in key)
+    return (
+        f"DELETE FROM {table} t "
+        f"USING unnest($1::integer[], $2::integer[]) AS w(brain_id, section_id) "
+        f"WHERE t.brain_id = w.brain_id AND t.section_id = w.section_id "
+        f"AND NOT EXISTS (SELECT 1 FROM {table}_staging s WHERE {match})"
+    )
+
+
+def as_result(pdb):
+    """PatchDBResult of a populated PatchDB, results pass through"""
+    return pdb.result() if hasattr(pdb, "populate_db") else pdb
+
+
+def patch_rows(result):
+    """Rows of the patches table for a PatchDBResult"""
+    brain_id, section_id = int(result.brain_id), int(result.section_id)
+    store_path = f"/storage/BrainSAM/zarr_n5/optimum_1024/{brain_id}/{section_id}.n5"
+    prefix = f"{brain_id}_{section_id}_"
+    check_bg, no_geojson = bool(result.check_bg), bool(result.no_geojson)
+    for x, y, is_bg in zip(result.min_x.tolist(), result.min_y.tolist(), result.is_bg.tolist()):
+        yield (
+            f"{prefix}{x}_{y}",
+            brain_id,
+            section_id,
+            x,
+            y,
+            int(result.patch_size),
+            store_path,
+            is_bg,
+            check_bg,
+            no_geojson,
+        )
+
+
+def label_rows(result):
+    """
+    Rows of the patch_labels table for a PatchDBResult: the coverage of every
+    non-zero label, with the region polygon of the patch when the labeling
+    engine kept one (as JSON text)
+    """
+    brain_id, section_id = int(result.brain_id), int(result.section_id)
+    prefix = f"{brain_id}_{section_id}_"
+    polygons = {}
+    for idx, _, region_polygons, _ in json.loads(result.payload):
+        for region_id, polygon in region_polygons:
+            polygons[(idx, int(region_id))] = polygon
+    region_ids, patch_idx, coverage = region_postings(result.labels, result.label_columns)
+    min_x, min_y = result.min_x, result.min_y
+    for region_id, idx, ratio in zip(region_ids.tolist(), patch_idx.tolist(), coverage.tolist()):
+        polygon = polygons.get((idx, region_id))
+        yield (
+            f"{prefix}{min_x[idx]}_{min_y[idx]}",
+            region_id,
+            brain_id,
+            section_id,
+            ratio,
+            json.dumps(polygon) if polygon is not None else None,
+        )
+
+
+class PatchMetadataWriter(object):
+    """
+    Bulk writer of PatchDB metadata (patches and their label coverages and
+    region polygons) over an asyncpg connection.
+
+    The rows of a batch of sections are streamed into temporary staging
+    tables with COPY, batch_size rows at a time, and merged with one
+    INSERT ... ON CONFLICT per table, in a single transaction. Rows of the
+    written sections that are missing from the staging tables are deleted,
+    so rerunning a section (also after qc_check dropped patches) leaves
+    exactly its latest rows, and unchanged rows are not rewritten.
+
+    Parameters
+    ---
+    - conn: asyncpg.Connection
+    - batch_size: int, rows per COPY
+    """
+
+    def __init__(self, conn, batch_size=COPY_BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+
+    @classmethod
+    async def from_session(cls, session, **kwargs):
+        """
+        Writer on the asyncpg connection of an SQLAlchemy AsyncSession (see
+        dependencies.session_scope). Writes then run in the session's
+        transaction and are kept once the session commits.
+        """
+        connection = await session.connection()
+        raw = await connection.get_raw_connection()
+        return cls(raw.driver_connection, **kwargs)
+
+    async def create_tables(self):
+        await self.conn.execute(SCHEMA)
+
+    async def copy(self, table, columns, rows):
+        n = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return n
+            await self.conn.copy_records_to_table(table, records=batch, columns=columns)
+            n += len(batch)
+
+    async def write_sections(self, results):
+        """
+        Write PatchDBResults (or populated PatchDBs). A section listed more
+        than once is written from its last result. Returns the number of
+        patch and label rows written.
+        """
+        sections = {}
+        for result in map(as_result, results):
+            sections[(int(result.brain_id), int(result.section_id))] = result
+        if not sections:
+            return {"patches": 0, "labels": 0}
+        brain_ids = [b for b, _ in sections]
+        section_ids = [s for _, s in sections]
+        n_patches = n_labels = 0
+        async with self.conn.transaction():
+            await self.conn.execute(STAGING)
+            for result in sections.values():
+                n_patches += await self.copy("patches_staging", PATCH_COLUMNS, patch_rows(result))
+                n_labels += await self.copy(
+                    "patch_labels_staging", LABEL_COLUMNS, label_rows(result)
+                )
+            # Temp tables are never auto-analyzed, the anti-joins below need their sizes
+            await self.conn.execute("ANALYZE patches_staging; ANALYZE patch_labels_staging")
+            await self.conn.execute(merge_sql("patches", PATCH_COLUMNS, ("id",)))
+            await self.conn.execute(
+                merge_sql("patch_labels", LABEL_COLUMNS, ("patch_id", "region_id"))
+            )
+            await self.conn.execute(delete_stale_sql("patches", ("id",)), brain_ids, section_ids)
+            await self.conn.execute(
+                delete_stale_sql("patch_labels", ("patch_id", "region_id")), brain_ids, section_ids
+            )
+        return {"patches": n_patches, "labels": n_labels}
+
+
+class PostgresRegistrar(object):
+    """
+    save_metadata registrar writing with PatchMetadataWriter. SyncStage is a
+    thread, so the registrar runs its own event loop and keeps one
+    connection, reopened after a failed batch.
+
+    Parameters
+    ---
+    - dsn: str, Postgres connection string, defaults to db_config.metadata_dsn()
+    - batch_size: int, rows per COPY
+    """
+
+    def __init__(self, dsn=None, batch_size=COPY_BATCH_SIZE):
+        self.dsn = dsn or metadata_dsn()
+        self.batch_size = batch_size
+        self.loop = asyncio.new_event_loop()
+        self.writer = None
+
+    async def _sync(self, results):
+        if self.writer is None:
+            conn = await asyncpg.connect(self.dsn)
+            self.writer = PatchMetadataWriter(conn, self.batch_size)
+            await self.writer.create_tables()
+        try:
+            return await self.writer.write_sections(results)
+        except Exception:
+            await self.writer.conn.close()
+            self.writer = None
+            raise
+
+    def sync_batch(self, results):
+        return self.loop.run_until_complete(self._sync(results))
+
+    def sync_patches(self, result):
+        return self.sync_batch([result])
+
+    def close(self):
+        if self.writer is not None:
+            self.loop.run_until_complete(self.writer.conn.close())
+            self.writer = None
+        self.loop.close()
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+NOMENCLATURE_PATH = "/storage/BrainSAM/models/nomenclature.json"
+
+FIELDS = [
+    "text",
+    "id",
+    "name",
+    "definition (description)",
+    "acronym",
+    "color_hex_triplet",
+    "children",
+    "type (gray matter/fiber tract/CNS cavity/developmental/other)",
+    "parent_structure_id",
+]
+
+
+class Nomenclature(object):
+    """
+    Parsed nomenclature tree with precomputed lookups.
+
+    Attributes
+    ---
+    - frame: pandas.DataFrame, one row per region indexed by id
+    - ids: numpy.ndarray, the region ids in row order
+    - row_index: dict, region id -> row position in frame
+    - label_columns: list[str], the region ids as label column names
+    - column_index: pandas.Index, label column name -> column position
+    - column_pos: dict, label column name -> column position
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.ids = frame.index.to_numpy()
+        self.row_index = {region_id: i for i, region_id in enumerate(self.ids.tolist())}
+        self.label_columns = [str(n) for n in self.ids.tolist()]
+        self.column_index = pd.Index(self.label_columns)
+        self.column_pos = {c: i for i, c in enumerate(self.label_columns)}
+
+    def __len__(self):
+        return len(self.frame)
+
+
+def parse_nomenclature(nomenclature_path=NOMENCLATURE_PATH):
+    """Parse the nomenclature json into a frame indexed by region id"""
+    with open(nomenclature_path, "r") as f:
+        nomenclature = json.load(f)
+
+    rename_fields = {}
+    for field in FIELDS:
+        if " " in field:
+            rename_fields[field] = field.split(" ")[0]
+        else:
+            rename_fields[field] = field
+    nomenclature = nomenclature["tree"][0]
+    nomenclature_df = pd.DataFrame(nomenclature["children"])
+    nomenclature_df = nomenclature_df.drop(
+        columns=["children", "text", "parent_structure_id"]
+    )
+    nomenclature_df = nomenclature_df.rename(columns=rename_fields)
+    nomenclature_df = nomenclature_df.set_index("id")
+    return nomenclature_df
+
+
+def sidecar_path(nomenclature_path):
+    return nomenclature_path + ".feather"
+
+
+def write_sidecar(nomenclature_path=NOMENCLATURE_PATH):
+    """
+    Serialize the parsed nomenclature to an Arrow (feather) file next to the
+    json, so worker processes can skip the json parse. Requires pyarrow.
+    """
+    frame = parse_nomenclature(nomenclature_path)
+    path = sidecar_path(nomenclature_path)
+    frame.reset_index().to_feather(path)
+    return path
+
+
+def read_sidecar(nomenclature_path):
+    """Read the Arrow sidecar if it exists and is newer than the json"""
+    path = sidecar_path(nomenclature_path)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(nomenclature_path):
+            return None
+        frame = pd.read_feather(path)
+    except (OSError, ImportError):
+        return None
+    # Arrow reads missing strings back as None, the json parse gives NaN
+    frame = frame.fillna(np.nan)
+    return frame.set_index("id")
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_nomenclature_registry(nomenclature_path=NOMENCLATURE_PATH):
+    """
+    Return the Nomenclature of `nomenclature_path`, loaded once per process and
+    reloaded when the file's mtime changes. The returned object is shared and
+    must not be mutated.
+    """
+    mtime = os.path.getmtime(nomenclature_path)
+    with _registry_lock:
+        cached = _registry.get(nomenclature_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        frame = read_sidecar(nomenclature_path)
+        if frame is None:
+            frame = parse_nomenclature(nomenclature_path)
+        nomenclature = Nomenclature(frame)
+        _registry[nomenclature_path] = (mtime, nomenclature)
+        return nomenclature
@@ -7,7 +7,11 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm, trange 
 from joblib import Parallel, delayed  
 from itertools import product
+from collections import Counter
+import shapely
 from shapely.geometry import Polygon
+from .chunk_cache import CachingStore, store_stamp
+from .pyramid import level_box, level_store_path
 
 
 class InvalidPatchSize(Exception):
@@ -16,13 +20,16 @@ class InvalidPatchSize(Exception):
 
 
 class Store:
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         self.path = path
-        self.store = zarr.open(path)
+        if cache is None:
+            self.store = zarr.open(path)
+        else:
+            self.store = zarr.open(CachingStore(path, cache), mode="r")
 
 
 class Patch:
-    def __init__(self, x, y, brain_id, section_id, patch_size=1024, store=None):
+    def __init__(self, x, y, brain_id, section_id, patch_size=1024, store=None, level=0):
         self.min_x = x
         self.min_y = y
         self.patch_size = patch_size
@@ -34,8 +41,10 @@ class Patch:
         self.labels = []
         self.id = f"{brain_id}_{section_id}_{x}_{y}"
         self.store = store
-        self.store_path = (
-            f"/storage/BrainSAM/zarr_n5/optimum_1024/{brain_id}/{section_id}.n5"
+        # Coordinates stay in full resolution pixels, level picks the 2**level store
+        self.level = level
+        self.store_path = level_store_path(
+            f"/storage/BrainSAM/zarr_n5/optimum_1024/{brain_id}/{section_id}.n5", level
         )
         self.corners = self.get_corners()
         self.polygon_coords = [
@@ -82,7 +91,12 @@ class Patch:
         ys = [self.min_y, self.max_y]
         return list(product(xs, ys))
 
+    def level_box(self):
+        """Pixel box of the patch in its level's store, as (y0, y1, x0, x1)"""
+        return level_box(self.min_x, self.min_y, self.max_x, self.max_y, self.level)
+
     def array(self):
+        y0, y1, x0, x1 = self.level_box()
         try:
             if self.store is None:
                 warnings.warn(
@@ -91,15 +105,15 @@ class Patch:
                 self.load_store()
                 if self.store is not None:
                     if self.z is None:
-                        return self.store[self.min_y : self.max_y, self.min_x : self.max_x, :]
+                        return self.store[y0:y1, x0:x1, :]
                     else:
-                        return self.store[self.min_y : self.max_y, self.min_x : self.max_x, self.z]
+                        return self.store[y0:y1, x0:x1, self.z]
 
             else:
                 if self.z is None:
-                    return self.store[self.min_y : self.max_y, self.min_x : self.max_x, :]
+                    return self.store[y0:y1, x0:x1, :]
                 else:
-                    return self.store[self.min_y : self.max_y, self.min_x : self.max_x, self.z]
+                    return self.store[y0:y1, x0:x1, self.z]
         except IndexError:
             if self.z is not None:
                 raise InvalidPatchSize(
@@ -110,6 +124,11 @@ class Patch:
                     f"Patch size {self.patch_size}x {self.patch_size} x {self.z} is invalid for the given image size"
                 )
 
+    @staticmethod
+    def array_many(patches):
+        """Read the arrays of many patches, see PatchBatchReader"""
+        return PatchBatchReader().read(patches)
+
     def cupy(self):
         return cp.array(self.array())
 
@@ -136,3 +155,360 @@ class Patch:
                 if self.adjacent(p):
                     adjacent.append(p)
         return adjacent
+
+
+class PatchBatchReader:
+    """
+    Read many patches while decoding every store chunk at most once.
+
+    Patches are grouped by (brain_id, section_id, level). Within a store, patches
+    that share chunks are grouped together, each chunk a group needs is read
+    once and every patch of the group is assembled from those chunks. Only
+    chunks the patches cover are read, and each is dropped once the patches
+    covering it are assembled, so sparse batches spread over a section stay
+    cheap. With a ChunkCache, decoded chunks are also reused
+    across reads.
+    """
+
+    def __init__(self, cache=None):
+        self.stores = {}
+        self.cache = cache
+
+    def open_store(self, patch):
+        if isinstance(patch.store, zarr.Array):
+            return patch.store
+        if patch.store_path not in self.stores:
+            self.stores[patch.store_path] = zarr.open(patch.store_path, mode="r")
+        return self.stores[patch.store_path]
+
+    def read(self, patches):
+        arrays = [None] * len(patches)
+        sections = {}
+        for i, patch in enumerate(patches):
+            sections.setdefault((patch.brain_id, patch.section_id, patch.level), []).append(i)
+        for patch_idx in sections.values():
+            section_patches = [patches[i] for i in patch_idx]
+            store = self.open_store(section_patches[0])
+            views = self.read_section(store, section_patches)
+            for i, view in zip(patch_idx, views):
+                arrays[i] = view
+        return arrays
+
+    @staticmethod
+    def _components(chunk_boxes):
+        """Group patches that share chunks, with a union-find over the chunks each patch covers"""
+        parent = list(range(len(chunk_boxes)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owners = {}
+        for i, (cy0, cy1, cx0, cx1) in enumerate(chunk_boxes.tolist()):
+            for chunk in product(range(cy0, cy1), range(cx0, cx1)):
+                j = owners.setdefault(chunk, i)
+                if j != i:
+                    parent[find(i)] = find(j)
+        components = {}
+        for i in range(len(chunk_boxes)):
+            components.setdefault(find(i), []).append(i)
+        return list(components.values())
+
+    def read_chunk(self, store, store_key, cy, cx, ys, xs):
+        if self.cache is None:
+            return store[ys, xs]
+        key = (store_key, cy, cx)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            chunk = store[ys, xs]
+            self.cache.put(key, chunk)
+        return chunk
+
+    @staticmethod
+    def store_key(store):
+        """(path, store stamp) of on-disk stores, so rewritten stores get new chunk keys"""
+        path = getattr(store.store, "path", None)
+        return (path, store_stamp(path)) if path is not None else id(store)
+
+    def read_section(self, store, patches):
+        h, w = store.shape[:2]
+        ch, cw = store.chunks[:2]
+        # Pixel boxes in the store's level, clamped to the image as slicing would
+        boxes = np.array([p.level_box() for p in patches]).reshape(-1, 4)
+        y0, y1 = np.minimum(boxes[:, 0], h), np.minimum(boxes[:, 1], h)
+        x0, x1 = np.minimum(boxes[:, 2], w), np.minimum(boxes[:, 3], w)
+        chunk_boxes = np.stack(
+            [y0 // ch, -(-y1 // ch), x0 // cw, -(-x1 // cw)], axis=1
+        )
+        y0, y1, x0, x1 = y0.tolist(), y1.tolist(), x0.tolist(), x1.tolist()
+        store_key = self.store_key(store) if self.cache is not None else None
+        views = [None] * len(patches)
+        for component in self._components(chunk_boxes):
+            # Patches are assembled row by row, and every chunk is decoded once
+            # and released after the last patch covering it
+            component = sorted(component, key=lambda i: (y0[i], x0[i]))
+            pending = Counter(
+                chunk
+                for i in component
+                for chunk in product(
+                    range(chunk_boxes[i, 0], chunk_boxes[i, 1]),
+                    range(chunk_boxes[i, 2], chunk_boxes[i, 3]),
+                )
+            )
+            chunks = {}
+            for i in component:
+                cy0, cy1, cx0, cx1 = chunk_boxes[i].tolist()
+                out = np.empty((y1[i] - y0[i], x1[i] - x0[i]) + store.shape[2:], dtype=store.dtype)
+                for cy, cx in product(range(cy0, cy1), range(cx0, cx1)):
+                    if (cy, cx) not in chunks:
+                        ys = slice(cy * ch, min((cy + 1) * ch, h))
+                        xs = slice(cx * cw, min((cx + 1) * cw, w))
+                        chunks[cy, cx] = self.read_chunk(store, store_key, cy, cx, ys, xs)
+                    # Overlap of the patch and the chunk, in pixels of the level
+                    oy0, oy1 = max(y0[i], cy * ch), min(y1[i], (cy + 1) * ch)
+                    ox0, ox1 = max(x0[i], cx * cw), min(x1[i], (cx + 1) * cw)
+                    out[oy0 - y0[i] : oy1 - y0[i], ox0 - x0[i] : ox1 - x0[i]] = chunks[cy, cx][
+                        oy0 - cy * ch : oy1 - cy * ch, ox0 - cx * cw : ox1 - cx * cw
+                    ]
+                    pending[cy, cx] -= 1
+                    if not pending[cy, cx]:
+                        del chunks[cy, cx]
+                if patches[i].z is not None:
+                    out = out[:, :, patches[i].z]
+                views[i] = out
+        return views
+
+
+class PatchView:
+    """
+    Lightweight patch handed out by PatchGrid. It only holds the grid and its
+    position in it, every attribute is read from the grid arrays. It reads
+    like a level 0 Patch without z, but its attributes cannot be set. Views
+    are invalidated when patches are removed from the grid.
+    """
+
+    __slots__ = ("grid", "index")
+
+    def __init__(self, grid, index):
+        self.grid = grid
+        self.index = index
+
+    @property
+    def min_x(self):
+        return int(self.grid.min_x[self.index])
+
+    @property
+    def min_y(self):
+        return int(self.grid.min_y[self.index])
+
+    @property
+    def max_x(self):
+        return self.min_x + self.grid.patch_size
+
+    @property
+    def max_y(self):
+        return self.min_y + self.grid.patch_size
+
+    @property
+    def patch_size(self):
+        return self.grid.patch_size
+
+    @property
+    def brain_id(self):
+        return self.grid.brain_id
+
+    @property
+    def section_id(self):
+        return self.grid.section_id
+
+    @property
+    def id(self):
+        return f"{self.brain_id}_{self.section_id}_{self.min_x}_{self.min_y}"
+
+    @property
+    def store(self):
+        return self.grid.store
+
+    @property
+    def store_path(self):
+        return self.grid.store_path
+
+    @property
+    def z(self):
+        return None
+
+    @property
+    def level(self):
+        return 0
+
+    def level_box(self):
+        """Pixel box of the patch in its level's store, as (y0, y1, x0, x1)"""
+        return level_box(self.min_x, self.min_y, self.max_x, self.max_y, self.level)
+
+    @property
+    def corners(self):
+        return self.get_corners()
+
+    def get_corners(self) -> list[tuple[int, int]]:
+        xs = [self.min_x, self.max_x]
+        ys = [self.min_y, self.max_y]
+        return list(product(xs, ys))
+
+    @property
+    def is_bg(self):
+        return bool(self.grid.is_bg[self.index])
+
+    @property
+    def is_background(self):
+        return self.is_bg
+
+    @property
+    def has_annotation(self):
+        # Patch never clears it either
+        return True
+
+    @property
+    def polygon(self):
+        return self.grid.polygons[self.index]
+
+    @property
+    def labels(self):
+        return self.grid.labels.setdefault(self.index, [])
+
+    @property
+    def region_polygons(self):
+        return self.grid.region_polygons.setdefault(self.index, {})
+
+    @property
+    def region_areas(self):
+        return self.grid.region_areas.setdefault(self.index, {})
+
+    def __hash__(self):
+        return hash((self.min_x, self.min_y))
+
+    def __eq__(self, other):
+        if not isinstance(other, (Patch, PatchView)):
+            return NotImplemented
+        return (
+            self.brain_id == other.brain_id
+            and self.section_id == other.section_id
+            and self.min_x == other.min_x
+            and self.min_y == other.min_y
+        )
+
+    def __str__(self):
+        return f"{self.brain_id}:{self.section_id} : ({self.min_x}, {self.min_y})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def array(self):
+        if self.grid.store is None:
+            self.grid.store = zarr.open(self.store_path)
+        y0, y1, x0, x1 = self.level_box()
+        if self.z is None:
+            return self.grid.store[y0:y1, x0:x1, :]
+        return self.grid.store[y0:y1, x0:x1, self.z]
+
+    def cupy(self):
+        return cp.array(self.array())
+
+    def adjacent(self, other):
+        if self.brain_id == other.brain_id and self.section_id == other.section_id:
+            other_corners = other.corners
+            for corner in self.corners:
+                if corner in other_corners:
+                    return True
+        return False
+
+    def display(self):
+        plt.imshow(self.array())  # type: ignore
+        plt.title(self.__str__())
+        plt.show()
+
+    def find_adjacent(self, patches):
+        return [p for p in patches if p != self and self.adjacent(p)]
+
+
+class PatchGrid:
+    """
+    Array-backed grid of patches over a section, in the same order as one
+    Patch per (x, y) with x as the outer loop. Patch geometries are built
+    with a single vectorized shapely.box call on first use and labels are
+    only stored for the patches that have any. is_bg and tissue_fraction
+    are filled by background detection, check_bg tells whether it ran.
+    """
+
+    arrays = ("min_x", "min_y", "is_bg", "tissue_fraction")
+
+    def __init__(self, brain_id, section_id, h, w, patch_size=1024, stride=1024, store=None):
+        self.brain_id = brain_id
+        self.section_id = section_id
+        self.patch_size = patch_size
+        self.store = store
+        self.store_path = (
+            f"/storage/BrainSAM/zarr_n5/optimum_1024/{brain_id}/{section_id}.n5"
+        )
+        xs = np.arange(0, w, stride)
+        ys = np.arange(0, h, stride)
+        self.min_x = np.repeat(xs, len(ys))
+        self.min_y = np.tile(ys, len(xs))
+        self.is_bg = np.zeros(len(self.min_x), dtype=bool)
+        self.tissue_fraction = np.full(len(self.min_x), np.nan)
+        self.check_bg = False
+        self.labels = {}
+        self.region_polygons = {}
+        self.region_areas = {}
+        self._polygons = None
+
+    @property
+    def max_x(self):
+        return self.min_x + self.patch_size
+
+    @property
+    def max_y(self):
+        return self.min_y + self.patch_size
+
+    @property
+    def ids(self):
+        return [
+            f"{self.brain_id}_{self.section_id}_{x}_{y}"
+            for x, y in zip(self.min_x.tolist(), self.min_y.tolist())
+        ]
+
+    @property
+    def polygons(self):
+        # Patch polygons live in the geojson frame, where image rows are negative y
+        if self._polygons is None:
+            self._polygons = shapely.box(self.min_x, -self.max_y, self.max_x, -self.min_y)
+        return self._polygons
+
+    def __len__(self):
+        return len(self.min_x)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("patch index out of range")
+        return PatchView(self, int(index))
+
+    def __iter__(self):
+        return (PatchView(self, i) for i in range(len(self)))
+
+    def remove(self, patch_idx_list):
+        """Remove patches by position, later patches move up"""
+        keep = np.ones(len(self), dtype=bool)
+        keep[np.asarray(patch_idx_list, dtype=int)] = False
+        new_index = np.cumsum(keep) - 1
+        for attr in self.arrays:
+            setattr(self, attr, getattr(self, attr)[keep])
+        if self._polygons is not None:
+            self._polygons = self._polygons[keep]
+        for attr in ("labels", "region_polygons", "region_areas"):
+            values = getattr(self, attr)
+            setattr(
+                self, attr, {int(new_index[i]): v for i, v in values.items() if keep[i]}
+            )
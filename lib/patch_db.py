@@ -1,6 +1,10 @@
 from .polygon_graph import PolygonGraph, InvalidGeojsonError
-from .patch import Patch
+from .region_index import ROTATION_MAP, load_region_index
+from .patch import Patch, PatchGrid
 from .path_config import PathConfig
+from .nomenclature import NOMENCLATURE_PATH, get_nomenclature_registry
+from .background import BACKGROUND_LEVEL, open_level, tissue_mask, tissue_fraction
+from .raster import RASTER_SCALE, SectionRaster, polygon_edges, rasterize
 import zarr as za
 import json
 import pandas as pd
@@ -8,8 +12,10 @@ from tqdm import tqdm, trange
 from joblib import Parallel, delayed 
 import numpy as np
 import shapely
+import scipy.sparse as sp
 from shapely import GEOSException 
-from functools import partial
+from shapely.geometry import Polygon
+from functools import partial, cached_property
 
 
 class ImageNotFoundError(Exception):
@@ -24,35 +30,118 @@ def get_shape(patch):
     return shape, True
 
 
-def get_nomenclature(nomenclature_path="/storage/BrainSAM/models/nomenclature.json"):
-    with open(nomenclature_path, "r") as f:
-        nomenclature = json.load(f)
+def get_nomenclature(nomenclature_path=NOMENCLATURE_PATH):
+    """Copy of the cached nomenclature frame, see lib.nomenclature"""
+    return get_nomenclature_registry(nomenclature_path).frame.copy()
 
-    fields = [
-        "text",
+
+class PatchRecord(object):
+    """Plain per-patch record of a PatchDBResult, with the Patch attributes used for syncing"""
+
+    __slots__ = (
         "id",
-        "name",
-        "definition (description)",
-        "acronym",
-        "color_hex_triplet",
-        "children",
-        "type (gray matter/fiber tract/CNS cavity/developmental/other)",
-        "parent_structure_id",
-    ]
-    rename_fields = {}
-    for field in fields:
-        if " " in field:
-            rename_fields[field] = field.split(" ")[0]
-        else:
-            rename_fields[field] = field
-    nomenclature = nomenclature["tree"][0]
-    nomenclature_df = pd.DataFrame(nomenclature["children"])
-    nomenclature_df = nomenclature_df.drop(
-        columns=["children", "text", "parent_structure_id"]
+        "brain_id",
+        "section_id",
+        "min_x",
+        "min_y",
+        "patch_size",
+        "store_path",
+        "labels",
+        "region_polygons",
+        "region_areas",
     )
-    nomenclature_df = nomenclature_df.rename(columns=rename_fields)
-    nomenclature_df = nomenclature_df.set_index("id")
-    return nomenclature_df
+
+    def __init__(self, brain_id, section_id, min_x, min_y, patch_size, labels, region_polygons, region_areas):
+        self.id = f"{brain_id}_{section_id}_{min_x}_{min_y}"
+        self.brain_id = brain_id
+        self.section_id = section_id
+        self.min_x = min_x
+        self.min_y = min_y
+        self.patch_size = patch_size
+        self.store_path = (
+            f"/storage/BrainSAM/zarr_n5/optimum_1024/{brain_id}/{section_id}.n5"
+        )
+        self.labels = labels
+        self.region_polygons = region_polygons
+        self.region_areas = region_areas
+
+
+class PatchDBResult(object):
+    """
+    Compact, cheaply picklable result of a populated PatchDB, for returning
+    from worker processes. It holds the patch origins as NumPy arrays, the
+    sparse label matrix and one JSON blob with the labels, region polygons
+    and region areas of the labeled patches. patch_db, patches and dense_db
+    are rebuilt on access, so it can be passed where a PatchDB is read.
+    """
+
+    def __init__(self, pdb):
+        self.brain_id = pdb.brain_id
+        self.section_id = pdb.section_id
+        self.patch_size = pdb.patch_size
+        self.stride = pdb.stride
+        self.no_geojson = pdb.no_geojson
+        self.min_x = pdb.patches.min_x
+        self.min_y = pdb.patches.min_y
+        self.is_bg = pdb.patches.is_bg
+        self.check_bg = pdb.patches.check_bg
+        self.labels = pdb.labels
+        self.label_columns = pdb.label_columns
+        grid = pdb.patches
+        self.payload = json.dumps(
+            [
+                [
+                    idx,
+                    grid.labels.get(idx, []),
+                    list(grid.region_polygons.get(idx, {}).items()),
+                    list(grid.region_areas.get(idx, {}).items()),
+                ]
+                for idx in sorted(set(grid.labels) | set(grid.region_areas))
+            ]
+        ).encode()
+
+    def __len__(self):
+        return len(self.min_x)
+
+    @property
+    def patch_db(self):
+        return pd.DataFrame(
+            {
+                "id": [
+                    f"{self.brain_id}_{self.section_id}_{x}_{y}"
+                    for x, y in zip(self.min_x.tolist(), self.min_y.tolist())
+                ],
+                "min_x": self.min_x,
+                "min_y": self.min_y,
+                "brain_id": self.brain_id,
+                "section_id": self.section_id,
+                "check_bg": int(self.check_bg),
+                "is_bg": self.is_bg.astype(int),
+                "no_geojson": int(self.no_geojson),
+            }
+        )
+
+    @property
+    def patches(self):
+        payload = {
+            idx: (labels, dict(polygons), dict(areas))
+            for idx, labels, polygons, areas in json.loads(self.payload)
+        }
+        return [
+            PatchRecord(
+                self.brain_id,
+                self.section_id,
+                x,
+                y,
+                self.patch_size,
+                *payload.get(idx, ([], {}, {})),
+            )
+            for idx, (x, y) in enumerate(zip(self.min_x.tolist(), self.min_y.tolist()))
+        ]
+
+    def dense_db(self):
+        labels = pd.DataFrame(self.labels.toarray(), columns=self.label_columns)
+        return pd.concat([self.patch_db, labels], axis=1)
 
 
 class PatchDB(object):
@@ -72,35 +161,68 @@ class PatchDB(object):
         self.geo_json_origin = (self.w / 2, -self.h / 2)  # type: ignore
         self.no_geojson = False
         try:
-            self.p_graph = PolygonGraph(self.path_config.gjson_path())
-            self.geo_rotation = self.p_graph.json["rotation"]
-            self.geoms = self.p_graph.geodf["geometry"]
-            self.rotation_map = {270: -90, 90: 90, 180: 180, 0: 0}
-            self.geoms = self.geoms.rotate(
-                self.rotation_map[self.geo_rotation], origin=self.geo_json_origin
-            )
-            self.p_graph.geodf["geometry"] = self.geoms
-            self.region_polygons = self.p_graph.geodf["geometry"].values.tolist()
+            # Rotated region polygons, from the per-section cache when it is current
+            self.region_index = load_region_index(self.path_config, self.h, self.w)
+            self.geo_rotation = self.region_index.rotation
+            self.region_polygons = self.region_index.geometries.tolist()
+            self.tree_region_ids = self.region_index.region_ids
         except InvalidGeojsonError:
-            self.p_graph = None
+            self.region_index = None
             self.region_polygons = []
+            self.tree_region_ids = np.array([], dtype=object)
             self.no_geojson = True
         self.stride = stride
         self.patch_size = patch_size
-        self.nomenclature_df = get_nomenclature()
+        self.nomenclature = get_nomenclature_registry()
+        self.nomenclature_df = self.nomenclature.frame
         self.patches = self.make_patches()
-        self.patch_polygons = [patch.polygon for patch in self.patches]
-        self.tree = shapely.strtree.STRtree(self.region_polygons + self.patch_polygons)
+        self._rasters = {}
+
+    rotation_map = ROTATION_MAP
+
+    @cached_property
+    def p_graph(self):
+        """
+        PolygonGraph of the section geojson with its geometries rotated into the
+        image frame, as the patches are. Parsed on first use, labeling reads the
+        cached region index instead.
+        """
+        if self.no_geojson:
+            return None
+        p_graph = PolygonGraph(self.path_config.gjson_path())
+        p_graph.geodf["geometry"] = p_graph.geodf["geometry"].rotate(
+            self.rotation_map[p_graph.json["rotation"]], origin=self.geo_json_origin
+        )
+        return p_graph
+
+    @property
+    def geoms(self):
+        """Rotated region geometries of p_graph"""
+        return None if self.p_graph is None else self.p_graph.geodf["geometry"]
+
+    @property
+    def patch_polygons(self):
+        return self.patches.polygons
+
+    @cached_property
+    def tree(self):
+        """STRtree over the region polygons followed by the patch polygons"""
+        return shapely.strtree.STRtree(
+            np.concatenate(
+                [np.asarray(self.region_polygons, dtype=object), self.patch_polygons]
+            )
+        )
 
     def make_patches(self):
-        patches = []
-        for x in range(0, self.w, self.stride):  # type: ignore
-            for y in range(0, self.h, self.stride):  # type: ignore
-                patch = Patch(
-                    x, y, self.brain_id, self.section_id, self.patch_size, self.store
-                )
-                patches.append(patch)
-        return patches
+        return PatchGrid(
+            self.brain_id,
+            self.section_id,
+            self.h,
+            self.w,
+            self.patch_size,
+            self.stride,
+            self.store,
+        )
 
     def load_patches(self):
         _ = Parallel(n_jobs=16, backend="loky")(
@@ -108,7 +230,7 @@ class PatchDB(object):
         )
 
     def create_db(self):
-        label_columns = [str(n) for n in self.nomenclature_df.index.values.tolist()]
+        """Patch metadata frame, the label coverage is kept apart in self.labels"""
         patch_db = pd.DataFrame(
             columns=[
                 "patch_index",
@@ -119,40 +241,91 @@ class PatchDB(object):
                 "section_id",
                 "check_bg",
             ]
-            + label_columns
         )
-        patch_db[label_columns] = patch_db[label_columns].astype(np.float64)
-        patch_db["id"] = [patch.id for patch in self.patches]
-        patch_db["min_x"] = [patch.min_x for patch in self.patches]
-        patch_db["min_y"] = [patch.min_y for patch in self.patches]
-        patch_db["brain_id"] = [patch.brain_id for patch in self.patches]
-        patch_db["section_id"] = [patch.section_id for patch in self.patches]
+        patch_db["id"] = self.patches.ids
+        patch_db["min_x"] = self.patches.min_x
+        patch_db["min_y"] = self.patches.min_y
+        patch_db["brain_id"] = self.brain_id
+        patch_db["section_id"] = self.section_id
         patch_db["patch_index"] = np.arange(len(self.patches))
+        patch_db["check_bg"] = int(self.patches.check_bg)
+        patch_db["is_bg"] = self.patches.is_bg.astype(int)
         patch_db["no_geojson"] = int(self.no_geojson)
         patch_db = patch_db.fillna(0)
         return patch_db
 
+    def detect_background(self, level=BACKGROUND_LEVEL, bg_threshold=220, min_tissue=0.05):
+        """
+        Mark the patches with less than min_tissue tissue as background, from
+        a 2**level downsampled level of the section (built if missing). The
+        labeling engines skip background patches.
+        """
+        thumb = open_level(self.path_config, self.store, level)
+        mask = tissue_mask(thumb, bg_threshold)
+        fraction = tissue_fraction(
+            mask, self.patches.min_x, self.patches.min_y, self.patch_size, 2**level
+        )
+        self.patches.tissue_fraction = fraction
+        self.patches.is_bg = fraction < min_tissue
+        self.patches.check_bg = True
+        return self.patches.is_bg
+
+    def rasterize_labels(self):
+        """
+        Burn the region polygons into a uint16 label mask of the whole section,
+        the region id of every pixel and 0 outside the regions. The mask is
+        written strip by strip to a zarr store whose chunks tile the patch
+        grid, so the mask of a patch is a chunk-aligned slice of it.
+        Returns the store path.
+        """
+        path = self.path_config.label_store_path()
+        chunk = int(np.gcd(self.patch_size, self.stride))
+        masks = za.open(
+            path, mode="w", shape=(self.h, self.w), chunks=(chunk, chunk), dtype=np.uint16
+        )
+        edges = polygon_edges(self.region_polygons)
+        values = np.asarray(self.tree_region_ids).astype(np.int64)
+        for row0 in range(0, self.h, chunk):
+            rows = min(chunk, self.h - row0)
+            masks[row0 : row0 + rows] = rasterize(edges, values, (rows, self.w), row0)
+        masks.attrs.update(
+            {"patch_size": self.patch_size, "stride": self.stride, "complete": True}
+        )
+        return path
+
     def get_region_id(self, region_poly_tree_idx) -> str | None:
-        if self.p_graph is not None:
+        if not self.no_geojson:
             if region_poly_tree_idx < len(self.region_polygons):
-                return self.p_graph.geodf.iloc[region_poly_tree_idx]["region_id"]
+                return self.tree_region_ids[region_poly_tree_idx]
         return None
 
     def get_region_weightage(self, region_poly_tree_idx, patch_poly_idx):
-        # Get the region polygon and the patch polygon
-        region_poly = self.region_polygons[region_poly_tree_idx]
+        """
+        Coverage of a patch by a region. region_poly_tree_idx is the tree index
+        of a region polygon, or a list of the tree indices of the polygons of
+        one region, which are then measured by their union.
+        """
+        region_poly_tree_idx = sorted(np.atleast_1d(region_poly_tree_idx).tolist())
+        # Get the patch polygon
         patch_poly = self.patch_polygons[patch_poly_idx]
         # Get the region ID
-        region_id = self.get_region_id(region_poly_tree_idx)
+        region_id = self.get_region_id(region_poly_tree_idx[0])
         if region_id is not None:
             region_id = int(region_id)
         try:
-            # Calculate the intersection region
-            patch_region = region_poly.intersection(patch_poly)
             # Discretize the patch region to avoid floating point errors
             discretize = lambda x: np.round(x)
-            # Transform the patch region to a discrete grid
-            patch_region = shapely.transform(patch_region, discretize)
+            # Calculate the intersection region of every polygon of the region
+            # and transform it to a discrete grid
+            patch_regions = [
+                shapely.transform(self.region_polygons[idx].intersection(patch_poly), discretize)
+                for idx in region_poly_tree_idx
+            ]
+            # Polygons of one region may overlap, so measure their union
+            if len(patch_regions) == 1:
+                patch_region = patch_regions[0]
+            else:
+                patch_region = shapely.union_all(patch_regions)
             # Calculate the intersection area
             intersection_ratio = patch_region.area / (patch_poly.area)
             # Get the Patch object
@@ -161,8 +334,8 @@ class PatchDB(object):
                 # Translate the intersection region to the origin of the patch
                 patch_region = shapely.affinity.translate(
                     patch_region,
-                    xoff=-self.patches[patch_poly_idx].min_x,
-                    yoff=self.patches[patch_poly_idx].min_y,
+                    xoff=-patch.min_x,
+                    yoff=patch.min_y,
                 )
                 if region_id not in patch.labels:
                     # Store the region ID as label in the patch object
@@ -193,16 +366,16 @@ class PatchDB(object):
             ]
             if len(region_poly_tree_idx) == 0:
                 return {}
-            region_ids = [
-                get_region_id(region_tree_idx)
-                for region_tree_idx in region_poly_tree_idx
-            ]
-            labels = {k: 0 for k in region_ids}
-            for region_id, region_tree_idx in zip(region_ids, region_poly_tree_idx):
-                labels[region_id] = get_region_weightage(
-                    region_tree_idx, patch_poly_idx
+            # Group the polygons by region, a region is weighted once
+            region_tree_idxs = {}
+            for region_tree_idx in region_poly_tree_idx:
+                region_tree_idxs.setdefault(get_region_id(region_tree_idx), []).append(
+                    region_tree_idx
                 )
-            return labels
+            return {
+                region_id: get_region_weightage(tree_idxs, patch_poly_idx)
+                for region_id, tree_idxs in region_tree_idxs.items()
+            }
         else:
             return {}
 
@@ -216,12 +389,35 @@ class PatchDB(object):
             get_region_weightage=self.get_region_weightage,
         )
 
-    @staticmethod
-    def populate_labels(row, get_labels):
-        labels = get_labels(row["patch_index"])
-        for k, v in labels.items():
-            row[str(k)] = v
-        return row
+    def label_columns_for(self, region_ids):
+        """
+        Label columns (the nomenclature ids followed by any unknown region id)
+        and the column position of each of the given region ids
+        """
+        label_columns = list(self.nomenclature.label_columns)
+        region_ids = np.asarray([str(r) for r in region_ids], dtype=object)
+        column_pos = self.nomenclature.column_index.get_indexer(region_ids)
+        unknown = pd.unique(region_ids[column_pos < 0])
+        if len(unknown) > 0:
+            label_columns.extend(unknown)
+            column_pos = pd.Index(label_columns).get_indexer(region_ids)
+        return label_columns, column_pos
+
+    def label_patches_rowwise(self):
+        """Row-wise labeling engine, one get_labels call per patch"""
+        get_labels = self.worker()
+        patch_idx, region_ids, coverage = [], [], []
+        for idx in np.flatnonzero(~self.patches.is_bg).tolist():
+            for region_id, ratio in get_labels(idx).items():
+                patch_idx.append(idx)
+                region_ids.append(region_id)
+                coverage.append(ratio)
+        label_columns, column_pos = self.label_columns_for(region_ids)
+        labels = sp.csr_matrix(
+            (coverage, (patch_idx, column_pos)),
+            shape=(len(self.patches), len(label_columns)),
+        )
+        return labels, label_columns
 
     @staticmethod
     def normalize_patch(patch):
@@ -233,9 +429,13 @@ class PatchDB(object):
         return patch
 
     def remove_patch(self, patch_idx_list):
-        for patch_idx in patch_idx_list:
-            del self.patches[patch_idx]
+        keep = np.ones(len(self.patches), dtype=bool)
+        keep[np.asarray(patch_idx_list, dtype=int)] = False
+        self.patches.remove(patch_idx_list)
+        self.labels = self.labels[keep]
         self.patch_db.drop(patch_idx_list, inplace=True)
+        # Keep the frame index aligned with the grid positions
+        self.patch_db.reset_index(drop=True, inplace=True)
 
     def qc_check(self, tol=0.05):
         """
@@ -243,41 +443,199 @@ class PatchDB(object):
         label percentage greater than tol. Normalizes the patches that have a
         label percentage greater than 1 and less than 1 + tol.
         """
-        # Extract Label Columns
-        labels = list(self.patch_db.columns)
-        not_labels = [
-            "id",
-            "min_x",
-            "min_y",
-            "brain_id",
-            "section_id",
-            "check_bg",
-            "is_bg",
-            "has_geojson",
-            "no_geojson",
-        ]
-        labels = [l for l in labels if l not in not_labels]
         # Calculate Label Area Percentage
-        pct = self.patch_db[labels].sum(axis=1) # type: ignore
+        pct = np.asarray(self.labels.sum(axis=1)).ravel()
         # Calculate Rejection Tolerance
         rejection_tol = 1 + tol
         # Rejected Patch Index Extraction
-        rejected_patches = self.patch_db[pct > rejection_tol].index.tolist()
+        rejected_patches = np.flatnonzero(pct > rejection_tol)
         # Abnormal Patch Index Extraction
-        abnormal_patches = self.patch_db[pct > 1][pct < rejection_tol].index.tolist()
+        abnormal_patches = np.flatnonzero((pct > 1) & (pct < rejection_tol))
         for patch_idx in abnormal_patches:
-            self.patches[patch_idx] = self.normalize_patch(self.patches[patch_idx])
-        self.remove_patch(rejected_patches)
+            self.normalize_patch(self.patches[patch_idx])
+        # Normalize the abnormal rows of the label matrix
+        scale = np.ones(len(pct))
+        scale[abnormal_patches] = 1 / pct[abnormal_patches]
+        self.labels = sp.diags(scale).dot(self.labels).tocsr()
+        self.remove_patch(rejected_patches.tolist())
 
-    def populate_db(self):
-        get_labels = self.worker()
+    @staticmethod
+    def _pairwise_intersection(region_polys, patch_polys):
+        """Intersect two aligned geometry arrays, isolating GEOS failures per pair"""
+        try:
+            return shapely.intersection(region_polys, patch_polys)
+        except GEOSException:
+            patch_regions = np.empty(len(region_polys), dtype=object)
+            for i, (region_poly, patch_poly) in enumerate(zip(region_polys, patch_polys)):
+                try:
+                    patch_regions[i] = region_poly.intersection(patch_poly)
+                except GEOSException:
+                    patch_regions[i] = Polygon()
+            return patch_regions
+
+    def label_patches(self):
+        """
+        Bulk labeling engine. Runs a single STRtree query for all patch polygons,
+        intersects the resulting (patch, region) pairs with shapely's vectorized
+        ufuncs and fills a sparse patch x region coverage matrix.
+
+        Returns the CSR coverage matrix and its label columns. The patch objects are
+        updated with labels, region polygons and region areas as in
+        get_region_weightage. A region made of several polygons gets the
+        coverage and polygon of the union of its polygons in the patch, as in
+        the row-wise and raster engines.
+        """
+        n_patches = len(self.patch_polygons)
+        if self.no_geojson or len(self.region_polygons) == 0:
+            label_columns, _ = self.label_columns_for([])
+            return sp.csr_matrix((n_patches, len(label_columns))), label_columns
+
+        region_polys = np.asarray(self.region_polygons, dtype=object)
+        patch_polys = np.asarray(self.patch_polygons, dtype=object)
+        region_tree = shapely.STRtree(region_polys)
+        foreground = np.flatnonzero(~self.patches.is_bg)
+        patch_idx, region_idx = region_tree.query(patch_polys[foreground])
+        patch_idx = foreground[patch_idx]
+
+        # Map every region polygon to its label column
+        region_ids = self.tree_region_ids
+        label_columns, column_pos = self.label_columns_for(region_ids)
+        shape = (n_patches, len(label_columns))
+        if len(patch_idx) == 0:
+            return sp.csr_matrix(shape), label_columns
+
+        # Intersect, discretize and measure all pairs at once
+        patch_regions = self._pairwise_intersection(
+            region_polys[region_idx], patch_polys[patch_idx]
+        )
+        patch_regions = shapely.transform(patch_regions, np.round)
+        areas = shapely.area(patch_regions)
+        patch_areas = shapely.area(patch_polys[patch_idx])
+
+        # Translate the non-empty intersections to the origin of their patch
+        hit = areas > 0
+        if not hit.any():
+            return sp.csr_matrix(shape), label_columns
+        patch_idx, region_idx = patch_idx[hit], region_idx[hit]
+        patch_regions, patch_areas = patch_regions[hit], patch_areas[hit]
+        ratios = areas[hit] / patch_areas
+        offsets = np.stack(
+            [-self.patches.min_x[patch_idx], self.patches.min_y[patch_idx]], axis=1
+        )
+        coords, coord_idx = shapely.get_coordinates(patch_regions, return_index=True)
+        patch_regions = shapely.set_coordinates(
+            patch_regions, coords + offsets[coord_idx]
+        )
+
+        # Group the pairs by (patch, region) so split regions are merged
+        order = np.lexsort((region_idx, column_pos[region_idx], patch_idx))
+        keys = np.stack([patch_idx, column_pos[region_idx]], axis=1)[order]
+        starts = np.flatnonzero(
+            np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)]
+        )
+        ends = np.r_[starts[1:], len(order)]
+        group_ratios = np.empty(len(starts))
+        for n, (start, end) in enumerate(zip(starts, ends)):
+            group = order[start:end]
+            patch = self.patches[patch_idx[group[0]]]
+            region_id = int(region_ids[region_idx[group[0]]])
+            if len(group) == 1:
+                patch_region = patch_regions[group[0]]
+                group_ratios[n] = ratios[group[0]]
+            else:
+                # Polygons of one region may overlap, so measure their union
+                patch_region = shapely.union_all(patch_regions[group])
+                group_ratios[n] = patch_region.area / patch_areas[group[0]]
+            if region_id not in patch.labels:
+                patch.labels.append(region_id)
+            patch.region_polygons[region_id] = json.loads(
+                shapely.to_geojson(patch_region)
+            )
+            patch.region_areas[region_id] = float(group_ratios[n])
+        coverage = sp.csr_matrix(
+            (group_ratios, (keys[starts, 0], keys[starts, 1])), shape=shape
+        )
+        return coverage, label_columns
+
+    def section_raster(self, scale=RASTER_SCALE):
+        """SectionRaster of the region polygons, built once per scale"""
+        if scale not in self._rasters:
+            label_columns, column_pos = self.label_columns_for(self.tree_region_ids)
+            self._rasters[scale] = (
+                SectionRaster(self.region_polygons, column_pos, len(label_columns), scale),
+                label_columns,
+            )
+        return self._rasters[scale]
+
+    def label_patches_raster(self, scale=RASTER_SCALE):
+        """
+        Raster labeling engine. Coverage is reduced from the section raster
+        (see SectionRaster) and agrees with the polygon engine to within
+        about scale / patch_size per label, regions thinner than a raster
+        pixel can be missed. Patches get their labels and region areas but
+        no region polygons.
+        """
+        raster, label_columns = self.section_raster(scale)
+        foreground = np.flatnonzero(~self.patches.is_bg)
+        coverage = raster.coverage(
+            self.patches.min_x[foreground],
+            self.patches.min_y[foreground],
+            self.patch_size,
+            self.stride,
+        ).tocoo()
+        labels = sp.csr_matrix(
+            (coverage.data, (foreground[coverage.row], coverage.col)),
+            shape=(len(self.patches), len(label_columns)),
+        )
+        labels.eliminate_zeros()
+        for idx in np.flatnonzero(np.diff(labels.indptr)).tolist():
+            row = slice(labels.indptr[idx], labels.indptr[idx + 1])
+            patch = self.patches[idx]
+            for col, ratio in zip(labels.indices[row].tolist(), labels.data[row].tolist()):
+                region_id = int(label_columns[col])
+                patch.labels.append(region_id)
+                patch.region_areas[region_id] = ratio
+        return labels, label_columns
+
+    def populate_db(self, engine="bulk", raster_scale=RASTER_SCALE):
+        """
+        Populate the patch database. The patch metadata goes to self.patch_db
+        and the label coverage to the sparse self.labels matrix, whose columns
+        are self.label_columns. Use dense_db for the wide frame.
+
+        Parameters
+        ---
+        - engine: str, "bulk" for the vectorized labeling engine (label_patches),
+          "rowwise" for the per-patch get_labels path or "raster" for the
+          raster coverage engine (label_patches_raster)
+        - raster_scale: int, full resolution pixels per raster pixel of the
+          raster engine
+
+        Patches marked by detect_background are not labeled.
+        """
+        if engine not in ("bulk", "rowwise", "raster"):
+            raise ValueError(f"Unknown labeling engine {engine!r}")
         patch_db = self.create_db()
-        if self.p_graph is not None:
-            feeder = partial(self.populate_labels, get_labels=get_labels)
-            patch_db = patch_db.apply(feeder, axis=1)
+        if not self.no_geojson and engine == "rowwise":
+            self.labels, self.label_columns = self.label_patches_rowwise()
+        elif engine == "raster":
+            self.labels, self.label_columns = self.label_patches_raster(raster_scale)
+        else:
+            self.labels, self.label_columns = self.label_patches()
         patch_db = patch_db.drop(columns=["patch_index"])
         self.patch_db = patch_db
 
+    def result(self):
+        """Compact PatchDBResult of the populated database, see PatchDBResult"""
+        return PatchDBResult(self)
+
+    def dense_db(self):
+        """Patch metadata with one float column per label column"""
+        labels = pd.DataFrame(
+            self.labels.toarray(), columns=self.label_columns, index=self.patch_db.index
+        )
+        return pd.concat([self.patch_db, labels], axis=1)
+
 
 # if __name__ == "__main__":
 #     brain_id=141
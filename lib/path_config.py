@@ -14,6 +14,10 @@ class PathConfig(object):
         self.img_path_template = Template('/storage/BrainSAM/data/img/highres/$brain_id/$section_id.jp2')
         self.metadata_path_template = Template('/storage/BrainSAM/data/metadata/$brain_id/$section_id.json')
         self.zarr_store_path_template = Template('zarr_n5/optimum_1024/$brain_id/$section_id.n5')
+        self.pyramid_store_path_template = Template('zarr_n5/optimum_1024/$brain_id/${section_id}_l${level}.n5')
+        self.label_store_path_template = Template('zarr_n5/optimum_1024/$brain_id/${section_id}_labels.n5')
+        self.region_index_path_template = Template('/storage/BrainSAM/data/region_index/$brain_id/$section_id.npz')
+        self.region_patches_path_template = Template('/storage/BrainSAM/data/region_index/$brain_id/region_patches.sqlite')
     
     def gjson_dir(self):
         return self.gjson_dir_path.substitute(brain_id=self.brain_id)
@@ -38,4 +42,20 @@ class PathConfig(object):
     
     def zarr_store_path(self):
         return self.zarr_store_path_template.substitute(brain_id=self.brain_id, section_id=self.section_id)
-    
\ No newline at end of file
+    
+
+    def pyramid_store_path(self, level):
+        """Store of the section downsampled by 2**level"""
+        return self.pyramid_store_path_template.substitute(brain_id=self.brain_id, section_id=self.section_id, level=level)
+
+    def label_store_path(self):
+        """Store of the section's rasterized region labels"""
+        return self.label_store_path_template.substitute(brain_id=self.brain_id, section_id=self.section_id)
+
+    def region_index_path(self):
+        """Cached rotated region polygons and bounds of the section"""
+        return self.region_index_path_template.substitute(brain_id=self.brain_id, section_id=self.section_id)
+
+    def region_patches_path(self):
+        """Region to patch inverted index of the brain"""
+        return self.region_patches_path_template.substitute(brain_id=self.brain_id)
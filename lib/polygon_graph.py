@@ -2,10 +2,17 @@ import networkx as nx
 from shapely import GEOSException 
 import geopandas as gpd 
 import numpy as np
+import pandas as pd
 from functools import partial
 import json
+import shapely
 from shapely.geometry import Polygon, MultiPolygon, shape
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class InvalidGeojsonError(Exception):
     pass
 
@@ -16,15 +23,18 @@ class PolygonGraph(object):
     Parameters
     ---
     - geojson_path: str, path to the geojson file
+    - bulk_edges: bool, build the edges from a single STRtree query over all polygons
+      instead of three queries per polygon
 
     Attributes
     ---
     - G: networkx.Graph, the graph of the geojson file
+    - tree_region_ids: numpy.ndarray, the region id of every polygon by its tree index
 
     Methods
     ---
     - graphml: Save the graph as a graphml file
-    - get_adjacency_matrix: Get the adjacency matrix of the graph. The nodes are sorted in the adjacency matrix by their region ids.
+    - get_adjacency_matrix: Get the adjacency matrix of the graph, dense or scipy.sparse. The nodes are sorted in the adjacency matrix by their region ids.
 
     Note
     ---
@@ -34,11 +44,11 @@ class PolygonGraph(object):
 
 
     """
-    def __init__(self, geojson_path):
+    def __init__(self, geojson_path, bulk_edges=True):
         self.geojson_path = geojson_path
+        self.bulk_edges = bulk_edges
         # Load the geojson file and parse the properties of the features
-        with open(geojson_path, "r") as f:
-            self.json = json.load(f)
+        self.json = self._load_json(geojson_path)
         
         if not isinstance(self.json, dict):
             raise InvalidGeojsonError("Invalid geojson file")
@@ -93,28 +103,9 @@ class PolygonGraph(object):
         self._add_edges()
 
     @staticmethod
-    def _parse_feature_properties(row):
-        """Convert the properties string to a dictionary"""
-        props = row["data"]
-        prop_data = json.loads(props)
-        row["data"] = prop_data
-        return row
-
-    @staticmethod
-    def _expand_data_column(row, prop_keys, prop_keys_):
-        """Expand the properties dictionary to columns"""
-        props = row["data"]
-        for k, v in zip(prop_keys, prop_keys_):
-            try:
-                row[v] = props[k]
-            except KeyError:
-                row[v] = None
-        return row
-
-    @staticmethod
-    def _tree_idx_to_region_id(geodf, tree_idx: int) -> str:
+    def _tree_idx_to_region_id(tree_region_ids, tree_idx: int) -> str:
         """Map the tree index to the region id"""
-        return geodf.loc[geodf["tree_idx"] == tree_idx, "region_id"].values[0]
+        return tree_region_ids[tree_idx]
 
     @staticmethod
     def add_edges_based_on_proximity(row, G, tree, region_id_mapper):
@@ -136,26 +127,84 @@ class PolygonGraph(object):
                 G.add_edge(row["region_id"], region_id_mapper(c))
         return row
 
+    @staticmethod
+    def _load_json(path):
+        """Read a json file, with orjson when it is installed"""
+        with open(path, "rb") as f:
+            raw = f.read()
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+    @staticmethod
+    def _dump_json(obj):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj)
+
     def _parse_geojson(self):
-        """Parse the geojson file and create a geodataframe"""
-        data = gpd.read_file(self.geojson_path, on_invalid='warn')
-        data = data.dropna(subset=["geometry"])
-        expander = partial(
-            self._expand_data_column,
-            prop_keys=self.prop_keys,
-            prop_keys_=self.prop_keys_,
+        """Create the geodataframe from the already loaded geojson in one pass"""
+        features = self.json["features"]
+        # Geometries are parsed by GEOS in one vectorized call. As with
+        # read_file, invalid geometries are warned about and dropped
+        geometries = shapely.from_geojson(
+            [
+                None if feature.get("geometry") is None else self._dump_json(feature["geometry"])
+                for feature in features
+            ],
+            on_invalid="warn",
         )
-        data = data.apply(self._parse_feature_properties, axis=1)
-        data = data.apply(expander, axis=1)
+        # Properties other than data keep their own columns
+        properties = [feature.get("properties") or {} for feature in features]
+        columns = {}
+        for props in properties:
+            for k in props:
+                if k != "data" and k not in columns:
+                    columns[k] = [p.get(k) for p in properties]
+        columns["geometry"] = geometries
+        datas = [props.get("data") or {} for props in properties]
+        for k, k_ in zip(self.prop_keys, self.prop_keys_):
+            columns[k_] = [d.get(k) for d in datas]
+        crs = self.json.get("crs", {}).get("properties", {}).get("name", "EPSG:4326")
+        data = gpd.GeoDataFrame(pd.DataFrame(columns), geometry="geometry", crs=crs)
+        data = data.dropna(subset=["geometry"])
         data["tree_idx"] = np.arange(data.shape[0])
+        # Region id of every tree index, for O(1) lookups
+        self.tree_region_ids = data["region_id"].astype(str).to_numpy(dtype=object)
         strTree = data["geometry"].sindex
-        data = data.drop(columns=["data"])
         self.geodf = data
         self.geo_tree = strTree
 
+    def _bulk_edges(self):
+        """
+        Region id pairs of all intersecting polygons from one STRtree query.
+        Intersects covers overlaps and touches, self and same-region pairs are
+        dropped and every pair is returned once.
+        """
+        left, right = self.geo_tree.query(
+            self.geodf["geometry"].values, predicate="intersects"
+        )
+        codes, region_ids = pd.factorize(self.tree_region_ids)
+        left, right = codes[left], codes[right]
+        different = left != right
+        pairs = np.stack(
+            [np.minimum(left, right)[different], np.maximum(left, right)[different]],
+            axis=1,
+        )
+        pairs = np.unique(pairs, axis=0)
+        region_ids = np.asarray(region_ids, dtype=object)
+        return list(zip(region_ids[pairs[:, 0]], region_ids[pairs[:, 1]]))
+
     def _add_edges(self):
         """Add edges to the graph based on the proximity of the polygons"""
-        region_idx_mapper = partial(self._tree_idx_to_region_id, self.geodf)
+        if self.bulk_edges:
+            try:
+                self.G.add_edges_from(self._bulk_edges())
+                return
+            except GEOSException:
+                # Fall back to the per-polygon queries, which tolerate invalid geometries
+                pass
+        region_idx_mapper = partial(self._tree_idx_to_region_id, self.tree_region_ids)
         add_edges = partial(
             self.add_edges_based_on_proximity,
             G=self.G,
@@ -168,10 +217,13 @@ class PolygonGraph(object):
         """Save the graph as a graphml file"""
         nx.write_graphml(self.G, path)
     
-    def get_adjacency_matrix(self):
-        """Get the adjacency matrix of the graph"""
+    def get_adjacency_matrix(self, sparse=False):
+        """Get the adjacency matrix of the graph, as a scipy.sparse array if sparse"""
         sorted_node_list = sorted(self.G.nodes())
-        return nx.adjacency_matrix(self.G,nodelist=sorted_node_list).todense()
+        adjacency = nx.adjacency_matrix(self.G,nodelist=sorted_node_list)
+        if sparse:
+            return adjacency
+        return adjacency.todense()
 
 
     
@@ -0,0 +1,126 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import zarr as za
+
+# Coarsest pyramid level, 2**5 = 32x
+PYRAMID_LEVELS = 5
+
+
+def downsample_block(block, factor):
+    """
+    Mean over factor x factor pixel blocks of a uint8 block, rounded half to
+    even. Edge blocks are averaged over what exists. Sums are taken in
+    uint32, the block is never copied to floats.
+    """
+    h, w = block.shape[:2]
+    out_h, out_w = -(-h // factor), -(-w // factor)
+    if (out_h * factor, out_w * factor) != (h, w):
+        pad = ((0, out_h * factor - h), (0, out_w * factor - w)) + ((0, 0),) * (block.ndim - 2)
+        block = np.pad(block, pad)
+    sums = block.reshape(out_h, factor, out_w, factor, *block.shape[2:]).sum(
+        axis=(1, 3), dtype=np.uint32
+    )
+    rows = np.minimum(factor, h - np.arange(out_h) * factor)
+    cols = np.minimum(factor, w - np.arange(out_w) * factor)
+    counts = np.outer(rows, cols).astype(np.uint32)
+    if block.ndim > 2:
+        counts = counts[..., None]
+    mean, rest = np.divmod(sums, counts)
+    # Round half to even, as np.round does
+    mean += (2 * rest > counts) | ((2 * rest == counts) & (mean % 2 == 1))
+    return mean.astype(np.uint8)
+
+
+def level_store_path(store_path, level):
+    """Path of the 2**level downsampled store next to a full resolution store"""
+    if level == 0:
+        return store_path
+    root, ext = os.path.splitext(store_path.rstrip("/"))
+    return f"{root}_l{level}{ext}"
+
+
+def level_box(min_x, min_y, max_x, max_y, level):
+    """Pixel box of a full resolution box in a 2**level store, as (y0, y1, x0, x1)"""
+    factor = 2**level
+    return (
+        min_y // factor,
+        -(-max_y // factor),
+        min_x // factor,
+        -(-max_x // factor),
+    )
+
+
+class PyramidBuilder(object):
+    """
+    Build the 2x downsampled levels of a section next to its store. This is
+    the only writer of level stores, background detection reads its levels
+    through it too (see background.open_level).
+
+    Level n is built from level n - 1, one output chunk per task, so every
+    task reads a 2x2 block of source chunks and writes one chunk. Chunk rows
+    are processed in order and the number of finished rows is kept in the
+    level's attributes, an interrupted build resumes from the first
+    unfinished row. A level is marked complete once every row is written.
+
+    Parameters
+    ---
+    - path_config: PathConfig, the section to build
+    - levels: int, coarsest level to build
+    - workers: int, threads writing chunks in parallel
+    """
+
+    def __init__(self, path_config, levels=PYRAMID_LEVELS, workers=8):
+        self.path_config = path_config
+        self.levels = levels
+        self.workers = workers
+
+    def open_target(self, path, src, level):
+        shape = (-(-src.shape[0] // 2), -(-src.shape[1] // 2)) + src.shape[2:]
+        try:
+            dst = za.open(path, mode="r+")
+            # Only resume stores this builder wrote, with the source's chunk grid
+            if (
+                dst.shape == shape
+                and dst.chunks == src.chunks
+                and dst.attrs.get("level") == level
+                and "rows_done" in dst.attrs
+            ):
+                return dst
+        except (za.errors.PathNotFoundError, KeyError, ValueError):
+            pass
+        dst = za.open(path, mode="w", shape=shape, chunks=src.chunks, dtype=src.dtype)
+        dst.attrs.update({"level": level, "rows_done": 0, "complete": False})
+        return dst
+
+    @staticmethod
+    def write_chunk(src, dst, cy, cx):
+        ch, cw = dst.chunks[:2]
+        block = np.asarray(
+            src[2 * cy * ch : 2 * (cy + 1) * ch, 2 * cx * cw : 2 * (cx + 1) * cw]
+        )
+        out = downsample_block(block, 2)
+        dst[cy * ch : cy * ch + out.shape[0], cx * cw : cx * cw + out.shape[1]] = out
+
+    def build_level(self, src, level, executor):
+        path = self.path_config.pyramid_store_path(level)
+        dst = self.open_target(path, src, level)
+        if dst.attrs.get("complete", False):
+            return dst
+        n_rows, n_cols = dst.cdata_shape[:2]
+        for cy in range(dst.attrs.get("rows_done", 0), n_rows):
+            list(executor.map(lambda cx: self.write_chunk(src, dst, cy, cx), range(n_cols)))
+            dst.attrs["rows_done"] = cy + 1
+        dst.attrs["complete"] = True
+        return dst
+
+    def build(self):
+        """Build every missing or unfinished level, returns the level paths"""
+        src = za.open(self.path_config.zarr_store_path(), mode="r")
+        paths = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for level in range(1, self.levels + 1):
+                src = self.build_level(src, level, executor)
+                paths.append(self.path_config.pyramid_store_path(level))
+        return paths
@@ -0,0 +1,182 @@
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+# Full resolution pixels per raster pixel of the raster coverage engine
+RASTER_SCALE = 8
+
+
+def label_store_path(store_path):
+    """Path of the section label mask store next to a full resolution store"""
+    root, ext = os.path.splitext(store_path.rstrip("/"))
+    return f"{root}_labels{ext}"
+
+
+def polygon_edges(polygons, scale=1):
+    """
+    Non-horizontal edges of the polygon rings in pixel coordinates of an image
+    downsampled by `scale`, as (owner, x0, y0, x1, y1) arrays where owner is
+    the position of the edge's polygon. Polygons are in the geojson frame,
+    where image rows are negative y.
+    """
+    parts, part_owner = shapely.get_parts(np.asarray(polygons, dtype=object), return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    px = coords[:, 0] / scale
+    py = -coords[:, 1] / scale
+    # Rings are closed, so consecutive coordinates of a ring are its edges
+    same = coord_ring[1:] == coord_ring[:-1]
+    owner = part_owner[ring_part[coord_ring[:-1][same]]]
+    x0, y0 = px[:-1][same], py[:-1][same]
+    x1, y1 = px[1:][same], py[1:][same]
+    keep = y0 != y1
+    return owner[keep], x0[keep], y0[keep], x1[keep], y1[keep]
+
+
+def scanline_spans(edges, row0, row1):
+    """
+    Even-odd scanline fill of the rows [row0, row1). A pixel is inside a
+    polygon when its center is, so every (polygon, row) has an even number of
+    edge crossings. Returns the filled runs as (owner, row, col0, col1) with
+    col1 exclusive, sorted by owner.
+    """
+    owner, x0, y0, x1, y1 = edges
+    ylo, yhi = np.minimum(y0, y1), np.maximum(y0, y1)
+    # Rows whose center lies in [ylo, yhi)
+    first = np.maximum(np.ceil(ylo - 0.5), row0).astype(np.int64)
+    last = np.minimum(np.ceil(yhi - 0.5), row1).astype(np.int64)
+    counts = np.clip(last - first, 0, None)
+    edge = np.repeat(np.arange(len(counts)), counts)
+    rows = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = (rows + 0.5 - y0[edge]) / (y1[edge] - y0[edge])
+    xs = x0[edge] + t * (x1[edge] - x0[edge])
+    order = np.lexsort((xs, rows, owner[edge]))
+    # Every (owner, row) group is even, so crossings pair up globally
+    start, stop = order[0::2], order[1::2]
+    cols0 = np.ceil(xs[start] - 0.5).astype(np.int64)
+    cols1 = np.ceil(xs[stop] - 0.5).astype(np.int64)
+    filled = cols1 > cols0
+    return owner[edge[start]][filled], rows[start][filled], cols0[filled], cols1[filled]
+
+
+def union_runs(keys, rows, cols0, cols1):
+    """
+    Merge the runs that share a key and a row where they overlap, so pixels
+    covered by several polygons of one label are kept once. Returns the
+    merged runs as (key, row, col0, col1), sorted by key and row.
+    """
+    filled = cols1 > cols0
+    keys, rows, cols0, cols1 = keys[filled], rows[filled], cols0[filled], cols1[filled]
+    order = np.lexsort((cols0, rows, keys))
+    keys, rows, cols0, cols1 = keys[order], rows[order], cols0[order], cols1[order]
+    if len(keys) == 0:
+        return keys, rows, cols0, cols1
+    new_group = np.r_[True, (keys[1:] != keys[:-1]) | (rows[1:] != rows[:-1])]
+    # Running end of every (key, row) group, offset so groups never mix
+    offset = (np.cumsum(new_group) - 1) * (int(cols1.max()) + 1)
+    ends = np.maximum.accumulate(cols1 + offset) - offset
+    new_run = new_group.copy()
+    new_run[1:] |= cols0[1:] > ends[:-1]
+    starts = np.flatnonzero(new_run)
+    last = np.r_[starts[1:], len(keys)] - 1
+    return keys[starts], rows[starts], cols0[starts], ends[last]
+
+
+def rasterize(edges, values, shape, row0=0, dtype=np.uint16):
+    """
+    Burn polygons into a label image of `shape` covering the rows starting at
+    row0. values holds the label of every polygon, 0 is left for unlabeled
+    pixels and later polygons are burned over earlier ones.
+    """
+    out = np.zeros(shape, dtype=dtype)
+    owner, rows, cols0, cols1 = scanline_spans(edges, row0, row0 + shape[0])
+    cols0 = np.clip(cols0, 0, shape[1])
+    cols1 = np.clip(cols1, 0, shape[1])
+    labels = np.asarray(values, dtype=dtype)[owner]
+    for row, c0, c1, label in zip(
+        (rows - row0).tolist(), cols0.tolist(), cols1.tolist(), labels.tolist()
+    ):
+        out[row, c0:c1] = label
+    return out
+
+
+class SectionRaster(object):
+    """
+    Region polygons of a section rasterized once at 1/scale resolution and
+    kept as the scanline runs of every label column. Patch coverage is a
+    block reduction of the runs: they are summed into per-cell pixel counts,
+    then every patch adds up the cells it covers. Overlapping polygons of one
+    label are merged, so their shared pixels count once, as the polygon
+    engines measure the union of a region's polygons. A new patch size or
+    stride only redoes the reduction, never the rasterization.
+
+    Parameters
+    ---
+    - polygons: list[shapely.Geometry], region polygons in the geojson frame
+    - columns: numpy.ndarray, label column of every polygon
+    - n_columns: int, number of label columns
+    - scale: int, full resolution pixels per raster pixel
+    """
+
+    def __init__(self, polygons, columns, n_columns, scale=RASTER_SCALE):
+        self.scale = scale
+        self.n_columns = n_columns
+        edges = polygon_edges(polygons, scale)
+        # Patches start at the image origin, nothing above or left of it is used
+        n_rows = int(np.ceil(max(edges[2].max(), edges[4].max()))) if len(edges[0]) else 0
+        owner, rows, cols0, cols1 = scanline_spans(edges, 0, n_rows)
+        self.columns, self.rows, self.cols0, self.cols1 = union_runs(
+            np.asarray(columns, dtype=np.int64)[owner],
+            rows,
+            np.maximum(cols0, 0),
+            np.maximum(cols1, 0),
+        )
+
+    def cell_counts(self, cell, n_cell_cols):
+        """Raster pixels of every label column in each cell x cell block, as CSR (cells, columns)"""
+        # Split every run at the cell borders it crosses
+        first, last = self.cols0 // cell, (self.cols1 - 1) // cell
+        counts = np.where(self.cols1 > self.cols0, last - first + 1, 0)
+        run = np.repeat(np.arange(len(counts)), counts)
+        cell_col = first[run] + np.arange(len(run)) - np.repeat(np.cumsum(counts) - counts, counts)
+        pixels = np.minimum(self.cols1[run], (cell_col + 1) * cell) - np.maximum(
+            self.cols0[run], cell_col * cell
+        )
+        cell_idx = (self.rows[run] // cell) * n_cell_cols + cell_col
+        n_cell_rows = int(self.rows.max()) // cell + 1 if len(self.rows) else 0
+        return sp.csr_matrix(
+            (pixels, (cell_idx, self.columns[run])),
+            shape=(n_cell_rows * n_cell_cols, self.n_columns),
+        )
+
+    def coverage(self, min_x, min_y, patch_size, stride):
+        """
+        Fraction of every patch (full resolution origins min_x, min_y) covered
+        by each label column, as CSR (patches, columns)
+        """
+        cell_px = int(np.gcd(patch_size, stride))
+        if cell_px % self.scale:
+            raise ValueError(
+                f"gcd(patch_size, stride) = {cell_px} is not a multiple of the raster scale {self.scale}"
+            )
+        cell = cell_px // self.scale
+        k = patch_size // cell_px
+        max_col = max(int(self.cols1.max()) if len(self.cols1) else 0, 1)
+        n_cell_cols = max(-(-max_col // cell), int(np.max(min_x, initial=0)) // cell_px + k)
+        counts = self.cell_counts(cell, n_cell_cols)
+        # Cells of every patch, dropping those past the rasterized rows
+        dy, dx = np.divmod(np.arange(k * k), k)
+        cell_rows = (np.asarray(min_y) // cell_px)[:, None] + dy
+        cell_cols = (np.asarray(min_x) // cell_px)[:, None] + dx
+        patch_idx = np.repeat(np.arange(len(min_x)), k * k).reshape(-1, k * k)
+        inside = cell_rows < counts.shape[0] // n_cell_cols
+        members = sp.csr_matrix(
+            (
+                np.ones(inside.sum()),
+                (patch_idx[inside], (cell_rows * n_cell_cols + cell_cols)[inside]),
+            ),
+            shape=(len(min_x), counts.shape[0]),
+        )
+        return (members @ counts) * (self.scale / patch_size) ** 2
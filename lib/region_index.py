@@ -0,0 +1,210 @@
+import os
+import threading
+from functools import cached_property
+
+import numpy as np
+import shapely
+import zarr as za
+
+from .manifest import file_sha256
+from .path_config import PathConfig
+from .polygon_graph import PolygonGraph, InvalidGeojsonError
+
+# Bump when the stored layout or the rotation of the geometries changes
+INDEX_VERSION = 1
+
+ROTATION_MAP = {270: -90, 90: 90, 180: 180, 0: 0}
+
+
+class SectionRegionIndex(object):
+    """
+    Rotated region polygons of a section as WKB, with their region ids and
+    bounds, persisted next to the metadata of the section.
+
+    The index is keyed on the sha256 of the geojson, its rotation and the
+    image shape the rotation origin is taken from. The geojson is only hashed
+    again when its mtime or size changed. An STRtree over the stored bounds
+    is rebuilt on first query (STRtrees are not serializable), so window
+    queries never parse the geojson or decode more than the candidate
+    polygons.
+
+    Parameters
+    ---
+    - wkb: numpy.ndarray, the WKB of every polygon concatenated as uint8
+    - offsets: numpy.ndarray, start of every polygon in wkb, plus the end
+    - region_ids: numpy.ndarray, region id of every polygon
+    - bounds: numpy.ndarray, (n, 4) bounds of every polygon in the geojson frame
+    - key: dict, geojson hash, rotation, image shape and geojson stat
+    """
+
+    def __init__(self, wkb, offsets, region_ids, bounds, key):
+        self.wkb = wkb
+        self.offsets = offsets
+        self.region_ids = region_ids
+        self.bounds = bounds
+        self.key = key
+
+    def __len__(self):
+        return len(self.region_ids)
+
+    @property
+    def rotation(self):
+        return self.key["rotation"]
+
+    @classmethod
+    def from_polygons(cls, polygons, region_ids, key):
+        blobs = shapely.to_wkb(np.asarray(polygons, dtype=object))
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        wkb = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+        bounds = shapely.bounds(np.asarray(polygons, dtype=object)).reshape(-1, 4)
+        return cls(wkb, offsets, np.asarray(region_ids, dtype=object), bounds, key)
+
+    @classmethod
+    def from_geojson(cls, gjson_path, h, w, key):
+        """Parse and rotate the geojson as PatchDB does"""
+        p_graph = PolygonGraph(gjson_path)
+        rotation = p_graph.json["rotation"]
+        geoms = p_graph.geodf["geometry"].rotate(
+            ROTATION_MAP[rotation], origin=(w / 2, -h / 2)
+        )
+        key = dict(key, rotation=rotation)
+        return cls.from_polygons(geoms.values, p_graph.tree_region_ids, key)
+
+    def save(self, path):
+        """Write the index atomically, so concurrent readers never see a partial file"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                wkb=self.wkb,
+                offsets=self.offsets,
+                region_ids=self.region_ids.astype(str),
+                bounds=self.bounds,
+                **{f"key_{k}": np.asarray(v) for k, v in self.key.items()},
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            key = {
+                k[len("key_") :]: data[k].item() if data[k].ndim == 0 else tuple(data[k].tolist())
+                for k in data.files
+                if k.startswith("key_")
+            }
+            return cls(
+                data["wkb"],
+                data["offsets"],
+                data["region_ids"].astype(object),
+                data["bounds"],
+                key,
+            )
+
+    def geometry(self, idx):
+        return shapely.from_wkb(self.wkb[self.offsets[idx] : self.offsets[idx + 1]].tobytes())
+
+    @cached_property
+    def geometries(self):
+        """All polygons, decoded on first use"""
+        return shapely.from_wkb(
+            [self.wkb[a:b].tobytes() for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+        )
+
+    @cached_property
+    def tree(self):
+        return shapely.STRtree(shapely.box(*self.bounds.T))
+
+    def query(self, bbox):
+        """
+        Region ids of the polygons intersecting bbox = (min_x, min_y, max_x, max_y)
+        in image pixels, where rows grow downwards as in the patch grid
+        """
+        min_x, min_y, max_x, max_y = bbox
+        window = shapely.box(min_x, -max_y, max_x, -min_y)
+        candidates = self.tree.query(window)
+        hits = [
+            idx for idx in candidates.tolist() if shapely.intersects(self.geometry(idx), window)
+        ]
+        return sorted({int(self.region_ids[idx]) for idx in hits})
+
+
+def _geojson_stat(gjson_path):
+    stat = os.stat(gjson_path)
+    return stat.st_mtime, stat.st_size
+
+
+def load_region_index(path_config, h, w, persist=True):
+    """
+    SectionRegionIndex of a section, read from its cache when the geojson
+    and image shape still match and rebuilt (and persisted) otherwise.
+    Raises InvalidGeojsonError when the section has no usable geojson.
+    """
+    gjson_path = path_config.gjson_path()
+    index_path = path_config.region_index_path()
+    mtime, size = _geojson_stat(gjson_path)
+    cached = None
+    try:
+        cached = SectionRegionIndex.load(index_path)
+    except (OSError, ValueError, KeyError):
+        pass
+    if cached is not None and (
+        cached.key.get("version") == INDEX_VERSION
+        and cached.key.get("shape") == (h, w)
+    ):
+        if (cached.key.get("mtime"), cached.key.get("size")) == (mtime, size):
+            return cached
+        sha = file_sha256(gjson_path)
+        if cached.key.get("geojson_hash") == sha:
+            # Same content under a new stat, skip the hash next time
+            cached.key.update(mtime=mtime, size=size)
+            if persist:
+                try:
+                    cached.save(index_path)
+                except OSError:
+                    pass
+            return cached
+    else:
+        sha = file_sha256(gjson_path)
+    key = {
+        "version": INDEX_VERSION,
+        "geojson_hash": sha,
+        "shape": (h, w),
+        "mtime": mtime,
+        "size": size,
+    }
+    index = SectionRegionIndex.from_geojson(gjson_path, h, w, key)
+    if persist:
+        try:
+            index.save(index_path)
+        except OSError:
+            pass
+    return index
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_region_index(brain_id, section_id):
+    """SectionRegionIndex of a section, kept per process until its geojson changes"""
+    path_config = PathConfig(brain_id, section_id)
+    stat = _geojson_stat(path_config.gjson_path())
+    with _indexes_lock:
+        cached = _indexes.get((brain_id, section_id))
+    if cached is not None and cached[0] == stat:
+        return cached[1]
+    h, w = za.open(path_config.zarr_store_path(), mode="r").shape[:2]
+    index = load_region_index(path_config, h, w)
+    with _indexes_lock:
+        _indexes[(brain_id, section_id)] = (stat, index)
+    return index
+
+
+def regions_in_window(brain_id, section_id, bbox):
+    """
+    Region ids touched by the window bbox = (min_x, min_y, max_x, max_y) of a
+    section, in full resolution image pixels
+    """
+    return get_region_index(brain_id, section_id).query(bbox)
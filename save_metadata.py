@@ -1,7 +1,11 @@
 from lib.patch_db import PatchDB
 from lib.path_config import PathConfig
-from lib.sync.registrar import MetaSync
+from lib.manifest import SectionManifest, code_version
+from lib.inverted_index import RegionPatchIndex
+from lib.metadata_writer import COPY_BATCH_SIZE, PostgresRegistrar
 import concurrent.futures
+import queue
+import threading
 from tqdm import tqdm
 import argparse
 import warnings
@@ -9,8 +13,10 @@ warnings.filterwarnings("ignore")
 
 import os
 
-def get_tasks(brain_id):
-    brain_ids = [141,142,244,222]
+BRAIN_IDS = [141,142,244,222]
+
+def get_tasks(brain_id=None):
+    brain_ids = BRAIN_IDS if brain_id is None else [brain_id]
     brain_sections = {b:[] for b in brain_ids}
     task_sections = []
     for brain_id in brain_ids:
@@ -21,53 +27,223 @@ def get_tasks(brain_id):
     return task_sections
 
 
-def work_unit(brain_id, section_id, patch_size, stride):
+def get_pending_tasks(manifest, task_sections, patch_size, stride, retry_failed=False):
+    """Section keys of the tasks that are new, changed or failed since their last run"""
+    version = code_version()
+    if retry_failed:
+        failed = set(manifest.failed_sections())
+        task_sections = [t for t in task_sections if t in failed]
+    keys = [manifest.section_key(b, s, patch_size, stride, version) for b, s in task_sections]
+    return [key for key in keys if not manifest.is_complete(key)]
+
+
+def work_unit(brain_id, section_id, patch_size, stride, masks=False):
     try:
         pdb = PatchDB(brain_id, section_id, patch_size, stride)
+        pdb.detect_background()
         pdb.populate_db()
+        if masks:
+            pdb.rasterize_labels()
         pdb.qc_check()
-        # registrar.sync_patches(pdb)
-        return pdb
+        # Only ship the compact result back to the parent process
+        return pdb.result(), None
     except Exception as e:
         with open('error_log.txt','a') as f:
             f.write(f'BrainID:{brain_id},SectionID:{section_id},Error:{e}\n')    
-    return None
+        return None, repr(e)
+
+class SyncStage(threading.Thread):
+    """
+    Dedicated sync thread between the compute pool and the metadata DB.
+
+    Results are put on a bounded queue, so the producer blocks when the DB
+    falls behind. The thread accumulates results across sections until they
+    hold batch_size patches, or the queue stays idle for flush_interval
+    seconds, and writes them in one call. A registrar with sync_batch gets
+    the whole batch, otherwise each result goes through sync_patches.
+    The postings of every written batch go to the region to patch index of
+    their brain, then its section keys are marked complete in the manifest.
+    Failed batches are counted in errors and recorded in the manifest's
+    failure table; no error ends the thread before close. put and close
+    raise once the thread is gone instead of blocking on the queue.
+    """
+
+    def __init__(self, registrar, manifest, max_queue=128, batch_size=50000, flush_interval=5.0):
+        super().__init__(daemon=True)
+        self.registrar = registrar
+        self.manifest = manifest
+        self.region_indexes = {}
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.errors = 0
+
+    def put(self, key, result):
+        self._put((key, result))
+
+    def _put(self, item):
+        # A thread that is gone never drains the queue, fail instead of blocking on it
+        while True:
+            if not self.is_alive():
+                raise RuntimeError('Sync thread is not running')
+            try:
+                self.queue.put(item, timeout=self.flush_interval)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        if self.is_alive():
+            self._put(None)
+            self.join()
+
+    def fail(self, batch, stage, error):
+        """Count and log a failed batch and record it in the manifest's failure table"""
+        self.errors += len(batch)
+        sections = ','.join(f'{r.brain_id}:{r.section_id}' for _, r in batch)
+        try:
+            with open('error_log.txt','a') as f:
+                f.write(f'{stage.capitalize()}:{sections},Error:{error}\n')
+            for key, _ in batch:
+                self.manifest.record_failure(key, stage, error)
+        except Exception as e:
+            print(f'Sync:{sections},Stage:{stage},Error:{error},Logging failed:{e}')
+
+    def flush(self, batch):
+        if not batch:
+            return
+        keys = [key for key, _ in batch]
+        results = [result for _, result in batch]
+        try:
+            if hasattr(self.registrar, 'sync_batch'):
+                self.registrar.sync_batch(results)
+            else:
+                for result in results:
+                    self.registrar.sync_patches(result)
+        except Exception as e:
+            self.fail(batch, 'sync', e)
+            return
+        try:
+            self.index_regions(results)
+        except Exception as e:
+            self.fail(batch, 'index', e)
+            return
+        try:
+            self.manifest.mark_complete(keys)
+        except Exception as e:
+            self.fail(batch, 'manifest', e)
+
+    def index_regions(self, results):
+        brains = {}
+        for result in results:
+            brains.setdefault(result.brain_id, []).append(result)
+        for brain_id, brain_results in brains.items():
+            if brain_id not in self.region_indexes:
+                self.region_indexes[brain_id] = RegionPatchIndex.for_brain(brain_id)
+            self.region_indexes[brain_id].add_sections(brain_results)
+
+    def flush_safely(self, batch):
+        try:
+            self.flush(batch)
+        except Exception as e:
+            self.fail(batch, 'sync', e)
+
+    def close_indexes(self):
+        for brain_id, region_index in self.region_indexes.items():
+            try:
+                region_index.close()
+            except Exception as e:
+                with open('error_log.txt','a') as f:
+                    f.write(f'Index:{brain_id},Error:{e}\n')
+
+    def run(self):
+        # Errors are counted and logged, never raised: the thread has to keep
+        # draining the queue until close, or put and close would block forever
+        batch, n_patches = [], 0
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.flush_safely(batch)
+                batch, n_patches = [], 0
+                continue
+            if item is None:
+                self.flush_safely(batch)
+                self.close_indexes()
+                return
+            batch.append(item)
+            n_patches += len(item[1])
+            if n_patches >= self.batch_size:
+                self.flush_safely(batch)
+                batch, n_patches = [], 0
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--brain_id', type=int)
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--sync_queue', type=int, default=128)
+    parser.add_argument('--sync_batch', type=int, default=50000)
+    parser.add_argument('--patch_size', type=int, default=1024)
+    parser.add_argument('--stride', type=int, default=512)
+    parser.add_argument('--manifest', default='metadata_manifest.sqlite')
+    parser.add_argument('--retry_failed', action='store_true', help='only rerun sections from the failure table')
+    parser.add_argument('--masks', action='store_true', help='also write the rasterized label mask of every section')
+    parser.add_argument('--postgres', action='store_true', help='bulk write with COPY to the metadata Postgres DB instead of MetaSync')
+    parser.add_argument('--dsn', help='Postgres DSN for --postgres, defaults to lib.db_config.metadata_dsn()')
+    parser.add_argument('--copy_batch', type=int, default=COPY_BATCH_SIZE, help='rows per COPY with --postgres')
     args = parser.parse_args()
+    manifest = SectionManifest(args.manifest)
     task_sections = get_tasks(args.brain_id)
-    registrar = MetaSync()
+    task_keys = get_pending_tasks(
+        manifest, task_sections, args.patch_size, args.stride, args.retry_failed
+    )
+    print(f'{len(task_keys)} of {len(task_sections)} sections to process')
+    if args.postgres:
+        registrar = PostgresRegistrar(args.dsn, batch_size=args.copy_batch)
+    else:
+        from lib.sync.registrar import MetaSync
+        registrar = MetaSync()
+    sync = SyncStage(registrar, manifest, max_queue=args.sync_queue, batch_size=args.sync_batch)
+    sync.start()
     errors = 0
-    with tqdm(total=len(task_sections)) as pbar:
-        print(f'Processing {args.brain_id}')
-        pdbs = []
-        with concurrent.futures.ProcessPoolExecutor(max_workers=64) as executor:
-            futures = []
-            for brain_id, section_id in task_sections:
-                f = executor.submit(work_unit, brain_id, section_id, 1024, 512)
-                futures.append(f)
-            for future in concurrent.futures.as_completed(futures):
-                pdb = future.result()
-                pdbs.append(pdb)
-                if pdb:
-                    registrar.sync_patches(pdb)
-                else:
-                    errors += 1
-                pbar.update(1)
-        # print(f'Processing {args.brain_id} - Syncing')
-        # with concurrent.futures.ThreadPoolExecutor() as executor:
-        #     futures = []
-        #     for pdb in pdbs:
-        #         if pdb:
-        #             f = executor.submit(registrar.sync_patches, pdb)
-        #             futures.append(f)
-        #         else:
-        #             errors += 1
-        #     for future in concurrent.futures.as_completed(futures):
-        #         pbar.update(1)
-            # for f in results:
-            #     if not f.result():
-            #         errors += 1
-            print(f'Errors: {errors}')
\ No newline at end of file
+    try:
+        with tqdm(total=len(task_keys)) as pbar:
+            print(f'Processing {args.brain_id}')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+                tasks = iter(task_keys)
+                pending = {}
+
+                def submit_next():
+                    key = next(tasks, None)
+                    if key is not None:
+                        future = executor.submit(
+                            work_unit, key.brain_id, key.section_id, key.patch_size, key.stride, args.masks
+                        )
+                        pending[future] = key
+
+                # Only keep a bounded number of sections in flight, so a full sync
+                # queue also holds back the compute pool
+                for _ in range(2 * args.workers):
+                    submit_next()
+                while pending:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        key = pending.pop(future)
+                        result, error = future.result()
+                        if result is not None:
+                            sync.put(key, result)
+                        else:
+                            manifest.record_failure(key, 'compute', error)
+                            errors += 1
+                        pbar.update(1)
+                        submit_next()
+    finally:
+        # Flushes the queued results before the registrar goes away
+        sync.close()
+        if args.postgres:
+            registrar.close()
+        manifest.close()
+    print(f'Errors: {errors + sync.errors}')
@@ -0,0 +1,102 @@
+"""
+Fixtures of the API tests: a synthetic section store and app.api.main served
+by uvicorn on a free port.
+
+The app modules import lib relatively, so the app is imported as a package
+named after the repository directory. The lifespan (and its 16 worker
+LocalCluster) is left off: get_client hands out the client of a one worker,
+in-process cluster started on the server's event loop.
+"""
+import asyncio
+import importlib
+import os
+import socket
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_PACKAGE = f"{os.path.basename(REPO)}.app.api"
+
+SECTION_SHAPE = (2048, 3072)
+
+
+def import_api(module):
+    """Module of app.api, the tests are skipped where the app cannot be imported"""
+    if os.path.dirname(REPO) not in sys.path:
+        sys.path.append(os.path.dirname(REPO))
+    try:
+        return importlib.import_module(f"{API_PACKAGE}.{module}")
+    except ImportError as e:
+        pytest.skip(f"app.api.{module} is not importable here: {e}", allow_module_level=True)
+
+
+@pytest.fixture(scope="session")
+def section_store(tmp_path_factory):
+    """Path and pixels of a random h x w x 3 uint8 zarr section"""
+    zarr = pytest.importorskip("zarr")
+    path = str(tmp_path_factory.mktemp("section") / "section.zarr")
+    pixels = np.random.default_rng(0).integers(0, 256, SECTION_SHAPE + (3,), dtype=np.uint8)
+    store = zarr.open(path, mode="w", shape=pixels.shape, chunks=(1024, 1024, 3), dtype=np.uint8)
+    store[:] = pixels
+    return path, pixels
+
+
+@pytest.fixture(scope="session")
+def api_server(tmp_path_factory):
+    """Base url of app.api.main served by uvicorn, with its main module"""
+    main = import_api("main")
+    response_cache = import_api("response_cache")
+    uvicorn = pytest.importorskip("uvicorn")
+    from dask.distributed import Client, LocalCluster
+
+    resources = {}
+
+    async def start_cluster():
+        resources["cluster"] = await LocalCluster(
+            n_workers=1, processes=False, asynchronous=True, dashboard_address=None
+        )
+        resources["client"] = await Client(resources["cluster"], asynchronous=True)
+
+    async def stop_cluster():
+        await resources["client"].close()
+        await resources["cluster"].close()
+
+    async def get_client():
+        return resources["client"]
+
+    # Cached responses go to a temporary directory
+    cache = response_cache.ResponseCache(str(tmp_path_factory.mktemp("response_cache")))
+    saved_cache = main.get_response_cache
+    main.get_response_cache = lambda: cache
+    main.app.dependency_overrides[main.get_client] = get_client
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, lifespan="off", log_level="warning")
+    )
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(start_cluster())
+        try:
+            loop.run_until_complete(server.serve(sockets=[sock]))
+        finally:
+            loop.run_until_complete(stop_cluster())
+            loop.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            pytest.fail("uvicorn did not start")
+        thread.join(0.05)
+    yield f"http://127.0.0.1:{sock.getsockname()[1]}", main
+    server.should_exit = True
+    thread.join(30)
+    main.app.dependency_overrides.clear()
+    main.get_response_cache = saved_cache
@@ -0,0 +1,98 @@
+"""
+PatchLoader against app.api.main served by uvicorn (see conftest): decoded
+tensors, buffer reuse and the throughput meter.
+"""
+import numpy as np
+import pytest
+
+from conftest import SECTION_SHAPE, import_api
+
+client = import_api("client")
+
+PATCH = 1024
+
+
+def make_batches(store_path, n_batches):
+    """Batches of every patch of the section, each starting one patch later"""
+    origins = [
+        (x, y)
+        for y in range(0, SECTION_SHAPE[0], PATCH)
+        for x in range(0, SECTION_SHAPE[1], PATCH)
+    ]
+    batches = []
+    for n in range(n_batches):
+        shifted = origins[n % len(origins) :] + origins[: n % len(origins)]
+        batches.append(
+            {
+                f"1_1_{x}_{y}": {
+                    "brain_id": 1,
+                    "section_id": 1,
+                    "x": x,
+                    "y": y,
+                    "store_path": store_path,
+                }
+                for x, y in shifted
+            }
+        )
+    return batches
+
+
+def expected(pixels, patch_id):
+    x, y = map(int, patch_id.split("_")[2:])
+    return pixels[y : y + PATCH, x : x + PATCH]
+
+
+def check_batches(loader, pixels):
+    """Yield the loader's batches after checking their images against the section"""
+    for batch in loader:
+        assert batch.masks is None
+        for patch_id, image in zip(batch.ids, batch.images):
+            image = np.asarray(image)
+            np.testing.assert_array_equal(image, expected(pixels, patch_id))
+            # Tensors are views into the response buffer
+            assert np.shares_memory(image, batch.buffer.array)
+        yield batch
+
+
+@pytest.mark.parametrize("codec", [None, "zstd", "lz4"])
+def test_loader_decodes_batches_in_order(api_server, section_store, codec):
+    if (codec == "zstd" and client.zstandard is None) or (codec == "lz4" and client.lz4_frame is None):
+        pytest.skip(f"{codec} is not installed")
+    url, _ = api_server
+    store_path, pixels = section_store
+    batches = make_batches(store_path, 5)
+    with client.PatchLoader(url, batches, concurrency=2, codec=codec) as loader:
+        seen = [batch.ids for batch in check_batches(loader, pixels)]
+    assert seen == [list(batch) for batch in batches]
+
+
+def test_loader_reuses_buffers_and_meters(api_server, section_store):
+    url, _ = api_server
+    store_path, pixels = section_store
+    batches = make_batches(store_path, 8)
+    meter = client.ThroughputMeter()
+    buffers, nbytes = set(), 0
+    with client.PatchLoader(url, batches, concurrency=2, meter=meter) as loader:
+        for batch in check_batches(loader, pixels):
+            buffers.add(id(batch.buffer))
+            nbytes += batch.nbytes
+    # At most concurrency + 1 buffers for 8 batches
+    assert len(buffers) <= 3
+    n_patches = sum(len(batch) for batch in batches)
+    assert (meter.batches, meter.patches, meter.bytes) == (8, n_patches, nbytes)
+    rates = meter.rates()
+    assert rates["patches_per_s"] > 0 and rates["latency_p50_ms"] > 0
+    assert str(meter).startswith(f"8 batches  {n_patches} patches")
+
+
+def test_loader_without_reuse_keeps_batches(api_server, section_store):
+    url, _ = api_server
+    store_path, pixels = section_store
+    batches = make_batches(store_path, 3)
+    with client.PatchLoader(url, batches, concurrency=2, reuse_buffers=False) as loader:
+        kept = list(loader)
+    # Earlier batches stay intact while later ones are decoded
+    assert len({id(batch.buffer) for batch in kept}) == 3
+    for batch in kept:
+        for patch_id, image in zip(batch.ids, batch.images):
+            np.testing.assert_array_equal(np.asarray(image), expected(pixels, patch_id))
@@ -0,0 +1,99 @@
+"""
+Conditional /get_patches/ requests against app.api.main served by uvicorn
+(see conftest): the ETag of a batch and 412 on a matching If-None-Match.
+"""
+import pytest
+
+from conftest import SECTION_SHAPE, import_api
+
+httpx = pytest.importorskip("httpx")
+
+response_cache = import_api("response_cache")
+
+PATCH = 1024
+
+
+def batch(store_path, n_patches=2):
+    origins = [(x, 0) for x in range(0, SECTION_SHAPE[1], PATCH)][:n_patches]
+    return {
+        "patches": {
+            f"1_1_{x}_{y}": {
+                "brain_id": 1,
+                "section_id": 1,
+                "x": x,
+                "y": y,
+                "store_path": store_path,
+            }
+            for x, y in origins
+        }
+    }
+
+
+def post(url, body, cache=False, stream=False, if_none_match=None):
+    headers = {"Accept-Encoding": "identity"}
+    if if_none_match is not None:
+        headers["If-None-Match"] = if_none_match
+    return httpx.post(
+        f"{url}/get_patches/",
+        params={"cache": cache, "stream": stream},
+        json=body,
+        headers=headers,
+        timeout=60,
+    )
+
+
+@pytest.mark.parametrize("header", ["{tag}", "W/{tag}", '"other", {tag}', "*"])
+@pytest.mark.parametrize("cache", [False, True])
+def test_matching_if_none_match_is_412(api_server, section_store, header, cache):
+    url, _ = api_server
+    body = batch(section_store[0])
+    # Without cache, any conditional request is answered with the ETag
+    tag = post(url, body, cache=cache, if_none_match='"other"').headers["ETag"]
+    response = post(url, body, cache=cache, if_none_match=header.format(tag=tag))
+    assert response.status_code == 412
+    assert response.headers["ETag"] == tag
+    assert response.content == b""
+    assert "X-Response-Cache" not in response.headers
+
+
+def test_hit_and_miss_share_the_etag(api_server, section_store):
+    url, _ = api_server
+    body = batch(section_store[0], n_patches=3)
+    first = post(url, body, cache=True)
+    second = post(url, body, cache=True)
+    assert (first.status_code, second.status_code) == (200, 200)
+    assert first.headers["X-Response-Cache"] == "miss"
+    assert second.headers["X-Response-Cache"] == "hit"
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert first.content == second.content
+    # Without cache the ETag is only sent to conditional requests
+    uncached = post(url, body)
+    assert "ETag" not in uncached.headers and "X-Response-Cache" not in uncached.headers
+
+
+def test_other_etag_gets_the_payload(api_server, section_store):
+    url, _ = api_server
+    body = batch(section_store[0])
+    expected = post(url, body)
+    response = post(url, body, if_none_match='"other", W/"another"')
+    assert response.status_code == 200
+    assert response.content == expected.content
+    assert response.headers["ETag"] != '"other"'
+
+
+def test_etag_matches():
+    tag = response_cache.etag("abc", "zstd")
+    assert tag == '"abc-zstd"'
+    assert response_cache.etag_matches(f' "x" ,W/{tag}', tag)
+    assert response_cache.etag_matches("*", tag)
+    assert not response_cache.etag_matches(response_cache.etag("abc"), tag)
+    assert not response_cache.etag_matches(None, tag)
+
+
+def test_streams_ignore_if_none_match(api_server, section_store):
+    url, _ = api_server
+    body = batch(section_store[0])
+    response = post(url, body, stream=True, if_none_match="*")
+    assert response.status_code == 200
+    assert response.headers["X-Patch-Framing"] == "length-prefixed-safetensors"
+    assert "ETag" not in response.headers
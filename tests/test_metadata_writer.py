@@ -0,0 +1,237 @@
+"""
+Row building and merge/delete semantics of lib.metadata_writer.
+
+The writer's SQL is Postgres only (COPY, ON CONFLICT, unnest), so the DB
+tests run against METADATA_TEST_PG_DSN, or a throwaway server from pgserver
+when it is installed, and are skipped otherwise. Every test works in its own
+schema, which is dropped afterwards.
+"""
+import asyncio
+import copy
+import json
+import os
+import uuid
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+asyncpg = pytest.importorskip("asyncpg")
+
+from lib.metadata_writer import PatchMetadataWriter, label_rows, patch_rows
+
+SQUARE = {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]]}
+
+
+def make_result(section_id=7, n=6, brain_id=141):
+    """PatchDBResult stand-in: n patches on a row, patch i labeled with region 10 + i % 3"""
+    min_x = np.arange(n, dtype=np.int64) * 512
+    min_y = np.zeros(n, dtype=np.int64)
+    label_columns = ["10", "11", "12"]
+    rows = np.arange(n)
+    cols = rows % 3
+    coverage = np.linspace(0.5, 1.0, n)
+    labels = sparse.csr_matrix((coverage, (rows, cols)), shape=(n, len(label_columns)))
+    payload = [
+        [i, [int(label_columns[cols[i]])], [[int(label_columns[cols[i]]), SQUARE]], []]
+        for i in range(0, n, 2)
+    ]
+    return SimpleNamespace(
+        brain_id=brain_id,
+        section_id=section_id,
+        patch_size=1024,
+        stride=512,
+        no_geojson=False,
+        min_x=min_x,
+        min_y=min_y,
+        is_bg=np.zeros(n, dtype=bool),
+        check_bg=True,
+        labels=labels,
+        label_columns=label_columns,
+        payload=json.dumps(payload).encode(),
+    )
+
+
+def drop_patches(result, keep):
+    """Result of a rerun where qc_check only kept the patches in the boolean mask keep"""
+    kept = copy.copy(result)
+    kept.min_x, kept.min_y, kept.is_bg = result.min_x[keep], result.min_y[keep], result.is_bg[keep]
+    kept.labels = result.labels[keep]
+    new_idx = np.cumsum(keep) - 1
+    kept.payload = json.dumps(
+        [[int(new_idx[i]), *rest] for i, *rest in json.loads(result.payload) if keep[i]]
+    ).encode()
+    return kept
+
+
+def test_patch_rows():
+    rows = list(patch_rows(make_result(n=3)))
+    assert [r[0] for r in rows] == ["141_7_0_0", "141_7_512_0", "141_7_1024_0"]
+    assert rows[1] == (
+        "141_7_512_0",
+        141,
+        7,
+        512,
+        0,
+        1024,
+        "/storage/BrainSAM/zarr_n5/optimum_1024/141/7.n5",
+        False,
+        True,
+        False,
+    )
+
+
+def test_label_rows():
+    result = make_result(n=4)
+    result.labels[3, 0] = 0.0
+    rows = {(r[0], r[1]): r for r in label_rows(result)}
+    # Only non-zero coverages, one row per (patch, region)
+    assert sorted(rows) == [("141_7_0_0", 10), ("141_7_1024_0", 12), ("141_7_512_0", 11)]
+    assert rows["141_7_512_0", 11][4] == pytest.approx(result.labels[1, 1])
+    # Polygons of the patches the payload kept them for, as JSON text
+    assert json.loads(rows["141_7_0_0", 10][5]) == SQUARE
+    assert rows["141_7_512_0", 11][5] is None
+
+
+@pytest.fixture(scope="session")
+def pg_dsn(tmp_path_factory):
+    dsn = os.environ.get("METADATA_TEST_PG_DSN")
+    if dsn:
+        yield dsn
+        return
+    pgserver = pytest.importorskip("pgserver")
+    server = pgserver.get_server(tmp_path_factory.mktemp("pgdata"), cleanup_mode="stop")
+    yield server.get_uri()
+
+
+@pytest.fixture
+def db(pg_dsn):
+    """Run a coroutine function with a PatchMetadataWriter in a fresh schema"""
+    schema = f"test_{uuid.uuid4().hex}"
+
+    def run(fn, batch_size=4):
+        async def main():
+            conn = await asyncpg.connect(pg_dsn, server_settings={"search_path": schema})
+            try:
+                await conn.execute(f"CREATE SCHEMA {schema}")
+                writer = PatchMetadataWriter(conn, batch_size=batch_size)
+                await writer.create_tables()
+                return await fn(writer, conn)
+            finally:
+                await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+                await conn.close()
+
+        return asyncio.run(main())
+
+    return run
+
+
+async def table_rows(conn):
+    patches = await conn.fetch("SELECT * FROM patches ORDER BY id")
+    labels = await conn.fetch("SELECT * FROM patch_labels ORDER BY patch_id, region_id")
+    return [tuple(r) for r in patches], [tuple(r) for r in labels]
+
+
+async def row_versions(conn):
+    """Tuple versions of every row, they change whenever a row is rewritten"""
+    return (
+        await conn.fetch("SELECT id, xmin::text FROM patches ORDER BY id"),
+        await conn.fetch("SELECT patch_id, region_id, xmin::text FROM patch_labels ORDER BY 1, 2"),
+    )
+
+
+def test_write_sections(db):
+    results = [make_result(section_id=1, n=5), make_result(section_id=2, n=3)]
+
+    async def check(writer, conn):
+        counts = await writer.write_sections(results)
+        patches, labels = await table_rows(conn)
+        assert counts == {"patches": 8, "labels": 8}
+        assert len(patches) == 8 and len(labels) == 8
+        assert patches == sorted(r for result in results for r in patch_rows(result))
+        polygons = {(r[0], r[1]): r[5] for r in labels}
+        assert json.loads(polygons["141_1_0_0", 10]) == SQUARE
+        assert polygons["141_1_512_0", 11] is None
+
+    db(check, batch_size=3)
+
+
+def test_unchanged_rerun_writes_nothing(db):
+    results = [make_result(section_id=1), make_result(section_id=2)]
+
+    async def check(writer, conn):
+        await writer.write_sections(results)
+        before_rows, before_versions = await table_rows(conn), await row_versions(conn)
+        await writer.write_sections(results)
+        assert await table_rows(conn) == before_rows
+        assert await row_versions(conn) == before_versions
+
+    db(check)
+
+
+def test_rerun_deletes_patches_dropped_by_qc(db):
+    first = make_result(section_id=1, n=6)
+    other = make_result(section_id=2, n=6)
+    keep = np.array([True, False, True, True, False, True])
+
+    async def check(writer, conn):
+        await writer.write_sections([first, other])
+        other_rows = [r for r in (await table_rows(conn))[0] if r[2] == 2]
+        rerun = drop_patches(first, keep)
+        await writer.write_sections([rerun])
+        patches, labels = await table_rows(conn)
+        assert [r for r in patches if r[2] == 1] == sorted(patch_rows(rerun))
+        assert {(r[0], r[1]) for r in labels if r[3] == 1} == {
+            (r[0], r[1]) for r in label_rows(rerun)
+        }
+        # Sections that were not rewritten keep their rows
+        assert [r for r in patches if r[2] == 2] == other_rows
+
+    db(check)
+
+
+def test_rerun_updates_only_changed_rows(db):
+    result = make_result(section_id=1, n=4)
+
+    async def check(writer, conn):
+        await writer.write_sections([result])
+        before = dict((await row_versions(conn))[0])
+        changed = copy.copy(result)
+        changed.is_bg = result.is_bg.copy()
+        changed.is_bg[2] = True
+        await writer.write_sections([changed])
+        after = dict((await row_versions(conn))[0])
+        rewritten = {key for key in before if before[key] != after[key]}
+        assert rewritten == {"141_1_1024_0"}
+        assert await conn.fetchval("SELECT is_bg FROM patches WHERE id = '141_1_1024_0'")
+
+    db(check)
+
+
+def test_repeated_section_is_written_from_its_last_result(db):
+    result = make_result(section_id=1, n=4)
+    rerun = drop_patches(result, np.array([True, True, False, False]))
+
+    async def check(writer, conn):
+        counts = await writer.write_sections([result, rerun])
+        patches, _ = await table_rows(conn)
+        assert counts["patches"] == 2
+        assert patches == sorted(patch_rows(rerun))
+
+    db(check)
+
+
+def test_failed_write_leaves_tables_untouched(db):
+    result = make_result(section_id=1, n=4)
+    broken = copy.copy(result)
+    broken.payload = b"not json"
+
+    async def check(writer, conn):
+        await writer.write_sections([result])
+        before = await table_rows(conn)
+        with pytest.raises(ValueError):
+            await writer.write_sections([make_result(section_id=2), broken])
+        assert await table_rows(conn) == before
+
+    db(check)